@@ -1,12 +1,27 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import re
-import base64
 import time
+import os
+import hashlib
+import tempfile
+import threading
+import random
+import difflib
+import io
+import zipfile
+import sqlite3
+import uuid
+from email.utils import parsedate_to_datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from datetime import datetime
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Iterator, Callable, Tuple
 
 # Configuración de la página
 st.set_page_config(
@@ -17,76 +32,200 @@ st.set_page_config(
 
 # Configuración de EdiBlocks
 EDIBLOCKS_BASE_URL = "https://ediblocks-test.edinumen.es"
+EDIBLOCKS_POOL_SIZE = 8  # Conexiones keep-alive reutilizables por URL base y API key
+EDIBLOCKS_TIMEOUT = (5, 30)  # (conexión, lectura) en segundos
+EDIBLOCKS_PREGUNTAS_POR_LOTE = 25  # Preguntas enviadas en cada petición al añadirlas a un grupo
 
-# Tipologías definidas directamente como objeto Python para evitar problemas con JSON
+# Configuración de la API de Anthropic
+ANTHROPIC_API_URL = "https://api.anthropic.com/v1/messages"
+ANTHROPIC_API_VERSION = "2023-06-01"
+ANTHROPIC_POOL_SIZE = 16  # Conexiones keep-alive reutilizables (>= análisis simultáneos de un lote)
+ANTHROPIC_TIMEOUT = (10, 60)  # (conexión, lectura) en segundos
+ANTHROPIC_RPM = 50  # Peticiones por minuto permitidas para la clave compartida
+ANTHROPIC_TPM = 80000  # Tokens (entrada + salida) por minuto permitidos para la clave compartida
+
+# Valor del enunciado cuando la respuesta de Claude no incluye ninguno
+ENUNCIADO_NO_ENCONTRADO = "No se encontró un enunciado claro"
+
+# Patrones de línea de las respuestas de Claude (cada línea se clasifica una sola vez)
+PATRON_LINEA_ENUNCIADO = re.compile(r'(?:ENUNCIADO PRINCIPAL|ENUNCIADO|INSTRUCCIÓN):\s*(.*)$', re.IGNORECASE)
+PATRON_LINEA_ACTIVIDAD = re.compile(r'^\s*ACTIVIDAD\s+(\d+):\s*(.*)$', re.IGNORECASE)
+PATRON_LINEA_CAMPO = re.compile(
+    r'^\s*(?:-\s*)?(Texto original|Tipo de shortcode|Shortcode generado):\s*(.*)$', re.IGNORECASE
+)
+PATRON_LINEA_ACTIVIDAD_LIBRE = re.compile(r'^\s*(?:ACTIVIDAD|EJERCICIO|PREGUNTA)(?![^\W\d])\s*(\d+)?\s*:?\s*(.*)$', re.IGNORECASE)
+PATRON_LINEA_CAMPO_LIBRE = re.compile(r'^\s*(TIPO|SHORTCODE|CÓDIGO)(?![^\W\d])\s*:?\s*(.*)$', re.IGNORECASE)
+# Etiquetas de campo escritas en la misma línea que "ACTIVIDAD N:" (una o varias seguidas)
+PATRON_CAMPO_EN_LINEA = re.compile(r'(?:-\s*)?(Texto original|Tipo de shortcode|Shortcode generado):\s*', re.IGNORECASE)
+CAMPOS_ACTIVIDAD = {
+    "texto original": "texto_original",
+    "tipo de shortcode": "tipo",
+    "shortcode generado": "shortcode"
+}
+
+# Análisis por bloques de textos largos
+TEXTO_BLOQUE_MAX_CARACTERES = 8000  # Por debajo de este tamaño el texto se analiza de una vez
+PATRON_ENCABEZADO_EJERCICIO = re.compile(r'^\s*(?:ejercicio|actividad|pregunta|tarea)\s*\d+', re.IGNORECASE)
+PATRON_LINEA_NUMERADA = re.compile(r'^\s*\d{1,3}\s*[.)]\s+\S')
+
+# Reintentos ante errores transitorios (429, 529, 5xx, red)
+REINTENTOS_MAXIMOS = 4
+REINTENTOS_ESPERA_BASE = 1.0  # Segundos del primer backoff
+REINTENTOS_ESPERA_MAXIMA = 30.0  # Tope de cada espera, incluida la indicada por retry-after
+
+# Continuación automática de respuestas cortadas por max_tokens
+MAX_CONTINUACIONES = 3
+
+# Versiones de shortcodes retenidas por actividad (las anteriores se guardan como diferencias)
+VERSIONES_MAX_POR_ACTIVIDAD = 20
+
+# Procesamiento por lotes de imágenes
+LOTE_MAX_WORKERS = 4  # Análisis simultáneos por defecto
+LOTE_MAX_WORKERS_LIMITE = 16
+
+# Caché persistente de respuestas de análisis
+CACHE_RESPUESTAS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "respuestas")
+CACHE_RESPUESTAS_MAX_BYTES = 200 * 1024 * 1024  # Tamaño máximo antes de expulsar entradas (LRU)
+CACHE_RESPUESTAS_TTL = None  # Segundos de validez de una entrada (None = sin caducidad)
+IMAGENES_POOL_SIZE = LOTE_MAX_WORKERS_LIMITE  # Conexiones keep-alive para identificar las imágenes de un lote
+IMAGENES_TIMEOUT = (5, 10)  # (conexión, lectura) en segundos
+
+# Historial de acciones: entradas en memoria antes de volcar las más antiguas a disco
+HISTORIAL_CAPACIDAD = 200
+HISTORIAL_POR_PAGINA = 10
+
+# Actividades del resultado mostradas en cada página de la columna de resultados
+ACTIVIDADES_POR_PAGINA = 20
+HISTORIAL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "historial")
+HISTORIAL_MAX_EDAD = 7 * 24 * 3600  # Segundos sin escribir tras los que se borra un volcado del historial
+
+# Almacén persistente de proyectos (resultados, versiones y publicaciones) para reanudar el trabajo
+PROYECTOS_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "proyectos.sqlite3")
+PROYECTOS_CACHE_MAX = 64  # Resultados y almacenes de versiones cargados en memoria (compartidos por las sesiones)
+
+# Tipologías definidas directamente como objeto Python para evitar problemas con JSON.
+# Es el registro único de tipos de shortcode (etiqueta, ejemplo, documentación para los prompts
+# y tipo de pregunta en EdiBlocks): los prompts y la detección de tipo se generan a partir de él.
 TIPOLOGIAS = [
     {
         "name": "drag-words",
         "label": "Arrastrar palabras",
-        "sample": "[drag-words words=\"gato|perro|elefante|mono|rata\" sentence=\"El [] es más grande que el [], pero el [] es el más [] pequeño.\" markers=\"elefante|perro|gato|mono\"][/drag-words]"
+        "uso": "Ejercicios donde hay que completar frases arrastrando palabras a huecos",
+        "formato": "[drag-words words=\"palabra1|palabra2|palabra3\" sentence=\"Texto con [] para rellenar\" markers=\"palabra_correcta1|palabra_correcta2\"][/drag-words]",
+        "sample": "[drag-words words=\"gato|perro|elefante|mono|rata\" sentence=\"El [] es más grande que el [], pero el [] es el más [] pequeño.\" markers=\"elefante|perro|gato|mono\"][/drag-words]",
+        "tipo_ediblocks": "drag-words"
     },
     {
         "name": "multiple-choice",
         "label": "Selección múltiple",
-        "sample": "[multiple-choice options=\"Lechuga|Manzana|Zanahoria|Plátano|Pera\" correctOptions=\"Manzana|Plátano|Pera\"][/multiple-choice]"
+        "uso": "Preguntas con MÚLTIPLES respuestas correctas posibles",
+        "formato": "[multiple-choice options=\"opción1|opción2|opción3\" correctOptions=\"opciónCorrecta1|opciónCorrecta2\"][/multiple-choice]",
+        "sample": "[multiple-choice options=\"Lechuga|Manzana|Zanahoria|Plátano|Pera\" correctOptions=\"Manzana|Plátano|Pera\"][/multiple-choice]",
+        "tipo_ediblocks": "multiple-choice"
     },
     {
         "name": "single-choice",
         "label": "Selección única",
-        "sample": "[single-choice options=\"Rojo|Verde|Azul|Amarillo\" correctOption=\"Azul\"][/single-choice]"
+        "uso": "Preguntas con UNA SOLA respuesta correcta",
+        "formato": "[single-choice options=\"opción1|opción2|opción3\" correctOption=\"opciónCorrecta\"][/single-choice]",
+        "sample": "[single-choice options=\"Rojo|Verde|Azul|Amarillo\" correctOption=\"Azul\"][/single-choice]",
+        "tipo_ediblocks": "single-choice"
     },
     {
-        "name": "abnone-choice",
-        "label": "Elige A o B o Ninguno",
-        "sample": "[abnone-choice titlea=\"Lorem\" texta=\"Lorem ipsum Lorem ipsum\" titleb=\"Ipsum\" textb=\"Lorem\" questions=\"a*¿Lorem ipsum?|b*¿Ipsum lorem?|c*¿Dolor sit?\"][/abnone-choice]"
+        "name": "fill-in-the-blanks",
+        "label": "Texto con espacios para rellenar (texto libre)",
+        "uso": "Textos con espacios para rellenar (texto libre)",
+        "formato": "[fill-in-the-blanks text=\"Texto con [text|respuesta] para completar.\" casesensitive=\"false\" specialcharssensitive=\"false\"][/fill-in-the-blanks]",
+        "sample": "[fill-in-the-blanks text=\"La capital de [text|España] es Madrid.\" casesensitive=\"false\" specialcharssensitive=\"false\"][/fill-in-the-blanks]",
+        "nota": "Si hay varias respuestas válidas se deben separar con el símbolo almohadilla (#).",
+        "tipo_ediblocks": "fill-in-the-blanks"
     },
     {
-        "name": "statement-option-match",
-        "label": "Empareja opciones",
-        "sample": "[statement-option-match statements=\"a*Lorem ipsum|b*Ipsum lorem|c*Dolor sit\" options=\"a*Persona 1*Lorem ipsum Lorem ipsum|b*Persona 2*Lorem ipsum Lorem ipsum|c*Persona 3*Lorem ipsum Lorem ipsum\"][/statement-option-match]"
+        "name": "fill-in-the-blanks",
+        "label": "Texto con espacios para elegir entre dos opciones",
+        "uso": "Elegir entre dos opciones",
+        "formato": "[fill-in-the-blanks text=\"Texto: [radio|Verdadero#*Falso]\" casesensitive=\"false\" specialcharssensitive=\"false\"][/fill-in-the-blanks]",
+        "sample": "[fill-in-the-blanks text=\"La leche es: [radio|*Blanca#Negra]\" casesensitive=\"false\" specialcharssensitive=\"false\"][/fill-in-the-blanks]",
+        "nota": "El asterisco (*) indica la opción correcta y va delante de ella. El símbolo # separa las opciones.",
+        "tipo_ediblocks": "fill-in-the-blanks"
     },
     {
         "name": "fill-in-the-blanks",
-        "label": "Texto con espacios para rellenar (texto libre)",
-        "sample": "[fill-in-the-blanks text=\"La capital de [text|España] es Madrid.\"][/fill-in-the-blanks]"
+        "label": "Textos con espacios para seleccionar entre opciones (menú desplegable)",
+        "uso": "Textos con espacios para seleccionar entre opciones (menú desplegable)",
+        "formato": "[fill-in-the-blanks text=\"Texto con [select|Incorrecta1#*Correcta#Incorrecta2] para seleccionar.\" casesensitive=\"false\" specialcharssensitive=\"false\"][/fill-in-the-blanks]",
+        "sample": "[fill-in-the-blanks text=\"El animal más rápido es el [select|leopardo#*guepardo#león#tigre].\" casesensitive=\"false\" specialcharssensitive=\"false\"][/fill-in-the-blanks]",
+        "nota": "El asterisco (*) indica la opción correcta. Debe haber solo una opción correcta por cada hueco. El símbolo # separa las opciones. SIEMPRE hay que poner la opción correcta.",
+        "tipo_ediblocks": "fill-in-the-blanks"
     },
     {
         "name": "fill-in-the-blanks",
-        "label": "Textos con espacios para seleccionar entre opciones (menú desplegable)",
-        "sample": "[fill-in-the-blanks text=\"El animal más rápido del mundo es el [select|leopardo#*guepardo#león#tigre].\"][/fill-in-the-blanks]"
+        "label": "Letras para completar una palabra",
+        "uso": "Introducir letras para completar una única palabra",
+        "formato": "[fill-in-the-blanks text=\"Texto [short-text|letra1][short-text|letra2][short-text|letra3]\" casesensitive=\"false\" specialcharssensitive=\"false\"][/fill-in-the-blanks]",
+        "sample": "[fill-in-the-blanks text=\"El caballo [text|blanco] de Santiago es de [short-text|c][short-text|o][short-text|l][short-text|o][short-text|r] blanco.\" casesensitive=\"false\" specialcharssensitive=\"false\"][/fill-in-the-blanks]",
+        "tipo_ediblocks": "fill-in-the-blanks"
+    },
+    {
+        "name": "statement-option-match",
+        "label": "Empareja opciones",
+        "uso": "Emparejar conceptos o frases con sus correspondientes opciones correctas",
+        "formato": "[statement-option-match statements=\"a*afirmación1|b*afirmación2\" options=\"b*respuesta correcta para la afirmación2*descripción1 (puede no existir, si no existe no poner nada)|a*respuesta correcta para la afirmación1*descripción2 (puede no existir, si no existe no poner nada)\"][/statement-option-match]",
+        "sample": "[statement-option-match statements=\"a*La leche es|b*El cielo es|c*La hierba es\" options=\"b*azul*El mismo color que el mar|c*verde*|a*blanca*\"][/statement-option-match]",
+        "nota": "Poner la misma etiqueta (números o letras) tanto en los statements como en las options. En las options las etiquetas indican la respuesta correcta para la opción. En las options, si no hay descripción mantener los dos asteriscos.",
+        "tipo_ediblocks": "statement-option-match"
     },
     {
         "name": "writing",
         "label": "Producción de texto",
-        "sample": "[writing maxtime=\"0\"][/writing]"
+        "uso": "Producción libre de texto escrito",
+        "formato": "[writing maxtime=\"0\"][/writing]",
+        "sample": "[writing maxtime=\"0\"][/writing]",
+        "tipo_ediblocks": "writing"
     },
     {
         "name": "oral-expression",
         "label": "Expresión Oral",
-        "sample": "[oral-expression autoplay=\"false\" maxtime=\"0\" maxplays=\"0\" recordmode=\"audio\"][/oral-expression]"
+        "uso": "Producción oral de respuestas",
+        "formato": "[oral-expression autoplay=\"false\" maxtime=\"0\" maxplays=\"0\" recordmode=\"audio\"][/oral-expression]",
+        "sample": "[oral-expression autoplay=\"false\" maxtime=\"0\" maxplays=\"0\" recordmode=\"audio\"][/oral-expression]",
+        "tipo_ediblocks": "oral-expression"
     },
     {
         "name": "file-upload",
         "label": "Subir archivo",
-        "sample": "[file-upload extensions=\"pdf|doc|docx\"][/file-upload]"
+        "uso": "Subir archivos como respuesta",
+        "formato": "[file-upload extensions=\"pdf|doc|docx\"][/file-upload]",
+        "sample": "[file-upload extensions=\"pdf|doc|docx\"][/file-upload]",
+        "tipo_ediblocks": "file-upload"
     },
     {
         "name": "image-choice",
         "label": "Selección de imagen",
-        "sample": "[image-choice images=\"https://url-a-imagen-de-gato.com/gato.jpg*texto alternativo gato|https://url-a-imagen-de-perro.com/perro.jpg*texto alternativo perro\" correctOptionIndex=\"1\"][/image-choice]"
+        "uso": "Preguntas con opciones de selección de imágenes",
+        "formato": "[image-choice images=\"url_imagen1*texto_alternativo1|url_imagen2*texto_alternativo2\" correctOptionIndex=\"índice_opción_correcta\"][/image-choice]",
+        "sample": "[image-choice images=\"https://url-a-imagen-de-gato.com/gato.jpg*texto alternativo gato|https://url-a-imagen-de-perro.com/perro.jpg*texto alternativo perro\" correctOptionIndex=\"1\"][/image-choice]",
+        "tipo_ediblocks": "image-choice"
     },
     {
         "name": "multi-question",
         "label": "Multipregunta",
-        "sample": "[multi-question questions=\"\"][/multi-question]"
+        "uso": "Agrupar varias preguntas en un solo bloque",
+        "formato": "[multi-question questions=\"\"][/multi-question]",
+        "sample": "[multi-question questions=\"\"][/multi-question]",
+        "tipo_ediblocks": "multi-question"
+    },
+    {
+        "name": "abnone-choice",
+        "label": "Elige A o B o Ninguno",
+        "uso": "Preguntas con opciones A, B, Ninguna de las anteriores",
+        "formato": "[abnone-choice titlea=\"Título A\" texta=\"Texto A\" titleb=\"Título B\" textb=\"Texto B\" questions=\"a*Pregunta A|b*Pregunta B|c*Pregunta C\"][/abnone-choice]",
+        "sample": "[abnone-choice titlea=\"Lorem\" texta=\"Lorem ipsum Lorem ipsum\" titleb=\"Ipsum\" textb=\"Lorem\" questions=\"a*¿Lorem ipsum?|b*¿Ipsum lorem?|c*¿Dolor sit?\"][/abnone-choice]",
+        "tipo_ediblocks": "abnone-choice"
     }
 ]
 
 # Inicializar variables de sesión si no existen
-if 'conversation_history' not in st.session_state:
-    st.session_state.conversation_history = []
-if 'shortcode_versions' not in st.session_state:
-    st.session_state.shortcode_versions = {}
 if 'current_image_url' not in st.session_state:
     st.session_state.current_image_url = None
 if 'current_text_content' not in st.session_state:
@@ -101,8 +240,12 @@ if 'prompt_personalizado' not in st.session_state:
     st.session_state.prompt_personalizado = ""
 if 'input_type' not in st.session_state:
     st.session_state.input_type = "image_url"
-if 'resultado' not in st.session_state:
-    st.session_state.resultado = None
+if 'resultado_activo' not in st.session_state:
+    st.session_state.resultado_activo = None  # Huella del resultado activo (el resultado se lee del almacén)
+if 'resultados_lote' not in st.session_state:
+    st.session_state.resultados_lote = None
+if 'auditoria_catalogo' not in st.session_state:
+    st.session_state.auditoria_catalogo = None
 
 # ============================================================================
 # NUEVAS VARIABLES DE SESIÓN PARA EDIBLOCKS (IMPLEMENTACIÓN BÁSICA)
@@ -115,8 +258,119 @@ if 'ediblocks_config' not in st.session_state:
     }
 if 'available_tags' not in st.session_state:
     st.session_state.available_tags = []
-if 'publication_history' not in st.session_state:
-    st.session_state.publication_history = []
+# ============================================================================
+# POLÍTICA DE REINTENTOS PARA LLAMADAS HTTP
+# ============================================================================
+
+class PoliticaReintentos:
+    """Reintentos con backoff exponencial acotado, jitter y respeto de retry-after"""
+
+    # Errores transitorios: la misma petición puede funcionar más tarde
+    ESTADOS_REINTENTABLES = {408, 409, 429, 500, 502, 503, 504, 529}
+    # Estados en los que el servidor no ha procesado la petición (seguros también para POST)
+    ESTADOS_NO_PROCESADOS = {429, 529}
+
+    def __init__(self, max_reintentos: int = REINTENTOS_MAXIMOS,
+                 espera_base: float = REINTENTOS_ESPERA_BASE,
+                 espera_maxima: float = REINTENTOS_ESPERA_MAXIMA):
+        self.max_reintentos = max_reintentos
+        self.espera_base = espera_base
+        self.espera_maxima = espera_maxima
+        self._lock = threading.Lock()
+        self.metricas = {"peticiones": 0, "reintentos": 0, "segundos_espera": 0.0, "agotados": 0}
+
+    def es_reintentable(self, status_code: int, idempotente: bool = True) -> bool:
+        """Clasificar un código de estado como reintentable o definitivo"""
+        if idempotente:
+            return status_code in self.ESTADOS_REINTENTABLES
+        return status_code in self.ESTADOS_NO_PROCESADOS
+
+    def calcular_espera(self, intento: int, response: Optional[requests.Response] = None) -> float:
+        """Usar retry-after si el servidor lo indica; si no, backoff exponencial con jitter completo"""
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            try:
+                espera = float(retry_after)
+            except ValueError:
+                try:
+                    espera = parsedate_to_datetime(retry_after).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    espera = None
+            if espera is not None:
+                return min(max(espera, 0.0), self.espera_maxima)
+        return random.uniform(0, min(self.espera_maxima, self.espera_base * 2 ** intento))
+
+    def ejecutar(self, enviar: Callable[[], requests.Response], idempotente: bool = True) -> requests.Response:
+        """Ejecutar la petición reintentando los errores transitorios; devuelve la última respuesta"""
+        intento = 0
+        while True:
+            try:
+                response = enviar()
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                # Sin respuesta no se sabe si un POST llegó a procesarse
+                if not idempotente or intento >= self.max_reintentos:
+                    self.registrar_peticion(agotado=idempotente)
+                    raise
+                espera = self.calcular_espera(intento)
+            else:
+                if not self.es_reintentable(response.status_code, idempotente):
+                    self.registrar_peticion()
+                    return response
+                if intento >= self.max_reintentos:
+                    self.registrar_peticion(agotado=True)
+                    return response
+                espera = self.calcular_espera(intento, response)
+                response.close()
+            
+            with self._lock:
+                self.metricas["reintentos"] += 1
+                self.metricas["segundos_espera"] += espera
+            time.sleep(espera)
+            intento += 1
+
+    def registrar_peticion(self, agotado: bool = False):
+        with self._lock:
+            self.metricas["peticiones"] += 1
+            if agotado:
+                self.metricas["agotados"] += 1
+
+    def registrar_reintento(self, espera: float):
+        """Anotar un reintento hecho fuera de ejecutar (por ejemplo, por el adaptador HTTP)"""
+        with self._lock:
+            self.metricas["reintentos"] += 1
+            self.metricas["segundos_espera"] += espera
+
+    def resumen(self) -> Dict[str, float]:
+        """Copia de las métricas de reintentos"""
+        with self._lock:
+            return dict(self.metricas)
+
+@st.cache_resource
+def obtener_reintentos_ediblocks() -> PoliticaReintentos:
+    """Política de reintentos compartida para la API de EdiBlocks"""
+    return PoliticaReintentos()
+
+class ReintentosAdaptador(Retry):
+    """Reintentos de urllib3 para los verbos idempotentes; anota cada espera en las métricas de EdiBlocks"""
+
+    def sleep(self, response=None):
+        inicio = time.monotonic()
+        super().sleep(response)
+        obtener_reintentos_ediblocks().registrar_reintento(time.monotonic() - inicio)
+
+def crear_reintentos_adaptador() -> ReintentosAdaptador:
+    """Misma política que PoliticaReintentos (estados, backoff con jitter y retry-after), sin reintentar POST"""
+    return ReintentosAdaptador(
+        total=REINTENTOS_MAXIMOS,
+        allowed_methods=frozenset({'GET', 'HEAD', 'PUT', 'DELETE'}),
+        status_forcelist=PoliticaReintentos.ESTADOS_REINTENTABLES,
+        backoff_factor=REINTENTOS_ESPERA_BASE,
+        backoff_max=REINTENTOS_ESPERA_MAXIMA,
+        backoff_jitter=REINTENTOS_ESPERA_BASE,
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+
 # ============================================================================
 # CLASE EDIBLOCKS API (IMPLEMENTACIÓN BÁSICA)
 # ============================================================================
@@ -124,61 +378,79 @@ if 'publication_history' not in st.session_state:
 class EdiBlocksAPI:
     """Clase básica para manejar las operaciones con la API de EdiBlocks"""
     
-    def __init__(self, base_url: str, api_key: str = None):
+    def __init__(self, base_url: str, api_key: str = None, pool_size: int = EDIBLOCKS_POOL_SIZE,
+                 timeout=EDIBLOCKS_TIMEOUT):
         self.base_url = base_url
         self.api_key = api_key
-    
-    def get_headers(self, force_auth: bool = False) -> Dict[str, str]:
-        """Obtener headers para las peticiones HTTP"""
-        headers = {
+        self.timeout = timeout
+        self.session = requests.Session()
+        
+        # Pool keep-alive (sin handshake por llamada) y reintentos de los verbos idempotentes en el
+        # adaptador; los POST se reintentan aparte y solo si el servidor no llegó a procesarlos
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=crear_reintentos_adaptador())
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        
+        # Cabeceras construidas una sola vez; con API key todas las peticiones van autenticadas
+        self.session.headers.update({
             'Content-Type': 'application/json',
             'Accept': 'application/json'
-        }
-        
-        # Para operaciones de escritura, siempre intentar autenticación si hay API key
-        if force_auth or (self.api_key and self.api_key.strip()):
-            api_key_clean = self.api_key.strip()
-            headers['Authorization'] = f'Bearer {api_key_clean}'
+        })
+        if self.api_key and self.api_key.strip():
+            self.session.headers['Authorization'] = f'Bearer {self.api_key.strip()}'
         
-        return headers
+        # Si el servidor admite añadir o actualizar preguntas sin reenviar el grupo (se averigua en el primer uso)
+        self.endpoint_preguntas: Optional[bool] = None
+        self.endpoint_actualizar_pregunta: Optional[bool] = None
     
-    def request(self, endpoint: str, method: str = 'GET', data: Dict = None) -> Optional[Dict]:
-        """Realizar petición HTTP a la API"""
+    def enviar(self, endpoint: str, method: str = 'GET', data: Dict = None) -> requests.Response:
+        """Enviar la petición HTTP y devolver la respuesta sin interpretarla"""
         url = f"{self.base_url}{endpoint}"
+        reintentos = obtener_reintentos_ediblocks()
         
-        # Para operaciones de escritura, forzar autenticación
-        force_auth = method in ['POST', 'PUT', 'DELETE']
+        if method not in ['GET', 'POST', 'PUT']:
+            raise ValueError(f"Método HTTP no soportado: {method}")
+        
+        enviar = lambda: self.session.request(method, url, json=data, timeout=self.timeout)
+        if method == 'POST':
+            # Reintentar el POST solo cuando el servidor no lo llegó a procesar (429/529)
+            return reintentos.ejecutar(enviar, idempotente=False)
         
         try:
-            if method == 'GET':
-                response = requests.get(url, headers=self.get_headers(), timeout=30)
-            elif method == 'POST':
-                response = requests.post(url, headers=self.get_headers(force_auth=True), 
-                                       json=data, timeout=30)
-            elif method == 'PUT':
-                response = requests.put(url, headers=self.get_headers(force_auth=True), 
-                                      json=data, timeout=30)
-            else:
-                raise ValueError(f"Método HTTP no soportado: {method}")
+            response = enviar()
+        except requests.exceptions.RequestException:
+            reintentos.registrar_peticion(agotado=True)
+            raise
+        reintentos.registrar_peticion(agotado=reintentos.es_reintentable(response.status_code))
+        return response
+    
+    @staticmethod
+    def mostrar_error_respuesta(response: requests.Response):
+        """Mostrar el error de una respuesta de EdiBlocks que no es 200/201"""
+        st.error(f"❌ **Error en API EdiBlocks:** {response.status_code}")
+        try:
+            error_detail = response.json()
+            st.error(f"📄 **Detalle:** {error_detail}")
+        except:
+            st.error(f"📄 **Respuesta:** {response.text}")
+        
+        # Mensajes específicos para códigos de error comunes
+        if response.status_code == 401:
+            st.warning("🔐 **Autenticación requerida**: Esta operación necesita una API Key válida.")
+        elif response.status_code == 403:
+            st.warning("🚫 **Sin permisos**: Tu API Key no tiene permisos para esta operación.")
+        elif response.status_code == 404:
+            st.warning("🔍 **No encontrado**: El endpoint o recurso no existe.")
+    
+    def request(self, endpoint: str, method: str = 'GET', data: Dict = None) -> Optional[Dict]:
+        """Realizar petición HTTP a la API"""
+        try:
+            response = self.enviar(endpoint, method, data)
             
             if response.status_code in [200, 201]:
                 return response.json()
             else:
-                st.error(f"❌ **Error en API EdiBlocks:** {response.status_code}")
-                try:
-                    error_detail = response.json()
-                    st.error(f"📄 **Detalle:** {error_detail}")
-                except:
-                    st.error(f"📄 **Respuesta:** {response.text}")
-                
-                # Mensajes específicos para códigos de error comunes
-                if response.status_code == 401:
-                    st.warning("🔐 **Autenticación requerida**: Esta operación necesita una API Key válida.")
-                elif response.status_code == 403:
-                    st.warning("🚫 **Sin permisos**: Tu API Key no tiene permisos para esta operación.")
-                elif response.status_code == 404:
-                    st.warning("🔍 **No encontrado**: El endpoint o recurso no existe.")
-                
+                self.mostrar_error_respuesta(response)
                 return None
                 
         except requests.exceptions.Timeout:
@@ -191,6 +463,11 @@ class EdiBlocksAPI:
             st.error(f"💥 **Error inesperado:** {str(e)}")
             return None
 
+@st.cache_resource(max_entries=16)
+def obtener_api_ediblocks(base_url: str, api_key: str = None) -> EdiBlocksAPI:
+    """Cliente de EdiBlocks compartido por todas las sesiones con la misma URL base y API key"""
+    return EdiBlocksAPI(base_url, api_key)
+
 # ============================================================================
 # FUNCIONES AUXILIARES PARA EDIBLOCKS
 # ============================================================================
@@ -207,46 +484,27 @@ def generate_internal_name(name: str) -> str:
     """Generar nombre interno válido"""
     return re.sub(r'[^a-z0-9-]', '', name.lower().replace(' ', '-'))[:50]
 
+# Tipo de pregunta de EdiBlocks para cada etiqueta de shortcode del registro de tipologías
+TIPOS_EDIBLOCKS = {tipologia["name"]: tipologia["tipo_ediblocks"] for tipologia in TIPOLOGIAS}
+PATRON_ETIQUETA_APERTURA = re.compile(r'\s*\[([\w-]+)')
+
 def detect_question_type(shortcode: str) -> str:
-    """Detectar tipo de pregunta desde shortcode"""
+    """Detectar tipo de pregunta desde la etiqueta de apertura del shortcode"""
     
     if not shortcode or not shortcode.strip():
         return 'text'
     
-    detected_type = 'text'  # valor por defecto
-    
-    if '[multiple-choice' in shortcode:
-        detected_type = 'multiple-choice'
-    elif '[fill-in-the-blanks' in shortcode:
-        detected_type = 'fill-in-the-blanks'
-    elif '[single-choice' in shortcode:
-        detected_type = 'single-choice'
-    elif '[drag-words' in shortcode:
-        detected_type = 'drag-words'
-    elif '[statement-option-match' in shortcode:
-        detected_type = 'statement-option-match'
-    elif '[writing' in shortcode:
-        detected_type = 'writing'
-    elif '[oral-expression' in shortcode:
-        detected_type = 'oral-expression'
-    elif '[file-upload' in shortcode:
-        detected_type = 'file-upload'
-    elif '[image-choice' in shortcode:
-        detected_type = 'image-choice'
-    elif '[abnone-choice' in shortcode:
-        detected_type = 'abnone-choice'
-    elif '[multi-question' in shortcode:
-        detected_type = 'multi-question'
-    
-    return detected_type
+    match = PATRON_ETIQUETA_APERTURA.match(shortcode)
+    return TIPOS_EDIBLOCKS.get(match.group(1), 'text') if match else 'text'
 
 def test_connection_simple(base_url: str, api_key: str = None) -> bool:
     """Test de conexión simple basado en los archivos PHP"""
     
+    api = obtener_api_ediblocks(base_url, api_key)
+    
     # Test 1: GET tags
     try:
-        headers = {'Accept': 'application/json'}
-        response = requests.get(f"{base_url}/api/tags", headers=headers, timeout=10)
+        response = api.session.get(f"{base_url}/api/tags", timeout=api.timeout)
         
         if response.status_code == 200:
             try:
@@ -262,9 +520,7 @@ def test_connection_simple(base_url: str, api_key: str = None) -> bool:
     
     # Test 2: GET questiongroups
     try:
-        headers = {'Accept': 'application/json'}
-        response = requests.get(f"{base_url}/api/questiongroups?limit=1", 
-                              headers=headers, timeout=10)
+        response = api.session.get(f"{base_url}/api/questiongroups?limit=1", timeout=api.timeout)
         
         if response.status_code == 200:
             try:
@@ -361,41 +617,371 @@ def get_available_tags(api: EdiBlocksAPI) -> List[Dict]:
             {"id": 1, "name": "Habilidad", "parent_id": None}
         ]
 # ============================================================================
-# FUNCIONES DE PUBLICACIÓN EN EDIBLOCKS
+# ANÁLISIS Y VALIDACIÓN DE SHORTCODES
 # ============================================================================
 
-def create_question_group(api: EdiBlocksAPI, task_data: Dict) -> Optional[Dict]:
-    """Crear un nuevo grupo de preguntas en EdiBlocks"""
-    payload = {
-        "id": None,
-        "name": format_multilang_text(task_data['name']),
-        "questions": [],
-        "type": task_data.get('type', 'sequence'),
-        "status": "active",
-        "instructions": format_multilang_text(task_data.get('instructions', '')),
-        "projects": [],
-        "item_grades": "",
-        "internal_name": generate_internal_name(task_data['name']),
-        "tags": task_data.get('tags', [])
+class ErrorShortcode(ValueError):
+    """Error de sintaxis al analizar un shortcode"""
+
+    def __init__(self, mensaje: str, posicion: int):
+        super().__init__(f"{mensaje} (posición {posicion})")
+        self.posicion = posicion
+
+PATRON_NOMBRE_SHORTCODE = re.compile(r'[A-Za-z][\w-]*')
+PATRON_HUECO = re.compile(r'\[([\w-]+)\|([^\[\]]*)\]')
+TIPOS_HUECO = ("text", "short-text", "select", "radio")
+TIPOS_SHORTCODE = {tipologia["name"] for tipologia in TIPOLOGIAS}
+
+# Atributos con listas separadas por | y número de campos separados por * en cada elemento
+ESQUEMAS_SHORTCODE = {
+    "drag-words": {"obligatorios": ("words", "sentence", "markers"), "listas": {"words": 1, "markers": 1}},
+    "multiple-choice": {"obligatorios": ("options", "correctOptions"), "listas": {"options": 1, "correctOptions": 1}},
+    "single-choice": {"obligatorios": ("options", "correctOption"), "listas": {"options": 1}},
+    "abnone-choice": {
+        "obligatorios": ("titlea", "texta", "titleb", "textb", "questions"), "listas": {"questions": 2}
+    },
+    "statement-option-match": {"obligatorios": ("statements", "options"), "listas": {"statements": 2, "options": 3}},
+    "fill-in-the-blanks": {"obligatorios": ("text",), "listas": {}},
+    "writing": {"obligatorios": (), "listas": {}},
+    "oral-expression": {"obligatorios": (), "listas": {}},
+    "file-upload": {"obligatorios": ("extensions",), "listas": {"extensions": 1}},
+    "image-choice": {"obligatorios": ("images", "correctOptionIndex"), "listas": {"images": 2}},
+    "multi-question": {"obligatorios": (), "listas": {}}
+}
+ESQUEMA_SIN_REGLAS = {"obligatorios": (), "listas": {}}
+
+def analizar_shortcode(shortcode: str) -> Dict:
+    """Convertir un shortcode en su representación tipada (etiqueta, atributos, listas y huecos)"""
+    texto = shortcode.strip()
+    if not texto.startswith("["):
+        raise ErrorShortcode("El shortcode debe empezar por '['", 0)
+    
+    match = PATRON_NOMBRE_SHORTCODE.match(texto, 1)
+    if not match:
+        raise ErrorShortcode("Falta el nombre del shortcode", 1)
+    etiqueta = match.group(0)
+    pos = match.end()
+    
+    # Atributos: nombre="valor" (los valores pueden contener corchetes, p. ej. los huecos)
+    atributos = {}
+    while True:
+        while pos < len(texto) and texto[pos].isspace():
+            pos += 1
+        if pos >= len(texto):
+            raise ErrorShortcode(f"Falta ']' al final de la etiqueta de apertura de '{etiqueta}'", pos)
+        if texto[pos] == "]":
+            pos += 1
+            break
+        
+        match = PATRON_NOMBRE_SHORTCODE.match(texto, pos)
+        if not match:
+            raise ErrorShortcode(f"Carácter inesperado {texto[pos]!r} en los atributos", pos)
+        nombre = match.group(0)
+        pos = match.end()
+        if not texto.startswith('="', pos):
+            raise ErrorShortcode(f"El atributo '{nombre}' debe tener la forma {nombre}=\"valor\"", pos)
+        
+        fin = texto.find('"', pos + 2)
+        if fin == -1:
+            raise ErrorShortcode(f"Falta la comilla de cierre del atributo '{nombre}'", pos)
+        if nombre in atributos:
+            raise ErrorShortcode(f"Atributo '{nombre}' repetido", match.start())
+        atributos[nombre] = texto[pos + 2:fin]
+        pos = fin + 1
+    
+    # Contenido y etiqueta de cierre
+    cierre = f"[/{etiqueta}]"
+    fin = texto.find(cierre, pos)
+    cerrado = fin != -1
+    if cerrado and texto[fin + len(cierre):].strip():
+        raise ErrorShortcode(f"Texto sobrante después de '{cierre}'", fin + len(cierre))
+    
+    esquema = ESQUEMAS_SHORTCODE.get(etiqueta, ESQUEMA_SIN_REGLAS)
+    listas = {
+        nombre: [elemento.split("*", campos - 1) for elemento in atributos[nombre].split("|")]
+        for nombre, campos in esquema["listas"].items()
+        if nombre in atributos
     }
     
-    return api.request('/api/questiongroups', 'POST', payload)
+    huecos = []
+    if etiqueta == "fill-in-the-blanks":
+        for match in PATRON_HUECO.finditer(atributos.get("text", "")):
+            opciones = match.group(2).split("#")
+            huecos.append({
+                "tipo": match.group(1),
+                "opciones": [opcion.lstrip("*") for opcion in opciones],
+                "correctas": [i for i, opcion in enumerate(opciones) if opcion.startswith("*")]
+            })
+    
+    return {
+        "etiqueta": etiqueta,
+        "atributos": atributos,
+        "contenido": texto[pos:fin] if cerrado else texto[pos:],
+        "cerrado": cerrado,
+        "listas": listas,
+        "huecos": huecos
+    }
 
-def add_questions_to_group(api: EdiBlocksAPI, group_id: int, questions: List[Dict]) -> Optional[Dict]:
-    """Añadir preguntas a un grupo existente"""
+def validar_shortcode(shortcode: str) -> List[str]:
+    """Comprobar localmente un shortcode y devolver la lista de problemas encontrados"""
+    if not shortcode or not shortcode.strip():
+        return ["El shortcode está vacío"]
     
-    # Primero obtener el grupo actual
-    current_group_response = api.request(f'/api/questiongroups/{group_id}')
-    if not current_group_response:
+    try:
+        nodo = analizar_shortcode(shortcode)
+    except ErrorShortcode as e:
+        return [str(e)]
+    
+    etiqueta = nodo["etiqueta"]
+    if etiqueta not in TIPOS_SHORTCODE:
+        return [f"Tipo de shortcode desconocido: '{etiqueta}'"]
+    
+    problemas = []
+    if not nodo["cerrado"]:
+        problemas.append(f"Falta la etiqueta de cierre [/{etiqueta}]")
+    
+    esquema = ESQUEMAS_SHORTCODE.get(etiqueta, ESQUEMA_SIN_REGLAS)
+    atributos = nodo["atributos"]
+    faltan = [nombre for nombre in esquema["obligatorios"] if not atributos.get(nombre, "").strip()]
+    for nombre in faltan:
+        problemas.append(f"Falta el atributo obligatorio '{nombre}'")
+    
+    errores_lista = []
+    for nombre, elementos in nodo["listas"].items():
+        campos = esquema["listas"][nombre]
+        for i, elemento in enumerate(elementos, 1):
+            if not elemento[0].strip():
+                errores_lista.append(f"El elemento {i} de '{nombre}' está vacío")
+            elif len(elemento) < campos:
+                errores_lista.append(f"El elemento {i} de '{nombre}' debe tener {campos} campos separados por '*'")
+    problemas.extend(errores_lista)
+    
+    # Las reglas específicas del tipo solo se aplican si la estructura básica es correcta
+    validador = VALIDADORES_SHORTCODE.get(etiqueta)
+    if validador and not faltan and not errores_lista:
+        problemas.extend(validador(nodo))
+    
+    return problemas
+
+def valores_lista(nodo: Dict, nombre: str) -> List[str]:
+    """Primer campo de cada elemento de una lista de atributos"""
+    return [elemento[0].strip() for elemento in nodo["listas"].get(nombre, [])]
+
+def validar_drag_words(nodo: Dict) -> List[str]:
+    problemas = []
+    palabras = valores_lista(nodo, "words")
+    marcadores = valores_lista(nodo, "markers")
+    for marcador in marcadores:
+        if marcador not in palabras:
+            problemas.append(f"El marcador '{marcador}' no está entre las palabras (words)")
+    
+    huecos = nodo["atributos"]["sentence"].count("[]")
+    if huecos != len(marcadores):
+        problemas.append(f"La frase tiene {huecos} huecos [] pero hay {len(marcadores)} marcadores")
+    return problemas
+
+def validar_opciones(opciones: List[str]) -> List[str]:
+    problemas = []
+    if len(opciones) < 2:
+        problemas.append("Debe haber al menos dos opciones")
+    repetidas = sorted({opcion for opcion in opciones if opciones.count(opcion) > 1})
+    if repetidas:
+        problemas.append(f"Opciones repetidas: {', '.join(repetidas)}")
+    return problemas
+
+def validar_single_choice(nodo: Dict) -> List[str]:
+    opciones = valores_lista(nodo, "options")
+    problemas = validar_opciones(opciones)
+    correcta = nodo["atributos"]["correctOption"].strip()
+    if correcta not in opciones:
+        problemas.append(f"La opción correcta '{correcta}' no está entre las opciones")
+    return problemas
+
+def validar_multiple_choice(nodo: Dict) -> List[str]:
+    opciones = valores_lista(nodo, "options")
+    problemas = validar_opciones(opciones)
+    for correcta in valores_lista(nodo, "correctOptions"):
+        if correcta not in opciones:
+            problemas.append(f"La opción correcta '{correcta}' no está entre las opciones")
+    return problemas
+
+def validar_abnone_choice(nodo: Dict) -> List[str]:
+    problemas = []
+    for i, etiqueta in enumerate(valores_lista(nodo, "questions"), 1):
+        if etiqueta.lower() not in ("a", "b", "c"):
+            problemas.append(f"La pregunta {i} debe empezar por a*, b* o c* (ninguno), no por '{etiqueta}*'")
+    return problemas
+
+def validar_statement_option_match(nodo: Dict) -> List[str]:
+    problemas = []
+    etiquetas = valores_lista(nodo, "statements")
+    repetidas = sorted({etiqueta for etiqueta in etiquetas if etiquetas.count(etiqueta) > 1})
+    if repetidas:
+        problemas.append(f"Etiquetas de afirmación repetidas: {', '.join(repetidas)}")
+    
+    etiquetas_opciones = valores_lista(nodo, "options")
+    for etiqueta in etiquetas_opciones:
+        if etiqueta not in etiquetas:
+            problemas.append(f"La opción con etiqueta '{etiqueta}' no corresponde a ninguna afirmación")
+    for etiqueta in etiquetas:
+        if etiqueta not in etiquetas_opciones:
+            problemas.append(f"La afirmación '{etiqueta}' no tiene ninguna opción asociada")
+    return problemas
+
+def validar_fill_in_the_blanks(nodo: Dict) -> List[str]:
+    if not nodo["huecos"]:
+        return ["El texto no contiene ningún hueco [text|...], [short-text|...], [select|...] o [radio|...]"]
+    
+    problemas = []
+    for i, hueco in enumerate(nodo["huecos"], 1):
+        if hueco["tipo"] not in TIPOS_HUECO:
+            problemas.append(f"Hueco {i}: tipo '{hueco['tipo']}' desconocido")
+        elif any(not opcion.strip() for opcion in hueco["opciones"]):
+            problemas.append(f"Hueco {i}: hay respuestas u opciones vacías")
+        elif hueco["tipo"] in ("select", "radio"):
+            if len(hueco["opciones"]) < 2:
+                problemas.append(f"Hueco {i}: un {hueco['tipo']} necesita al menos dos opciones separadas por '#'")
+            if len(hueco["correctas"]) != 1:
+                problemas.append(f"Hueco {i}: debe haber exactamente una opción correcta marcada con '*'")
+    return problemas
+
+def validar_image_choice(nodo: Dict) -> List[str]:
+    problemas = []
+    imagenes = valores_lista(nodo, "images")
+    for i, url in enumerate(imagenes, 1):
+        if not url.startswith(("http://", "https://")):
+            problemas.append(f"La imagen {i} no tiene una URL válida")
+    
+    indice = nodo["atributos"]["correctOptionIndex"].strip()
+    if not indice.isdigit() or int(indice) > len(imagenes):
+        problemas.append(f"correctOptionIndex '{indice}' no corresponde a ninguna de las {len(imagenes)} imágenes")
+    return problemas
+
+def validar_numericos(nodo: Dict) -> List[str]:
+    return [
+        f"El atributo '{nombre}' debe ser un número entero"
+        for nombre in ("maxtime", "maxplays")
+        if nombre in nodo["atributos"] and not nodo["atributos"][nombre].strip().isdigit()
+    ]
+
+VALIDADORES_SHORTCODE = {
+    "drag-words": validar_drag_words,
+    "multiple-choice": validar_multiple_choice,
+    "single-choice": validar_single_choice,
+    "abnone-choice": validar_abnone_choice,
+    "statement-option-match": validar_statement_option_match,
+    "fill-in-the-blanks": validar_fill_in_the_blanks,
+    "writing": validar_numericos,
+    "oral-expression": validar_numericos,
+    "image-choice": validar_image_choice
+}
+
+# Reparación automática de defectos mecánicos frecuentes (sin llamar a Claude)
+COMILLAS_TIPOGRAFICAS = "“”„‟″«»"
+PATRON_ATRIBUTO_COMILLAS_TIPOGRAFICAS = re.compile(
+    r'(\s[A-Za-z][\w-]*)=([' + COMILLAS_TIPOGRAFICAS + r'"])(.*?)([' + COMILLAS_TIPOGRAFICAS + r'"])(?=\s+[A-Za-z][\w-]*=|\s*\])',
+    re.DOTALL
+)
+PATRON_ATRIBUTOS_EN_HUECO = re.compile(
+    r'(\[(?:text|short-text|select|radio)\|[^\[\]"]*?)((?:\s+(?:casesensitive|specialcharssensitive)="[^"]*")+)\s*\]'
+)
+PATRON_ATRIBUTO_SIMPLE = re.compile(r'([A-Za-z][\w-]*)="([^"]*)"')
+PATRON_CIERRE_FINAL = re.compile(r'\[/([\w-]+)\]\s*$')
+
+def generar_shortcode(nodo: Dict) -> str:
+    """Volver a escribir un shortcode a partir de su representación tipada"""
+    atributos = "".join(f' {nombre}="{valor}"' for nombre, valor in nodo["atributos"].items())
+    return f'[{nodo["etiqueta"]}{atributos}]{nodo["contenido"]}[/{nodo["etiqueta"]}]'
+
+def reparar_comillas_tipograficas(shortcode: str) -> Optional[str]:
+    def sustituir(match):
+        if match.group(2) == '"' and match.group(4) == '"':
+            return match.group(0)
+        return f'{match.group(1)}="{match.group(3)}"'
+    
+    return PATRON_ATRIBUTO_COMILLAS_TIPOGRAFICAS.sub(sustituir, shortcode)
+
+def reparar_atributos_en_huecos(shortcode: str) -> Optional[str]:
+    movidos = {}
+    
+    def sustituir(match):
+        movidos.update(PATRON_ATRIBUTO_SIMPLE.findall(match.group(2)))
+        return match.group(1) + "]"
+    
+    reparado = PATRON_ATRIBUTOS_EN_HUECO.sub(sustituir, shortcode)
+    if not movidos:
         return None
     
-    # EXTRAER EL OBJETO QUESTIONGROUP SI ESTÁ ANIDADO
-    if 'questiongroup' in current_group_response:
-        current_group = current_group_response['questiongroup']
-    else:
-        current_group = current_group_response
+    # Los atributos extraídos de los huecos pasan a la etiqueta de apertura (sin pisar los existentes)
+    try:
+        nodo = analizar_shortcode(reparado)
+    except ErrorShortcode:
+        return None
+    for nombre, valor in movidos.items():
+        nodo["atributos"].setdefault(nombre, valor)
+    return generar_shortcode(nodo)
+
+def reparar_etiqueta_cierre(shortcode: str) -> Optional[str]:
+    try:
+        nodo = analizar_shortcode(shortcode)
+    except ErrorShortcode:
+        # Un cierre final con otro nombre deja texto sobrante: sustituirlo por el correcto
+        match = PATRON_NOMBRE_SHORTCODE.match(shortcode.strip(), 1)
+        cierre = PATRON_CIERRE_FINAL.search(shortcode)
+        if not match or not cierre or cierre.group(1) == match.group(0):
+            return None
+        return f"{shortcode[:cierre.start()]}[/{match.group(0)}]"
+    
+    if nodo["cerrado"]:
+        return None
+    # Un cierre con otro nombre al final del contenido se sustituye; si no hay, se añade
+    contenido = PATRON_CIERRE_FINAL.sub("", nodo["contenido"])
+    return generar_shortcode(dict(nodo, contenido=contenido))
+
+def reparar_marcas_correctas(shortcode: str) -> Optional[str]:
+    # [radio|Verdadero#Falso*] -> [radio|Verdadero#*Falso] cuando ninguna opción lleva el * delante
+    def sustituir(match):
+        opciones = match.group(2).split("#")
+        if any(opcion.startswith("*") for opcion in opciones):
+            return match.group(0)
+        opciones = [f"*{opcion[:-1]}" if opcion.endswith("*") else opcion for opcion in opciones]
+        return f"[{match.group(1)}|{'#'.join(opciones)}]"
     
-    # Formatear las preguntas nuevas
+    return re.sub(r'\[(select|radio)\|([^\[\]"]*)\]', sustituir, shortcode)
+
+REPARACIONES_SHORTCODE = [
+    (reparar_comillas_tipograficas, "comillas tipográficas sustituidas por comillas rectas en los atributos"),
+    (reparar_atributos_en_huecos, "atributos casesensitive/specialcharssensitive sacados de los huecos a la etiqueta"),
+    (reparar_etiqueta_cierre, "etiqueta de cierre añadida o corregida"),
+    (reparar_marcas_correctas, "marca * de opción correcta movida delante de la opción")
+]
+
+def reparar_shortcode(shortcode: str) -> Tuple[str, List[str]]:
+    """Aplicar las reparaciones automáticas y devolver (shortcode reparado, reparaciones aplicadas)"""
+    aplicadas = []
+    for reparacion, descripcion in REPARACIONES_SHORTCODE:
+        reparado = reparacion(shortcode)
+        if reparado and reparado != shortcode:
+            shortcode = reparado
+            aplicadas.append(descripcion)
+    return shortcode, aplicadas
+
+def problemas_shortcodes_resultado(resultado: Dict) -> Dict[str, List[str]]:
+    """Problemas de la versión actual del shortcode de cada actividad, por número de actividad"""
+    problemas = {}
+    almacen = obtener_almacen_versiones()
+    for actividad in resultado.get("actividades", []):
+        problemas_actividad = validar_shortcode(almacen.shortcode_actual(actividad))
+        if problemas_actividad:
+            problemas[actividad.get("numero")] = problemas_actividad
+    return problemas
+
+# ============================================================================
+# FUNCIONES DE PUBLICACIÓN EN EDIBLOCKS
+# ============================================================================
+
+def formatear_preguntas(questions: List[Dict]) -> List[Dict]:
+    """Formatear preguntas nuevas con la estructura que espera EdiBlocks"""
     formatted_questions = []
     for i, q in enumerate(questions):
         formatted_question = {
@@ -410,11 +996,33 @@ def add_questions_to_group(api: EdiBlocksAPI, group_id: int, questions: List[Dic
             "questions": q.get('subQuestions', [])
         }
         formatted_questions.append(formatted_question)
+    return formatted_questions
+
+def extraer_grupo(group_response: Dict) -> Dict:
+    """Extraer el objeto questiongroup si la respuesta lo trae anidado"""
+    if 'questiongroup' in group_response:
+        return group_response['questiongroup']
+    return group_response
+
+def create_question_group(api: EdiBlocksAPI, task_data: Dict, questions: Optional[List[Dict]] = None) -> Optional[Dict]:
+    """Crear un nuevo grupo de preguntas en EdiBlocks (opcionalmente ya con sus preguntas)"""
+    payload = {
+        "id": None,
+        "name": format_multilang_text(task_data['name']),
+        "questions": formatear_preguntas(questions or []),
+        "type": task_data.get('type', 'sequence'),
+        "status": "active",
+        "instructions": format_multilang_text(task_data.get('instructions', '')),
+        "projects": [],
+        "item_grades": "",
+        "internal_name": generate_internal_name(task_data['name']),
+        "tags": task_data.get('tags', [])
+    }
     
-    # COMBINAR con preguntas existentes
-    existing_questions = current_group.get('questions', [])
-    all_questions = existing_questions + formatted_questions
-    
+    return api.request('/api/questiongroups', 'POST', payload)
+
+def payload_grupo(current_group: Dict, questions: List[Dict]) -> Dict:
+    """Payload limpio para actualizar (PUT) un grupo con la lista completa de preguntas"""
     # CREAR PAYLOAD LIMPIO
     clean_payload = {
         "id": current_group.get('id'),
@@ -435,24 +1043,104 @@ def add_questions_to_group(api: EdiBlocksAPI, group_id: int, questions: List[Dic
         "audio_start_time": current_group.get('audio_start_time', 0),
         "prepare_time": current_group.get('prepare_time'),
         "elementor_state": current_group.get('elementor_state'),
-        "questions": all_questions,
+        "questions": questions,
         "tags": current_group.get('tags', [])
     }
     
     # Eliminar campos None para limpiar el payload
-    clean_payload = {k: v for k, v in clean_payload.items() if v is not None}
+    return {k: v for k, v in clean_payload.items() if v is not None}
+
+def anadir_lotes_por_endpoint(api: EdiBlocksAPI, group_id: int, lotes: List[List[Dict]],
+                              current_group: Optional[Dict] = None,
+                              al_avanzar: Optional[Callable[[int, int], None]] = None) -> Optional[Dict]:
+    """Enviar cada lote de preguntas a /questiongroups/{id}/questions, sin reenviar el grupo.
+    Si el endpoint resulta no existir, devuelve el grupo actual (o None) para seguir con el PUT"""
+    total = sum(len(lote) for lote in lotes)
+    enviadas = 0
+    creadas = []
+    for lote in lotes:
+        try:
+            response = api.enviar(f'/api/questiongroups/{group_id}/questions', 'POST', {"questions": lote})
+        except requests.exceptions.RequestException as e:
+            st.error(f"🌐 **Error de conexión:** {str(e)} ({enviadas} de {total} preguntas añadidas)")
+            return None
+        
+        # Primer uso: si el endpoint no existe se recuerda y se usa el PUT del grupo. Un 404 también
+        # llega si el grupo no existe: solo se descarta el endpoint si el grupo sí existe (si no se
+        # tiene ya, se pide una vez y se devuelve para que el PUT no lo vuelva a pedir)
+        if api.endpoint_preguntas is None and response.status_code in (404, 405):
+            if current_group is None and response.status_code == 404:
+                respuesta_grupo = api.request(f'/api/questiongroups/{group_id}')
+                current_group = extraer_grupo(respuesta_grupo) if respuesta_grupo else None
+            if response.status_code == 405 or current_group is not None:
+                api.endpoint_preguntas = False
+            return current_group
+        if response.status_code not in (200, 201):
+            api.mostrar_error_respuesta(response)
+            st.error(f"❌ {enviadas} de {total} preguntas añadidas antes del error")
+            return None
+        
+        api.endpoint_preguntas = True
+        creadas.extend(response.json().get('questions', lote))
+        enviadas += len(lote)
+        if al_avanzar:
+            al_avanzar(enviadas, total)
+    
+    return {'id': group_id, 'questions': creadas}
+
+def add_questions_to_group(api: EdiBlocksAPI, group_id: int, questions: List[Dict],
+                           current_group: Optional[Dict] = None,
+                           tamaño_lote: int = EDIBLOCKS_PREGUNTAS_POR_LOTE,
+                           al_avanzar: Optional[Callable[[int, int], None]] = None) -> Optional[Dict]:
+    """Añadir preguntas a un grupo existente en lotes acotados (current_group evita volver a pedirlo si ya se tiene)"""
+    
+    # Formatear las preguntas nuevas y repartirlas en lotes
+    formatted_questions = formatear_preguntas(questions)
+    lotes = [formatted_questions[i:i + tamaño_lote] for i in range(0, len(formatted_questions), tamaño_lote)]
+    
+    # Si EdiBlocks permite añadir preguntas sueltas, cada petición lleva solo su lote
+    if api.endpoint_preguntas is not False:
+        result = anadir_lotes_por_endpoint(api, group_id, lotes, current_group, al_avanzar)
+        if api.endpoint_preguntas is not False:
+            return result
+        current_group = result
     
-    # Realizar el UPDATE con payload limpio
-    result = api.request(f'/api/questiongroups/{group_id}', 'PUT', clean_payload)
+    # Si no, un PUT del grupo por lote (el PUT sustituye el grupo: lleva todas sus preguntas)
+    if current_group is None:
+        current_group_response = api.request(f'/api/questiongroups/{group_id}')
+        if not current_group_response:
+            return None
+        current_group = extraer_grupo(current_group_response)
+    
+    result = None
+    enviadas = 0
+    for lote in lotes:
+        result = api.request(
+            f'/api/questiongroups/{group_id}', 'PUT',
+            payload_grupo(current_group, current_group.get('questions', []) + lote)
+        )
+        if not result:
+            if enviadas:
+                st.error(f"❌ {enviadas} de {len(formatted_questions)} preguntas añadidas antes del error")
+            return None
+        
+        # Las preguntas enviadas vuelven con su id: el siguiente lote no las duplica
+        grupo_actualizado = extraer_grupo(result)
+        preguntas = grupo_actualizado.get('questions', current_group.get('questions', []) + lote)
+        current_group = {**current_group, **grupo_actualizado, 'questions': preguntas}
+        enviadas += len(lote)
+        if al_avanzar:
+            al_avanzar(enviadas, len(formatted_questions))
     
     return result
 
 def publish_to_ediblocks(task_name: str, instructions: str, resultado: Dict, 
-                        selected_tags: List[Dict], api_key: str) -> Dict:
-    """Función principal para publicar en EdiBlocks (implementación básica)"""
+                        selected_tags: List[Dict], api_key: str, group_id: Optional[int] = None,
+                        al_avanzar: Optional[Callable[[int, int], None]] = None) -> Dict:
+    """Función principal para publicar en EdiBlocks (con group_id, añade las preguntas a ese grupo)"""
     try:
         # Crear instancia de API
-        api = EdiBlocksAPI(EDIBLOCKS_BASE_URL, api_key)
+        api = obtener_api_ediblocks(EDIBLOCKS_BASE_URL, api_key)
         
         # Preparar datos de la tarea
         task_data = {
@@ -462,43 +1150,53 @@ def publish_to_ediblocks(task_name: str, instructions: str, resultado: Dict,
             'tags': selected_tags
         }
         
-        # Crear el grupo de preguntas
-        group_result = create_question_group(api, task_data)
-        if not group_result:
-            return {'success': False, 'error': 'No se pudo crear el grupo de preguntas'}
-        
-        group_id = group_result['id']
-        
         # Preparar las preguntas desde el resultado
-        questions = []
-        for actividad in resultado.get('actividades', []):
-            # Obtener la versión más reciente del shortcode
-            shortcode = actividad.get('shortcode', '')
-            actividad_key = f"actividad_{actividad.get('numero')}"
-            
-            if (actividad_key in st.session_state.shortcode_versions and 
-                st.session_state.shortcode_versions[actividad_key]):
-                versiones = st.session_state.shortcode_versions[actividad_key]
-                if versiones:
-                    shortcode = versiones[-1]["shortcode"]
-            
-            questions.append({
-                'name': f"Actividad {actividad.get('numero')}",
-                'statement': actividad.get('texto_original', ''),
-                'type': detect_question_type(shortcode),
-                'shortcode': shortcode,
-                'tags': []
-            })
+        questions = preguntas_desde_resultado(resultado)
+        
+        # Añadir a un grupo existente
+        if questions and group_id:
+            final_result = add_questions_to_group(api, group_id, questions, al_avanzar=al_avanzar)
+            if final_result:
+                return {
+                    'success': True,
+                    'group_id': group_id,
+                    'group': final_result,
+                    'questions_count': len(questions),
+                    'preguntas': registrar_preguntas_publicadas(questions, final_result)
+                }
+            return {'success': False, 'error': 'No se pudieron añadir las preguntas al grupo'}
         
-        # Añadir preguntas al grupo
+        # Crear el grupo enviando ya las preguntas: una sola petición si EdiBlocks las acepta
         if questions:
-            final_result = add_questions_to_group(api, group_id, questions)
+            group_result = create_question_group(api, task_data, questions)
+            if not group_result:
+                return {'success': False, 'error': 'No se pudo crear el grupo de preguntas'}
+            
+            group = extraer_grupo(group_result)
+            group_id = group['id']
+            recibidas = group.get('questions') or []
+            if len(recibidas) == len(questions):
+                final_result = group_result
+            else:
+                # El servidor ignoró (todas o parte de) las preguntas de la creación: añadir solo las
+                # que faltan, reutilizando el grupo devuelto sin volver a pedirlo, en un único lote
+                nombres = {p.get('name') for p in recibidas}
+                faltan = [q for q in questions if q['name'] not in nombres]
+                final_result = group_result
+                if faltan:
+                    final_result = add_questions_to_group(api, group_id, faltan, current_group=group,
+                                                          tamaño_lote=len(faltan), al_avanzar=al_avanzar)
+                if final_result:
+                    # Preguntas del grupo en el orden de las actividades, para registrar sus ids
+                    por_nombre = {p.get('name'): p for p in recibidas + (extraer_grupo(final_result).get('questions') or [])}
+                    final_result = {**group, 'questions': [por_nombre.get(q['name'], {}) for q in questions]}
             if final_result:
                 return {
                     'success': True,
                     'group_id': group_id,
                     'group': final_result,
-                    'questions_count': len(questions)
+                    'questions_count': len(questions),
+                    'preguntas': registrar_preguntas_publicadas(questions, final_result)
                 }
             else:
                 return {'success': False, 'error': 'No se pudieron añadir las preguntas al grupo'}
@@ -508,6 +1206,150 @@ def publish_to_ediblocks(task_name: str, instructions: str, resultado: Dict,
     except Exception as e:
         return {'success': False, 'error': f'Error inesperado: {str(e)}'}
 
+def hash_pregunta(question: Dict) -> str:
+    """Huella del contenido publicado de una pregunta (enunciado, tipo y shortcode)"""
+    contenido = json.dumps(
+        [question.get('statement', ''), question.get('type', ''), question.get('shortcode', '')],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(contenido.encode('utf-8')).hexdigest()
+
+def huella_resultado(resultado: Dict) -> str:
+    """Identificador del resultado del que sale una publicación (su contenido original, sin refinar)"""
+    contenido = json.dumps(resultado, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(contenido.encode('utf-8')).hexdigest()
+
+def preguntas_desde_resultado(resultado: Dict) -> List[Dict]:
+    """Preguntas para EdiBlocks con la versión más reciente del shortcode de cada actividad"""
+    questions = []
+    almacen = obtener_almacen_versiones()
+    for actividad in resultado.get('actividades', []):
+        shortcode = almacen.shortcode_actual(actividad)
+        questions.append({
+            'numero': actividad.get('numero'),
+            'name': f"Actividad {actividad.get('numero')}",
+            'statement': actividad.get('texto_original', ''),
+            'type': detect_question_type(shortcode),
+            'shortcode': shortcode,
+            'tags': []
+        })
+    return questions
+
+def registrar_preguntas_publicadas(questions: List[Dict], group_result: Dict) -> List[Dict]:
+    """Número de actividad, id en EdiBlocks y huella de cada pregunta enviada (para sincronizar después)"""
+    # Las preguntas enviadas son las últimas del grupo devuelto, en el mismo orden
+    publicadas = extraer_grupo(group_result).get('questions') or []
+    if len(publicadas) < len(questions):
+        publicadas = [{}] * len(questions)
+    return [
+        {'numero': q['numero'], 'id': p.get('id'), 'hash': hash_pregunta(q)}
+        for q, p in zip(questions, publicadas[len(publicadas) - len(questions):])
+    ]
+
+def cambios_pendientes(publicacion: Dict, resultado: Dict) -> Tuple[List[Dict], List[Dict]]:
+    """Preguntas modificadas (con su id publicado) y nuevas respecto a lo registrado en una publicación"""
+    publicadas = {p['numero']: p for p in publicacion.get('preguntas', [])}
+    modificadas, nuevas = [], []
+    for q in preguntas_desde_resultado(resultado):
+        publicada = publicadas.get(q['numero'])
+        if publicada is None:
+            nuevas.append(q)
+        elif publicada['hash'] != hash_pregunta(q):
+            modificadas.append(dict(q, id=publicada['id']))
+    return modificadas, nuevas
+
+def actualizar_preguntas_sueltas(api: EdiBlocksAPI, modificadas: List[Dict]) -> Optional[bool]:
+    """Enviar cada pregunta modificada a /questions/{id} con solo sus campos; None si no hay endpoint"""
+    if api.endpoint_actualizar_pregunta is False or not all(q['id'] for q in modificadas):
+        return None
+    
+    for q in modificadas:
+        campos = {'statement': q['statement'], 'type': q['type'], 'shortcode': q['shortcode']}
+        response = api.enviar(f"/api/questions/{q['id']}", 'PUT', campos)
+        # 405: EdiBlocks no permite actualizar preguntas sueltas. 404: la pregunta ya no existe;
+        # en ambos casos se recurre al PUT del grupo, pero solo el 405 se recuerda
+        if response.status_code == 405 and api.endpoint_actualizar_pregunta is None:
+            api.endpoint_actualizar_pregunta = False
+            return None
+        if response.status_code == 404:
+            return None
+        if response.status_code not in (200, 201):
+            api.mostrar_error_respuesta(response)
+            return False
+        api.endpoint_actualizar_pregunta = True
+    return True
+
+def reenviar_grupo(api: EdiBlocksAPI, group_id: int, modificadas: List[Dict], nuevas: List[Dict]) -> Optional[Dict]:
+    """Un único PUT del grupo con las preguntas modificadas sustituidas y las nuevas añadidas al final"""
+    current_group_response = api.request(f'/api/questiongroups/{group_id}')
+    if not current_group_response:
+        return None
+    current_group = extraer_grupo(current_group_response)
+    
+    # Localizar cada pregunta del grupo por su id (o por su nombre si no se registró el id)
+    por_id = {q['id']: q for q in modificadas if q['id']}
+    por_nombre = {q['name']: q for q in modificadas}
+    preguntas = []
+    for pregunta in current_group.get('questions', []):
+        q = por_id.get(pregunta.get('id')) or por_nombre.get(pregunta.get('name'))
+        if q:
+            pregunta = dict(pregunta, statement=q['statement'], type=q['type'], shortcode=q['shortcode'])
+        preguntas.append(pregunta)
+    
+    return api.request(
+        f'/api/questiongroups/{group_id}', 'PUT',
+        payload_grupo(current_group, preguntas + formatear_preguntas(nuevas))
+    )
+
+def sincronizar_publicacion(publicacion: Dict, resultado: Dict, api_key: str) -> Dict:
+    """Llevar a un grupo ya publicado solo las preguntas cambiadas o nuevas desde la publicación"""
+    try:
+        # Las preguntas publicadas solo se corresponden con las actividades del mismo resultado
+        if publicacion.get('resultado') != huella_resultado(resultado):
+            return {'success': False, 'error': 'La publicación no procede del resultado activo'}
+        
+        api = obtener_api_ediblocks(EDIBLOCKS_BASE_URL, api_key)
+        group_id = publicacion['group_id']
+        modificadas, nuevas = cambios_pendientes(publicacion, resultado)
+        registro = {p['numero']: p for p in publicacion.get('preguntas', [])}
+        
+        enviadas_sueltas = actualizar_preguntas_sueltas(api, modificadas) if modificadas else True
+        if enviadas_sueltas is False:
+            return {'success': False, 'error': 'No se pudieron actualizar las preguntas modificadas'}
+        
+        if enviadas_sueltas is None:
+            # Sin endpoint por pregunta: modificadas y nuevas van en el mismo PUT del grupo
+            result = reenviar_grupo(api, group_id, modificadas, nuevas)
+            if not result:
+                return {'success': False, 'error': 'No se pudo actualizar el grupo'}
+        elif nuevas:
+            result = add_questions_to_group(api, group_id, nuevas)
+            if not result:
+                # Las modificadas ya se enviaron: se devuelven sus huellas para registrarlas
+                for q in modificadas:
+                    registro[q['numero']] = {'numero': q['numero'], 'id': q['id'], 'hash': hash_pregunta(q)}
+                return {
+                    'success': False,
+                    'error': 'No se pudieron añadir las preguntas nuevas al grupo',
+                    'preguntas': list(registro.values())
+                }
+        
+        for q in modificadas:
+            registro[q['numero']] = {'numero': q['numero'], 'id': q['id'], 'hash': hash_pregunta(q)}
+        if nuevas:
+            for pregunta in registrar_preguntas_publicadas(nuevas, result):
+                registro[pregunta['numero']] = pregunta
+        
+        return {
+            'success': True,
+            'actualizadas': len(modificadas),
+            'nuevas': len(nuevas),
+            'preguntas': list(registro.values())
+        }
+    
+    except Exception as e:
+        return {'success': False, 'error': f'Error inesperado: {str(e)}'}
+
 # ============================================================================
 # FUNCIONES DE INTERFAZ BÁSICA PARA EDIBLOCKS
 # ============================================================================
@@ -594,7 +1436,7 @@ def mostrar_configuracion_ediblocks_basica():
     
     with col3:
         if st.button("🏷️ Cargar tags"):
-            api = EdiBlocksAPI(new_base_url, new_api_key)
+            api = obtener_api_ediblocks(new_base_url, new_api_key)
             with st.spinner("Cargando tags..."):
                 st.session_state.available_tags = get_available_tags(api)
                 if st.session_state.available_tags:
@@ -602,10 +1444,46 @@ def mostrar_configuracion_ediblocks_basica():
                 else:
                     st.error("❌ No se pudieron cargar los tags")
 
+def mostrar_sincronizacion_publicacion(pub: Dict, resultado: Dict):
+    """Cambios pendientes de una publicación y botón para enviarlos al grupo"""
+    modificadas, nuevas = cambios_pendientes(pub, resultado)
+    if not modificadas and not nuevas:
+        st.caption("✅ Sin cambios respecto a lo publicado")
+        return
+    
+    st.write(f"**🔄 Cambios pendientes:** {len(modificadas)} preguntas modificadas, {len(nuevas)} nuevas")
+    if st.button("🔄 Sincronizar cambios", key=f"sync_{pub['registro']}"):
+        if not st.session_state.ediblocks_config['api_key']:
+            st.error("❌ Se requiere una API Key para sincronizar")
+            return
+        
+        with st.spinner("Sincronizando con EdiBlocks..."):
+            sync = sincronizar_publicacion(pub, resultado, st.session_state.ediblocks_config['api_key'])
+        
+        # Registrar las huellas de lo que se haya llegado a enviar
+        if 'preguntas' in sync:
+            obtener_almacen_proyectos().actualizar_publicacion(pub['registro'], dict(
+                pub,
+                preguntas=sync['preguntas'],
+                sincronizada=datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            ))
+        
+        if sync['success']:
+            agregar_a_historial(
+                "Publicación sincronizada con EdiBlocks",
+                f"ID: {pub['group_id']}\nActualizadas: {sync['actualizadas']}\nNuevas: {sync['nuevas']}"
+            )
+            st.toast(f"✅ Grupo {pub['group_id']} sincronizado: {sync['actualizadas']} actualizadas, {sync['nuevas']} nuevas")
+            st.rerun(scope="fragment")
+        else:
+            st.error(f"❌ Error al sincronizar: {sync['error']}")
+
+@st.fragment
 def mostrar_seccion_publicacion_basica():
-    """Sección básica de publicación en EdiBlocks"""
+    """Sección básica de publicación en EdiBlocks (fragmento: sus interacciones no recargan la página)"""
     
-    if not st.session_state.resultado:
+    resultado = obtener_resultado_activo()
+    if not resultado:
         st.info("ℹ️ Primero procesa una imagen o texto para poder publicar en EdiBlocks.")
         return
     
@@ -616,6 +1494,13 @@ def mostrar_seccion_publicacion_basica():
     
     st.markdown("---")
     
+    # Validar localmente los shortcodes antes de publicar
+    problemas_publicacion = problemas_shortcodes_resultado(resultado)
+    if problemas_publicacion:
+        st.warning(f"⚠️ {len(problemas_publicacion)} actividades tienen shortcodes con problemas:")
+        for numero, problemas in problemas_publicacion.items():
+            st.markdown(f"**Actividad {numero}:** " + "; ".join(problemas))
+    
     # Formulario de publicación
     with st.form("publish_form"):
         st.subheader("Configurar publicación")
@@ -630,20 +1515,38 @@ def mostrar_seccion_publicacion_basica():
         # Instrucciones
         task_instructions = st.text_area(
             "Instrucciones de la tarea",
-            value=st.session_state.resultado.get('enunciado', ''),
+            value=resultado.get('enunciado', ''),
             help="Instrucciones generales para los estudiantes"
         )
         
+        # Grupo de destino: uno nuevo o uno ya existente
+        existing_group_id = st.number_input(
+            "Añadir a un grupo existente (ID)",
+            min_value=0,
+            value=0,
+            help="Deja 0 para crear un grupo nuevo. Con un ID, las preguntas se añaden a ese grupo por lotes."
+        )
+        
         # Selección de tags
         st.subheader("🏷️ Etiquetas")
         selected_tag_names = mostrar_selector_tags_basico()
         
+        publicar_con_problemas = False
+        if problemas_publicacion:
+            publicar_con_problemas = st.checkbox(
+                "Publicar aunque haya shortcodes con problemas",
+                value=False,
+                help="EdiBlocks puede rechazar o mostrar mal las preguntas con shortcodes incorrectos"
+            )
+        
         # Botón de publicación
         submitted = st.form_submit_button("🚀 Publicar en EdiBlocks", type="primary")
         
         if submitted:
             if not task_name.strip():
                 st.error("❌ El nombre de la tarea es obligatorio")
+            elif problemas_publicacion and not publicar_con_problemas:
+                st.error("❌ Corrige los shortcodes con problemas o confirma que quieres publicarlos igualmente")
             elif not st.session_state.ediblocks_config['api_key']:
                 st.error("❌ Se requiere una API Key para publicar")
             else:
@@ -662,12 +1565,17 @@ def mostrar_seccion_publicacion_basica():
                 
                 # Publicar
                 with st.spinner("Publicando en EdiBlocks..."):
+                    barra_progreso = st.progress(0.0)
                     result = publish_to_ediblocks(
                         task_name,
                         task_instructions,
-                        st.session_state.resultado,
+                        resultado,
                         selected_tags,
-                        st.session_state.ediblocks_config['api_key']
+                        st.session_state.ediblocks_config['api_key'],
+                        group_id=int(existing_group_id) or None,
+                        al_avanzar=lambda enviadas, total: barra_progreso.progress(
+                            enviadas / total, text=f"{enviadas} de {total} preguntas enviadas"
+                        )
                     )
                     
                     if result['success']:
@@ -675,13 +1583,15 @@ def mostrar_seccion_publicacion_basica():
                         st.info(f"🆔 ID del grupo creado: {result['group_id']}")
                         st.info(f"📝 Preguntas publicadas: {result['questions_count']}")
                         
-                        # Agregar al historial
-                        st.session_state.publication_history.append({
+                        # Agregar al historial de publicaciones del proyecto
+                        obtener_almacen_proyectos().guardar_publicacion(obtener_proyecto_actual(crear=True), {
                             'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
                             'task_name': task_name,
                             'group_id': result['group_id'],
                             'questions_count': result['questions_count'],
-                            'tags': [tag['name'] for tag in selected_tags]
+                            'tags': [tag['name'] for tag in selected_tags],
+                            'resultado': st.session_state.resultado_activo,
+                            'preguntas': result['preguntas']
                         })
                         
                         # Agregar al historial general
@@ -694,11 +1604,14 @@ def mostrar_seccion_publicacion_basica():
                         st.error(f"❌ Error al publicar: {result['error']}")
     
     # Mostrar historial si existe
-    if st.session_state.publication_history:
+    proyecto = obtener_proyecto_actual()
+    publicaciones = obtener_almacen_proyectos().publicaciones(proyecto) if proyecto else []
+    if publicaciones:
         st.markdown("---")
         st.subheader("📋 Historial de publicaciones")
         
-        for pub in reversed(st.session_state.publication_history):
+        resultado_activo = st.session_state.resultado_activo
+        for pub in publicaciones:
             with st.expander(f"📅 {pub['timestamp']} - {pub['task_name']}"):
                 st.write(f"**🆔 ID del grupo:** {pub['group_id']}")
                 st.write(f"**📝 Preguntas publicadas:** {pub['questions_count']}")
@@ -708,298 +1621,464 @@ def mostrar_seccion_publicacion_basica():
                 # Enlace directo
                 ediblocks_url = f"{st.session_state.ediblocks_config['base_url']}/questiongroups/{pub['group_id']}"
                 st.markdown(f"[🔗 Ver en EdiBlocks]({ediblocks_url})")
+                
+                # Sincronización de los cambios hechos después de publicar (solo lo que ha cambiado),
+                # únicamente si la publicación salió del resultado que está abierto
+                if 'preguntas' in pub and pub.get('resultado') == resultado_activo:
+                    mostrar_sincronizacion_publicacion(pub, resultado)
+                elif 'preguntas' in pub:
+                    st.caption("ℹ️ Publicada desde otro resultado: ábrelo para sincronizar sus cambios")
 # ============================================================================
-# FUNCIONES ORIGINALES DE IMGTOSH (CONSERVADAS)
+# CLIENTE HTTP COMPARTIDO PARA LA API DE ANTHROPIC
 # ============================================================================
 
-# Función para analizar texto con prompt adaptado
-def analizar_texto_con_prompt(api_key, texto, prompt_personalizado=""):
-    url = "https://api.anthropic.com/v1/messages"
-    
-    # Usar exactamente los encabezados que funcionaron
-    headers = {
-        "x-api-key": api_key.strip(),  # Eliminar espacios al inicio/final
-        "anthropic-version": "2023-06-01",
-        "content-type": "application/json"
-    }
-    
-    # Prompt base detallado para Claude
-    instrucciones_base = """
-# Tarea: Extraer ejercicios educativos y convertirlos en shortcodes
+class MetricasAnthropic:
+    """Contadores de uso de la API compartidos por todas las sesiones"""
 
-Analiza detalladamente este texto de ejercicios educativos y extrae:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.valores = {
+            "llamadas": 0,
+            "input_tokens": 0,
+            "output_tokens": 0,
+            "cache_creation_input_tokens": 0,
+            "cache_read_input_tokens": 0,
+            "llamadas_con_cache_leida": 0,
+            "segundos_con_cache_leida": 0.0,
+            "llamadas_sin_cache_leida": 0,
+            "segundos_sin_cache_leida": 0.0,
+            "continuaciones": 0
+        }
 
-1. El enunciado principal que explica el objetivo general de los ejercicios
-2. Cada actividad o pregunta individual presente en el texto
+    def registrar(self, **incrementos):
+        """Sumar los incrementos indicados a los contadores"""
+        with self._lock:
+            for nombre, valor in incrementos.items():
+                self.valores[nombre] = self.valores.get(nombre, 0) + valor
 
-"""
+    def registrar_uso(self, usage: Optional[Dict], segundos: float):
+        """Registrar los tokens (incluidos los de caché de prompts) y la latencia de una llamada"""
+        usage = usage or {}
+        leidos = usage.get("cache_read_input_tokens") or 0
+        sufijo = "con_cache_leida" if leidos else "sin_cache_leida"
+        self.registrar(**{
+            "llamadas": 1,
+            "input_tokens": usage.get("input_tokens") or 0,
+            "output_tokens": usage.get("output_tokens") or 0,
+            "cache_creation_input_tokens": usage.get("cache_creation_input_tokens") or 0,
+            "cache_read_input_tokens": leidos,
+            f"llamadas_{sufijo}": 1,
+            f"segundos_{sufijo}": segundos
+        })
 
-    # Combinar prompt base con el prompt personalizado si existe
-    if prompt_personalizado and prompt_personalizado.strip():
-        instrucciones_completas = instrucciones_base + "\n\n## Instrucciones personalizadas adicionales\n\n" + prompt_personalizado
-    else:
-        instrucciones_completas = instrucciones_base
-    
-    # Añadir el texto de instrucciones sobre shortcodes y formato
-    instrucciones_completas += """
-## Tipos de shortcodes disponibles
+    def resumen(self) -> Dict[str, Any]:
+        """Copia de los contadores con la tasa de acierto y las latencias medias"""
+        with self._lock:
+            valores = dict(self.valores)
+        
+        total_entrada = (valores["input_tokens"] + valores["cache_creation_input_tokens"] +
+                         valores["cache_read_input_tokens"])
+        valores["tasa_acierto_cache"] = (
+            valores["cache_read_input_tokens"] / total_entrada if total_entrada else 0.0
+        )
+        for sufijo in ("con_cache_leida", "sin_cache_leida"):
+            llamadas = valores[f"llamadas_{sufijo}"]
+            valores[f"latencia_media_{sufijo}"] = (
+                valores[f"segundos_{sufijo}"] / llamadas if llamadas else 0.0
+            )
+        return valores
 
-Debes convertir cada actividad al formato de shortcode más apropiado según los siguientes tipos:
+class ErrorAnthropic(Exception):
+    """Error devuelto por la API de Anthropic"""
 
-### 1. drag-words
-- Usar para: Ejercicios donde hay que completar frases arrastrando palabras a huecos
-- Formato: [drag-words words="palabra1|palabra2|palabra3" sentence="Texto con [] para rellenar" markers="palabra_correcta1|palabra_correcta2"][/drag-words]
-- Ejemplo: [drag-words words="gato|perro|elefante|mono|rata" sentence="El [] es más grande que el [], pero el [] es el más [] pequeño." markers="elefante|perro|gato|mono"][/drag-words]
-
-### 2. multiple-choice
-- Usar para: Preguntas con MÚLTIPLES respuestas correctas posibles
-- Formato: [multiple-choice options="opción1|opción2|opción3" correctOptions="opciónCorrecta1|opciónCorrecta2"][/multiple-choice]
-- Ejemplo: [multiple-choice options="Lechuga|Manzana|Zanahoria|Plátano|Pera" correctOptions="Manzana|Plátano|Pera"][/multiple-choice]
-
-### 3. single-choice
-- Usar para: Preguntas con UNA SOLA respuesta correcta
-- Formato: [single-choice options="opción1|opción2|opción3" correctOption="opciónCorrecta"][/single-choice]
-- Ejemplo: [single-choice options="Rojo|Verde|Azul|Amarillo" correctOption="Azul"][/single-choice]
-
-### 4. fill-in-the-blanks
-- Usar para: Textos con espacios para rellenar (texto libre)
-- Formato: [fill-in-the-blanks text="Texto con [text|respuesta] para completar." casesensitive="false" specialcharssensitive="false"][/fill-in-the-blanks]
-- Ejemplo: [fill-in-the-blanks text="La capital de [text|España] es Madrid." casesensitive="false" specialcharssensitive="false"][/fill-in-the-blanks]
-- MUY IMPORTANTE: Si hay varias respuestas válidas se deben separar con el símbolo almohadilla (#).
-
-### 5. fill-in-the-blanks
-- Usar para: Elegir entre dos opciones
-- Formato: [fill-in-the-blanks text="Texto: [radio|Verdadero#*Falso]" casesensitive="false" specialcharssensitive="false"][/fill-in-the-blanks]
-- Ejemplo: [fill-in-the-blanks text="La leche es: [radio|*Blanca#Negra]" casesensitive="false" specialcharssensitive="false"][/fill-in-the-blanks]
-- MUY IMPORTANTE: El asterisco (*) indica la opción correcta. El símbolo | separa las opciones.
-
-### 6. fill-in-the-blanks
-- Usar para: Textos con espacios para seleccionar entre opciones (menú desplegable)
-- Formato: [fill-in-the-blanks text="Texto con [select|Incorrecta1#*Correcta#Incorrecta2] para seleccionar." casesensitive="false" specialcharssensitive="false"][/fill-in-the-blanks]
-- Ejemplo: [fill-in-the-blanks text="El animal más rápido es el [select|leopardo#*guepardo#león#tigre]." casesensitive="false" specialcharssensitive="false"][/fill-in-the-blanks]
-- MUY IMPORTANTE: El asterisco (*) indica la opción correcta. Debe haber solo una opción correcta por cada hueco. El símbolo # separa las opciones. SIEMPRE hay que poner la oción correcta.
-
-### 7. fill-in-the-blanks
-- Usar para: Introducir letras para completar una única palabra
-- Formato: [fill-in-the-blanks text="Texto [short-text|letra1][short-text|letra2][short-text|letra3]" casesensitive="false" specialcharssensitive="false"][/fill-in-the-blanks]
-- Ejemplo: [fill-in-the-blanks text="El caballo [text|blanco] de Santiago es de [short-text|c][short-text|o][short-text|l][short-text|o][short-text|r] blanco." casesensitive="false" specialcharssensitive="false"][/fill-in-the-blanks]
-
-### 8. statement-option-match
-- Usar para: Emparejar conceptos o frases con sus correspondientes opciones
-- Formato: [statement-option-match statements="a*afirmación1|b*afirmación2" options="b*respuesta correcta para la afirmación2*descripción1 (puede no existir, si no existe no poner nada)|a*respuesta correcta para la afirmación2*descripción2 (puede no existir, si no existe no poner nada)"][/statement-option-match]
-- Ejemplo: [statement-option-match statements="a*La leche es|b*El cielo es|c*La hierba es" options="b*azul*El  mismo color que el mar|b*verde*|a*blanca*"][/statement-option-match]
-- MUY IMPORTANTE: Poner la misma etiqueta (números o letras) tanto en los statments como en las options. En las options las etiquetas indican la respuesta correcta para la opción. En las options, si no hay descripción mantener los dos asteríscos.
-
-### 9. writing
-- Usar para: Producción libre de texto escrito
-- Formato: [writing maxtime="0"][/writing]
-- Ejemplo: [writing maxtime="0"][/writing]
-
-### 10. oral-expression
-- Usar para: Producción oral de respuestas
-- Formato: [oral-expression autoplay="false" maxtime="0" maxplays="0" recordmode="audio"][/oral-expression]
-- Ejemplo: [oral-expression autoplay="false" maxtime="0" maxplays="0" recordmode="audio"][/oral-expression]
-
-### 11. file-upload
-- Usar para: Subir archivos como respuesta
-- Formato: [file-upload extensions="pdf|doc|docx"][/file-upload]
-- Ejemplo: [file-upload extensions="pdf|doc|docx"][/file-upload]
-
-### 12. image-choice
-- Usar para: Preguntas con opciones de selección de imágenes
-- Formato: [image-choice images="url_imagen1*texto_alternativo1|url_imagen2*texto_alternativo2" correctOptionIndex="índice_opción_correcta"][/image-choice]
-- Ejemplo: [image-choice images="https://url-a-imagen-de-gato.com/gato.jpg*texto alternativo gato|https://url-a-imagen-de-perro.com/perro.jpg*texto alternativo perro" correctOptionIndex="1"][/image-choice]
-
-### 13. multi-question
-- Usar para: Agrupar varias preguntas en un solo bloque
-- Formato: [multi-question questions=""][/multi-question]
-- Ejemplo: [multi-question questions=""][/multi-question]
-
-### 14. abnone-choice
-- Usar para: Preguntas con opciones A, B, Ninguna de las anteriores
-- Formato: [abnone-choice titlea="Título A" texta="Texto A" titleb="Título B" textb="Texto B" questions="a*Pregunta A|b*Pregunta B|c*Pregunta C"][/abnone-choice]
-- Ejemplo: [abnone-choice titlea="Lorem" texta="Lorem ipsum Lorem ipsum" titleb="Ipsum" textb="Lorem" questions="a*¿Lorem ipsum?|b*¿Ipsum lorem?|c*¿Dolor sit?"]
+    def __init__(self, status_code: Optional[int], detalle: Any):
+        super().__init__(f"Código {status_code}: {detalle}")
+        self.status_code = status_code
+        self.detalle = detalle
 
-## Instrucciones IMPORTANTES
+class LimitadorAnthropic:
+    """Limitador token-bucket de peticiones y tokens por minuto con cola justa entre sesiones"""
 
-1. Analiza cuidadosamente el tipo de ejercicio antes de elegir el shortcode
-2. Usa EXACTAMENTE la misma estructura y símbolos separadores (|, *, #, etc.) que se muestran en los ejemplos
-3. Respeta el formato exacto de las comillas y corchetes
-4. Si un ejercicio no encaja exactamente en un tipo, elige el más cercano y adáptalo
-5. Si un ejercicio tiene múltiples partes que requieren diferentes tipos, trátalas como actividades separadas
-6. Si un ejercicio tiene múltiples partes intenta que vaya en un ÚNICO shortcode
-7. Los shortcodes tipo fill-the-blanks pueden usarse para agrupar en un único shortcode varios apartados distintos. Pueden ser del mismo tipo o de diferente tipo:
-   – Ejemplo: [fill-in-the-blanks text="La capital de [text|España] es Madrid. El caballo [text|blanco] de Santiago es de [short-text|c][short-text|o][short-text|l][short-text|o][short-text|r] blanco. El animal más rápido del mundo es el [select|leopardo#*guepardo#león#tigre]. Las afirmaciones anteriores son: [radio|Verdaderas#*Falsas]" casesensitive="false" specialcharssensitive="false"][/fill-in-the-blanks]
+    def __init__(self, rpm: int = ANTHROPIC_RPM, tpm: int = ANTHROPIC_TPM):
+        self.capacidad = {"peticiones": float(rpm), "tokens": float(tpm)}
+        self.disponible = dict(self.capacidad)
+        self.ultima_recarga = time.monotonic()
+        self._cond = threading.Condition()
+        self.colas = {}  # sesión -> deque de peticiones en espera (tokens estimados)
+        self.turnos = deque()  # sesiones con peticiones en espera, en orden round-robin
 
-## Formato de tu respuesta
+    def _recargar(self):
+        ahora = time.monotonic()
+        transcurrido = ahora - self.ultima_recarga
+        self.ultima_recarga = ahora
+        for recurso, capacidad in self.capacidad.items():
+            self.disponible[recurso] = min(capacidad, self.disponible[recurso] + capacidad * transcurrido / 60)
 
-Responde usando exactamente este formato:
+    def _espera_para(self, peticiones: float, tokens: float) -> float:
+        """Segundos hasta que ambos cubos tengan saldo suficiente"""
+        esperas = []
+        for recurso, necesario in (("peticiones", peticiones), ("tokens", tokens)):
+            falta = necesario - self.disponible[recurso]
+            esperas.append(falta * 60 / self.capacidad[recurso] if falta > 0 else 0.0)
+        return max(esperas)
 
-ENUNCIADO: (escribe aquí el enunciado principal identificado en el texto)
+    def adquirir(self, sesion: str, tokens: int):
+        """Bloquear hasta que la petición tenga turno y saldo en ambos cubos"""
+        tokens = min(tokens, self.capacidad["tokens"])
+        ticket = [tokens]  # Objeto único que identifica esta petición en la cola
+        
+        with self._cond:
+            self.colas.setdefault(sesion, deque()).append(ticket)
+            if sesion not in self.turnos:
+                self.turnos.append(sesion)
+            
+            while True:
+                if self.turnos[0] == sesion and self.colas[sesion][0] is ticket:
+                    self._recargar()
+                    espera = self._espera_para(1, tokens)
+                    if espera <= 0:
+                        break
+                    self._cond.wait(espera)
+                else:
+                    self._cond.wait(1.0)
+            
+            # Consumir saldo y ceder el turno a la siguiente sesión
+            self.disponible["peticiones"] -= 1
+            self.disponible["tokens"] -= tokens
+            self.colas[sesion].popleft()
+            self.turnos.popleft()
+            if self.colas[sesion]:
+                self.turnos.append(sesion)
+            else:
+                del self.colas[sesion]
+            self._cond.notify_all()
 
-ACTIVIDAD 1:
-- Texto original: (transcribe aquí el texto completo de la actividad como aparece en el texto)
-- Tipo de shortcode: (nombre exacto del tipo de shortcode más adecuado)
-- Shortcode generado: (escribe el shortcode completo siguiendo exactamente el formato del ejemplo)
+    def ajustar(self, tokens_estimados: int, tokens_reales: int):
+        """Corregir el cubo de tokens con el uso real devuelto por la API"""
+        with self._cond:
+            diferencia = min(tokens_estimados, self.capacidad["tokens"]) - tokens_reales
+            self.disponible["tokens"] = min(self.capacidad["tokens"], self.disponible["tokens"] + diferencia)
+            self._cond.notify_all()
 
-ACTIVIDAD 2:
-- Texto original: (texto de la segunda actividad)
-- Tipo de shortcode: (tipo elegido)
-- Shortcode generado: (shortcode completo)
+    def estado(self) -> Dict[str, float]:
+        """Peticiones en cola y espera estimada para una petición nueva"""
+        with self._cond:
+            self._recargar()
+            en_cola = sum(len(cola) for cola in self.colas.values())
+            tokens_en_cola = sum(ticket[0] for cola in self.colas.values() for ticket in cola)
+            return {
+                "en_cola": en_cola,
+                "sesiones": len(self.colas),
+                "espera_estimada": self._espera_para(en_cola + 1, tokens_en_cola)
+            }
 
-Y así sucesivamente para cada actividad identificada.
+def estimar_tokens_peticion(data: Dict) -> int:
+    """Estimación conservadora de tokens: texto de entrada (~4 caracteres/token) + max_tokens"""
+    caracteres = 0
+    imagenes = 0
+    for mensaje in data.get("messages", []):
+        contenido = mensaje.get("content")
+        if isinstance(contenido, str):
+            caracteres += len(contenido)
+            continue
+        for bloque in contenido or []:
+            if bloque.get("type") == "image":
+                imagenes += 1
+            else:
+                caracteres += len(bloque.get("text", ""))
+    return caracteres // 4 + imagenes * 1600 + data.get("max_tokens", 0)
 
-NO uses formato JSON ni otro formato. Usa SOLO el formato de texto indicado.
-"""
-    
-    # Estructura de la solicitud
-    data = {
-        "model": "claude-3-7-sonnet-20250219",
-        "max_tokens": 4000,
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": instrucciones_completas + "\n\nAquí está el texto a analizar:\n\n" + texto
-                    }
-                ]
-            }
-        ]
-    }
-    
-    try:
-        # Realizar la solicitud a la API
-        response = requests.post(url, headers=headers, json=data, timeout=60)
+def tokens_consumidos(usage: Optional[Dict]) -> int:
+    """Tokens que cuentan para el límite por minuto según el campo usage de la respuesta"""
+    usage = usage or {}
+    return sum(usage.get(campo) or 0 for campo in (
+        "input_tokens", "output_tokens", "cache_creation_input_tokens", "cache_read_input_tokens"
+    ))
+
+def obtener_sesion_actual() -> str:
+    """Identificador de la sesión de Streamlit que ejecuta el hilo actual"""
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else "global"
+
+class ErrorFormatoRespuesta(ErrorAnthropic):
+    """La respuesta no tiene el formato estructurado pedido (se puede repetir en modo texto)"""
+
+class ClienteAnthropic:
+    """Cliente con un pool de conexiones keep-alive compartido por todas las sesiones"""
+
+    def __init__(self, pool_size: int = ANTHROPIC_POOL_SIZE, timeout=ANTHROPIC_TIMEOUT):
+        self.timeout = timeout
+        self.metricas = MetricasAnthropic()
+        self.limitador = LimitadorAnthropic()
+        self.reintentos = PoliticaReintentos()
+        self.session = requests.Session()
+
+        # Pool de conexiones reutilizables (evita un handshake TCP+TLS por llamada)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        # Cabeceras comunes construidas una sola vez; la API key va en cada llamada
+        self.session.headers.update({
+            "anthropic-version": ANTHROPIC_API_VERSION,
+            "content-type": "application/json"
+        })
+
+    def _post(self, api_key: str, data: Dict, tokens_estimados: int, timeout=None,
+              stream: bool = False) -> requests.Response:
+        """Un intento de petición: turno en el limitador compartido y POST por el pool"""
+        self.limitador.adquirir(obtener_sesion_actual(), tokens_estimados)
+        response = self.session.post(
+            ANTHROPIC_API_URL,
+            headers={"x-api-key": api_key.strip()},  # Eliminar espacios al inicio/final
+            json=data,
+            timeout=timeout or self.timeout,
+            stream=stream
+        )
         
-        # Verificar si la respuesta fue exitosa
+        # Un intento fallido no consume tokens: devolverlos al cubo
+        if response.status_code != 200:
+            self.limitador.ajustar(tokens_estimados, 0)
+        return response
+
+    def enviar_mensaje(self, api_key: str, data: Dict, timeout=None) -> requests.Response:
+        """Enviar una petición a /v1/messages reutilizando las conexiones del pool"""
+        tokens_estimados = estimar_tokens_peticion(data)
+        
+        # Las peticiones a Claude no tienen efectos secundarios: siempre son reintentables
+        inicio = time.perf_counter()
+        response = self.reintentos.ejecutar(
+            lambda: self._post(api_key, data, tokens_estimados, timeout)
+        )
+        
+        # Registrar el uso de tokens y de la caché de prompts
         if response.status_code == 200:
             try:
-                resultado = response.json()
+                usage = response.json().get("usage")
+            except ValueError:
+                usage = None
+            self.metricas.registrar_uso(usage, time.perf_counter() - inicio)
+            self.limitador.ajustar(tokens_estimados, tokens_consumidos(usage))
+        
+        return response
+
+    def enviar_mensaje_stream(self, api_key: str, data: Dict, timeout=None) -> Iterator[Dict]:
+        """Enviar una petición en modo streaming y devolver los eventos SSE decodificados"""
+        tokens_estimados = estimar_tokens_peticion(data)
+        
+        # Solo se reintenta el establecimiento del stream, no un stream ya empezado
+        inicio = time.perf_counter()
+        response = self.reintentos.ejecutar(
+            lambda: self._post(api_key, dict(data, stream=True), tokens_estimados, timeout, stream=True)
+        )
+        
+        with response:
+            if response.status_code != 200:
+                raise ErrorAnthropic(response.status_code, response.text)
+            
+            # El stream SSE no declara charset; el contenido siempre es UTF-8
+            response.encoding = "utf-8"
+            usage = {}
+            for linea in response.iter_lines(decode_unicode=True):
+                if not linea or not linea.startswith("data:"):
+                    continue
+                evento = json.loads(linea[len("data:"):].strip())
+                tipo = evento.get("type")
                 
-                # Extraer la respuesta de texto
-                if 'content' in resultado and len(resultado['content']) > 0:
-                    respuesta_texto = resultado['content'][0]['text']
-                    return respuesta_texto
-                else:
-                    st.error("La respuesta de Claude no contiene contenido de texto")
-                    return None
-            except Exception as e:
-                st.error(f"Error al procesar la respuesta: {str(e)}")
-                return None
-        else:
-            # Mostrar información sobre el error
-            st.error(f"Error en la API: Código {response.status_code}")
-            try:
-                error_detail = response.json()
-            except:
-                error_detail = response.text
-            st.error(f"Detalle del error: {error_detail}")
+                if tipo == "message_start":
+                    usage.update(evento.get("message", {}).get("usage") or {})
+                elif tipo == "message_delta":
+                    usage.update(evento.get("usage") or {})
+                elif tipo == "error":
+                    raise ErrorAnthropic(None, evento.get("error"))
+                
+                yield evento
+        
+        self.metricas.registrar_uso(usage, time.perf_counter() - inicio)
+        self.limitador.ajustar(tokens_estimados, tokens_consumidos(usage))
+
+@st.cache_resource
+def obtener_cliente_anthropic() -> ClienteAnthropic:
+    """Obtener el cliente de Anthropic compartido por todo el proceso"""
+    return ClienteAnthropic()
+
+# ============================================================================
+# CACHÉ PERSISTENTE DE RESPUESTAS DE ANÁLISIS
+# ============================================================================
+
+class CacheRespuestas:
+    """Caché en disco direccionada por contenido, con expulsión LRU por tamaño y TTL opcional"""
+
+    def __init__(self, directorio: str, max_bytes: int = CACHE_RESPUESTAS_MAX_BYTES,
+                 ttl: Optional[float] = CACHE_RESPUESTAS_TTL):
+        self.directorio = directorio
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        os.makedirs(self.directorio, exist_ok=True)
+
+    @staticmethod
+    def calcular_clave(data: Dict, contenido_extra: bytes = b"") -> str:
+        """Calcular un hash estable de la petición (modelo, prompt, entrada y max_tokens)"""
+        hasher = hashlib.sha256()
+        hasher.update(json.dumps(data, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+        hasher.update(contenido_extra)
+        return hasher.hexdigest()
+
+    def _ruta(self, clave: str) -> str:
+        return os.path.join(self.directorio, f"{clave}.json")
+
+    def obtener(self, clave: str) -> Optional[str]:
+        """Devolver la respuesta guardada o None si no existe o ha caducado"""
+        ruta = self._ruta(clave)
+        try:
+            with open(ruta, "r", encoding="utf-8") as f:
+                entrada = json.load(f)
+        except (OSError, ValueError):
             return None
-    
-    except Exception as e:
-        st.error(f"Error al comunicarse con la API: {str(e)}")
-        return None
 
-# Función para analizar la imagen con prompt mejorado y personalizado
-def analizar_imagen_con_prompt(api_key, image_url, prompt_personalizado=""):
-    url = "https://api.anthropic.com/v1/messages"
-    
-    # Usar exactamente los encabezados que funcionaron
-    headers = {
-        "x-api-key": api_key.strip(),  # Eliminar espacios al inicio/final
-        "anthropic-version": "2023-06-01",
-        "content-type": "application/json"
-    }
-    
-    # Prompt base detallado para Claude
-    instrucciones_base = """
+        if self.ttl is not None and time.time() - entrada.get("creado", 0) > self.ttl:
+            self._eliminar(ruta)
+            return None
+
+        # Marcar como usada recientemente para la política LRU
+        try:
+            os.utime(ruta, None)
+        except OSError:
+            pass
+        return entrada.get("respuesta")
+
+    def guardar(self, clave: str, respuesta: str):
+        """Guardar una respuesta de forma atómica y expulsar entradas antiguas si hace falta"""
+        entrada = {"creado": time.time(), "respuesta": respuesta}
+        with self._lock:
+            fd, ruta_tmp = tempfile.mkstemp(dir=self.directorio, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump(entrada, f, ensure_ascii=False)
+                os.replace(ruta_tmp, self._ruta(clave))
+            except OSError:
+                self._eliminar(ruta_tmp)
+                return
+            self._expulsar()
+
+    def estadisticas(self) -> Dict[str, int]:
+        """Número de entradas y bytes ocupados"""
+        entradas = self._listar()
+        return {"entradas": len(entradas), "bytes": sum(tam for _, tam, _ in entradas)}
+
+    def limpiar(self):
+        """Eliminar todas las entradas de la caché"""
+        with self._lock:
+            for ruta, _, _ in self._listar():
+                self._eliminar(ruta)
+
+    def _listar(self) -> List[tuple]:
+        entradas = []
+        try:
+            with os.scandir(self.directorio) as it:
+                for e in it:
+                    if e.name.endswith(".json"):
+                        try:
+                            info = e.stat()
+                        except OSError:
+                            continue
+                        entradas.append((e.path, info.st_size, info.st_mtime))
+        except OSError:
+            pass
+        return entradas
+
+    def _expulsar(self):
+        entradas = self._listar()
+        total = sum(tam for _, tam, _ in entradas)
+        if total <= self.max_bytes:
+            return
+        # Eliminar primero las entradas usadas hace más tiempo
+        for ruta, tam, _ in sorted(entradas, key=lambda e: e[2]):
+            if total <= self.max_bytes:
+                break
+            self._eliminar(ruta)
+            total -= tam
+
+    @staticmethod
+    def _eliminar(ruta: str):
+        try:
+            os.remove(ruta)
+        except OSError:
+            pass
+
+@st.cache_resource
+def obtener_cache_respuestas() -> CacheRespuestas:
+    """Obtener la caché de respuestas compartida por todas las sesiones"""
+    return CacheRespuestas(CACHE_RESPUESTAS_DIR)
+
+@st.cache_resource
+def obtener_sesion_imagenes() -> requests.Session:
+    """Obtener la sesión con pool keep-alive compartida para consultar las imágenes"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=IMAGENES_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def huella_imagen(image_url: str) -> Optional[bytes]:
+    """Identificar la versión de una imagen para la clave de caché (None si no se puede consultar:
+    entonces no se usa la caché, porque con la URL sola podría devolverse el análisis de una imagen
+    ya sustituida)"""
+    session = obtener_sesion_imagenes()
+    try:
+        # Claude descarga la imagen por URL: si el servidor envía ETag o Last-Modified, la URL y
+        # esos validadores bastan como clave y la imagen no se descarga aquí
+        response = session.head(image_url, timeout=IMAGENES_TIMEOUT, allow_redirects=True)
+        if response.status_code == 200:
+            validadores = [response.headers.get(cabecera) for cabecera in ("ETag", "Last-Modified")]
+            if any(validadores):
+                return "\n".join([response.url, *(v or "" for v in validadores)]).encode("utf-8")
+        
+        # Sin validadores, el contenido de la imagen es la única huella fiable
+        response = session.get(image_url, timeout=IMAGENES_TIMEOUT)
+        if response.status_code == 200:
+            return response.content
+    except requests.exceptions.RequestException:
+        pass
+    return None
+
+# ============================================================================
+# PROMPTS ESTÁTICOS Y CONSTRUCCIÓN DE PETICIONES A CLAUDE
+# ============================================================================
+# Las instrucciones y el catálogo de shortcodes son idénticos en todas las
+# llamadas: se envían como prefijo marcado con cache_control para que la API
+# los lea de su caché de prompts, y lo específico de cada llamada va después.
+
+# Documentación de los tipos de shortcode para los prompts, generada a partir de TIPOLOGIAS
+def documentar_tipologias() -> str:
+    secciones = []
+    for i, tipologia in enumerate(TIPOLOGIAS, 1):
+        seccion = (
+            f"### {i}. {tipologia['name']}\n"
+            f"- Usar para: {tipologia['uso']}\n"
+            f"- Formato: {tipologia['formato']}\n"
+            f"- Ejemplo: {tipologia['sample']}\n"
+        )
+        if tipologia.get("nota"):
+            seccion += f"- MUY IMPORTANTE: {tipologia['nota']}\n"
+        secciones.append(seccion)
+    return "\n".join(secciones)
+
+def construir_prompt_analisis(descripcion: str, origen: str) -> str:
+    return f"""
 # Tarea: Extraer ejercicios educativos y convertirlos en shortcodes
 
-Analiza detalladamente esta imagen de un libro de ejercicios educativos y extrae:
+Analiza detalladamente {descripcion} y extrae:
 
 1. El enunciado principal que explica el objetivo general de los ejercicios
-2. Cada actividad o pregunta individual presente en la imagen
+2. Cada actividad o pregunta individual presente en {origen}
 
 ## Tipos de shortcodes disponibles
 
 Debes convertir cada actividad al formato de shortcode más apropiado según los siguientes tipos:
 
-### 1. drag-words
-- Usar para: Ejercicios donde hay que completar frases arrastrando palabras a huecos
-- Formato: [drag-words words="palabra1|palabra2|palabra3" sentence="Texto con [] para rellenar" markers="palabra_correcta1|palabra_correcta2"][/drag-words]
-- Ejemplo: [drag-words words="gato|perro|elefante|mono|rata" sentence="El [] es más grande que el [], pero el [] es el más [] pequeño." markers="elefante|perro|gato|mono"][/drag-words]
-
-### 2. multiple-choice
-- Usar para: Preguntas con MÚLTIPLES respuestas correctas posibles
-- Formato: [multiple-choice options="opción1|opción2|opción3" correctOptions="opciónCorrecta1|opciónCorrecta2"][/multiple-choice]
-- Ejemplo: [multiple-choice options="Lechuga|Manzana|Zanahoria|Plátano|Pera" correctOptions="Manzana|Plátano|Pera"][/multiple-choice]
-
-### 3. single-choice
-- Usar para: Preguntas con UNA SOLA respuesta correcta
-- Formato: [single-choice options="opción1|opción2|opción3" correctOption="opciónCorrecta"][/single-choice]
-- Ejemplo: [single-choice options="Rojo|Verde|Azul|Amarillo" correctOption="Azul"][/single-choice]
-
-### 4. fill-in-the-blanks
-- Usar para: Textos con espacios para rellenar (texto libre)
-- Formato: [fill-in-the-blanks text="Texto con [text|respuesta] para completar." casesensitive="false" specialcharssensitive="false"][/fill-in-the-blanks]
-- Ejemplo: [fill-in-the-blanks text="La capital de [text|España] es Madrid." casesensitive="false" specialcharssensitive="false"][/fill-in-the-blanks]
-- MUY IMPORTANTE: Si hay varias respuestas válidas se deben separar con el símbolo almohadilla (#).
-
-### 5. fill-in-the-blanks
-- Usar para: Elegir entre dos opciones
-- Formato: [fill-in-the-blanks text="Texto: [radio|Verdadero#*Falso]" casesensitive="false" specialcharssensitive="false"][/fill-in-the-blanks]
-- Ejemplo: [fill-in-the-blanks text="La leche es: [radio|*Blanca#Negra]" casesensitive="false" specialcharssensitive="false"][/fill-in-the-blanks]
-- MUY IMPORTANTE: El asterisco (*) indica la opción correcta. El símbolo | separa las opciones. 
-
-### 6. fill-in-the-blanks
-- Usar para: Textos con espacios para seleccionar entre opciones (menú desplegable)
-- Formato: [fill-in-the-blanks text="Texto con [select|Incorrecta1#*Correcta#Incorrecta2] para seleccionar." casesensitive="false" specialcharssensitive="false"][/fill-in-the-blanks]
-- Ejemplo: [fill-in-the-blanks text="El animal más rápido es el [select|leopardo#*guepardo#león#tigre]." casesensitive="false" specialcharssensitive="false"][/fill-in-the-blanks]
-- MUY IMPORTANTE: El asterisco (*) indica la opción correcta. Debe haber solo una opción correcta por cada hueco. El símbolo # separa las opciones.
-
-### 7. fill-in-the-blanks
-- Usar para: Introducir letras para completar una única palabra
-- Formato: [fill-in-the-blanks text="Texto [short-text|letra1][short-text|letra2][short-text|letra3]" casesensitive="false" specialcharssensitive="false"][/fill-in-the-blanks]
-- Ejemplo: [fill-in-the-blanks text="El caballo [text|blanco] de Santiago es de [short-text|c][short-text|o][short-text|l][short-text|o][short-text|r] blanco." casesensitive="false" specialcharssensitive="false"][/fill-in-the-blanks]
-
-### 8. statement-option-match
-- Usar para: Emparejar conceptos o frases con sus correspondientes opciones correctas
-- Formato: [statement-option-match statements="a*afirmación1|b*afirmación2" options="b*respuesta correcta para la afirmación2*descripción1 (puede no existir, si no existe no poner nada)|a*respuesta correcta para la afirmación2*descripción2 (puede no existir, si no existe no poner nada)"][/statement-option-match]
-- Ejemplo: [statement-option-match statements="a*La leche es|b*El cielo es|c*La hierba es" options="b*azul*El  mismo color que el mar|b*verde*|a*blanca*"][/statement-option-match]
-- MUY IMPORTANTE: Poner la misma etiqueta (números o letras) tanto en los statments como en las options. En las options las etiquetas indican la respuesta correcta para la opción. En las options, si no hay descripción mantener los dos asteríscos.
-
-### 9. writing
-- Usar para: Producción libre de texto escrito
-- Formato: [writing maxtime="0"][/writing]
-- Ejemplo: [writing maxtime="0"][/writing]
-
-### 10. oral-expression
-- Usar para: Producción oral de respuestas
-- Formato: [oral-expression autoplay="false" maxtime="0" maxplays="0" recordmode="audio"][/oral-expression]
-- Ejemplo: [oral-expression autoplay="false" maxtime="0" maxplays="0" recordmode="audio"][/oral-expression]
-
-### 11. file-upload
-- Usar para: Subir archivos como respuesta
-- Formato: [file-upload extensions="pdf|doc|docx"][/file-upload]
-- Ejemplo: [file-upload extensions="pdf|doc|docx"][/file-upload]
-
-### 12. image-choice
-- Usar para: Preguntas con opciones de selección de imágenes
-- Formato: [image-choice images="url_imagen1*texto_alternativo1|url_imagen2*texto_alternativo2" correctOptionIndex="índice_opción_correcta"][/image-choice]
-- Ejemplo: [image-choice images="https://url-a-imagen-de-gato.com/gato.jpg*texto alternativo gato|https://url-a-imagen-de-perro.com/perro.jpg*texto alternativo perro" correctOptionIndex="1"][/image-choice]
-
-### 13. multi-question
-- Usar para: Agrupar varias preguntas en un solo bloque
-- Formato: [multi-question questions=""][/multi-question]
-- Ejemplo: [multi-question questions=""][/multi-question]
-
-### 14. abnone-choice
-- Usar para: Preguntas con opciones A, B, Ninguna de las anteriores
-- Formato: [abnone-choice titlea="Título A" texta="Texto A" titleb="Título B" textb="Texto B" questions="a*Pregunta A|b*Pregunta B|c*Pregunta C"][/abnone-choice]
-- Ejemplo: [abnone-choice titlea="Lorem" texta="Lorem ipsum Lorem ipsum" titleb="Ipsum" textb="Lorem" questions="a*¿Lorem ipsum?|b*¿Ipsum lorem?|c*¿Dolor sit?"]
-
+{documentar_tipologias()}
 ## Instrucciones IMPORTANTES
 
 1. Analiza cuidadosamente el tipo de ejercicio antes de elegir el shortcode
@@ -1009,16 +2088,24 @@ Debes convertir cada actividad al formato de shortcode más apropiado según los
 5. Si un ejercicio tiene múltiples partes que requieren diferentes tipos, trátalas como actividades separadas
 6. Si un ejercicio tiene múltiples partes intenta que vaya en un ÚNICO shortcode
 7. Los shortcodes tipo fill-the-blanks pueden usarse para agrupar en un único shortcode varios apartados distintos. Pueden ser del mismo tipo o de diferente tipo:
-   – Ejemplo: [fill-in-the-blanks text="La capital de [text|España] es Madrid. El caballo [text|blanco] de Santiago es de [short-text|c][short-text|o][short-text|l][short-text|o][short-text|r] blanco. El animal más rápido del mundo es el [select|leopardo#*guepardo#león#tigre]. Las afirmaciones anteriores son: [radio|Verdaderas#Falsas*]" casesensitive="false" specialcharssensitive="false"][/fill-in-the-blanks]
+   – Ejemplo: [fill-in-the-blanks text="La capital de [text|España] es Madrid. El caballo [text|blanco] de Santiago es de [short-text|c][short-text|o][short-text|l][short-text|o][short-text|r] blanco. El animal más rápido del mundo es el [select|leopardo#*guepardo#león#tigre]. Las afirmaciones anteriores son: [radio|Verdaderas#*Falsas]" casesensitive="false" specialcharssensitive="false"][/fill-in-the-blanks]
+
+"""
 
+PROMPT_ANALISIS_TEXTO = construir_prompt_analisis("este texto de ejercicios educativos", "el texto")
+
+PROMPT_ANALISIS_IMAGEN = construir_prompt_analisis("esta imagen de un libro de ejercicios educativos", "la imagen")
+
+# Formato de la respuesta: va en el sufijo porque depende del modo de salida (texto o herramienta)
+FORMATO_RESPUESTA_TEXTO = """
 ## Formato de tu respuesta
 
 Responde usando exactamente este formato:
 
-ENUNCIADO: (escribe aquí el enunciado principal identificado en la imagen)
+ENUNCIADO: (escribe aquí el enunciado principal identificado en {origen})
 
 ACTIVIDAD 1:
-- Texto original: (transcribe aquí el texto completo de la actividad como aparece en la imagen)
+- Texto original: (transcribe aquí el texto completo de la actividad como aparece en {origen})
 - Tipo de shortcode: (nombre exacto del tipo de shortcode más adecuado)
 - Shortcode generado: (escribe el shortcode completo siguiendo exactamente el formato del ejemplo)
 
@@ -1032,13 +2119,116 @@ Y así sucesivamente para cada actividad identificada.
 NO uses formato JSON ni otro formato. Usa SOLO el formato de texto indicado.
 """
 
-    # Combinar prompt base con el prompt personalizado si existe
+FORMATO_RESPUESTA_HERRAMIENTA = """
+## Formato de tu respuesta
+
+Registra el resultado llamando a la herramienta `registrar_actividades` con:
+- enunciado: el enunciado principal identificado en {origen}
+- actividades: una entrada por actividad, en orden, con el texto original completo, el tipo de shortcode elegido y el shortcode generado siguiendo exactamente el formato del ejemplo
+"""
+
+# Herramienta para obtener el resultado como JSON con esquema en lugar de texto libre
+HERRAMIENTA_REGISTRAR_ACTIVIDADES = {
+    "name": "registrar_actividades",
+    "description": "Registra el enunciado principal y las actividades convertidas a shortcodes.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "enunciado": {
+                "type": "string",
+                "description": "Enunciado principal que explica el objetivo general de los ejercicios"
+            },
+            "actividades": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "texto_original": {"type": "string"},
+                        "tipo": {"type": "string", "enum": list(dict.fromkeys(t["name"] for t in TIPOLOGIAS))},
+                        "shortcode": {"type": "string"}
+                    },
+                    "required": ["texto_original", "tipo", "shortcode"]
+                }
+            }
+        },
+        "required": ["enunciado", "actividades"]
+    }
+}
+
+PROMPT_REFINAMIENTO = """
+# Tarea: Refinar un shortcode educativo existente
+
+Necesito que refines el shortcode indicado al final según las instrucciones de refinamiento proporcionadas.
+
+## Tipos de shortcodes disponibles
+El shortcode debe seguir alguno de estos formatos:
+{formatos}
+
+## Instrucciones importantes
+1. Mantén el mismo tipo de shortcode a menos que la instrucción de refinamiento indique explícitamente cambiarlo
+2. Sigue EXACTAMENTE la misma estructura y símbolos separadores (|, *, #, etc.)
+3. Respeta el formato exacto de las comillas y corchetes
+4. Incorpora las mejoras solicitadas en la instrucción de refinamiento
+
+## Formato de tu respuesta
+Proporciona tu respuesta usando exactamente este formato:
+
+SHORTCODE REFINADO: (escribe aquí solo el shortcode refinado completo, sin comentarios adicionales)
+
+EXPLICACIÓN: (explica brevemente los cambios realizados)
+""".format(formatos="\n".join(
+    f"- {tipologia['name']}: {tipologia['formato']}" + (f" ({tipologia['nota']})" if tipologia.get("nota") else "")
+    for tipologia in TIPOLOGIAS
+))
+
+def bloque_texto_cacheable(texto: str) -> Dict:
+    """Bloque de texto marcado como prefijo cacheable para la API de Anthropic"""
+    return {
+        "type": "text",
+        "text": texto,
+        "cache_control": {"type": "ephemeral"}
+    }
+
+def construir_instrucciones_personalizadas(prompt_personalizado: str) -> str:
+    """Sección de instrucciones personalizadas del sufijo (vacía si no hay)"""
     if prompt_personalizado and prompt_personalizado.strip():
-        instrucciones_completas = instrucciones_base + "\n\n## Instrucciones personalizadas adicionales\n\n" + prompt_personalizado
-    else:
-        instrucciones_completas = instrucciones_base
+        return "## Instrucciones personalizadas adicionales\n\n" + prompt_personalizado + "\n\n"
+    return ""
+
+def construir_formato_respuesta(data: Dict, origen: str, salida_estructurada: bool) -> str:
+    """Sección de formato del sufijo; en modo estructurado añade la herramienta a la petición"""
+    if salida_estructurada:
+        data["tools"] = [HERRAMIENTA_REGISTRAR_ACTIVIDADES]
+        data["tool_choice"] = {"type": "tool", "name": HERRAMIENTA_REGISTRAR_ACTIVIDADES["name"]}
+        return FORMATO_RESPUESTA_HERRAMIENTA.format(origen=origen)
+    return FORMATO_RESPUESTA_TEXTO.format(origen=origen)
+
+def construir_solicitud_analisis_texto(texto: str, prompt_personalizado: str = "",
+                                       salida_estructurada: bool = False) -> Dict:
+    """Construir la petición de análisis de un texto de ejercicios"""
+    data = {
+        "model": "claude-3-7-sonnet-20250219",
+        "max_tokens": 4000,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    bloque_texto_cacheable(PROMPT_ANALISIS_TEXTO)
+                ]
+            }
+        ]
+    }
+    
+    sufijo = construir_formato_respuesta(data, "el texto", salida_estructurada)
+    sufijo += construir_instrucciones_personalizadas(prompt_personalizado)
+    sufijo += "Aquí está el texto a analizar:\n\n" + texto
+    data["messages"][0]["content"].append({"type": "text", "text": sufijo})
     
-    # Estructura de la solicitud 
+    return data
+
+def construir_solicitud_analisis_imagen(image_url: str, prompt_personalizado: str = "",
+                                        salida_estructurada: bool = False) -> Dict:
+    """Construir la petición de análisis de una imagen de ejercicios"""
     data = {
         "model": "claude-sonnet-4-20250514",
         "max_tokens": 4000,
@@ -1046,133 +2236,756 @@ NO uses formato JSON ni otro formato. Usa SOLO el formato de texto indicado.
             {
                 "role": "user",
                 "content": [
+                    bloque_texto_cacheable(PROMPT_ANALISIS_IMAGEN),
                     {
                         "type": "image",
                         "source": {
                             "type": "url",
                             "url": image_url
                         }
-                    },
+                    }
+                ]
+            }
+        ]
+    }
+    
+    sufijo = construir_formato_respuesta(data, "la imagen", salida_estructurada)
+    sufijo += construir_instrucciones_personalizadas(prompt_personalizado)
+    sufijo += "Analiza la imagen anterior siguiendo todas las instrucciones."
+    data["messages"][0]["content"].append({"type": "text", "text": sufijo})
+    
+    return data
+
+def construir_solicitud_refinamiento(shortcode_original: str, texto_original: str,
+                                     tipo_actividad: str, instruccion_refinamiento: str) -> Dict:
+    """Construir la petición de refinamiento de un shortcode"""
+    sufijo = f"""## Texto original del ejercicio
+{texto_original}
+
+## Tipo de shortcode actual
+{tipo_actividad}
+
+## Shortcode actual
+{shortcode_original}
+
+## Instrucciones de refinamiento
+{instruccion_refinamiento}
+"""
+    
+    return {
+        "model": "claude-3-7-sonnet-20250219",
+        "max_tokens": 1000,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    bloque_texto_cacheable(PROMPT_REFINAMIENTO),
                     {
                         "type": "text",
-                        "text": instrucciones_completas
+                        "text": sufijo
                     }
                 ]
             }
         ]
     }
+
+def construir_solicitud_continuacion(data: Dict, texto_parcial: str) -> Dict:
+    """Petición que retoma una respuesta cortada por max_tokens a partir del texto ya generado"""
+    return dict(data, messages=data["messages"] + [
+        {
+            "role": "assistant",
+            "content": texto_parcial
+        }
+    ])
+
+# ============================================================================
+# ALMACÉN DE VERSIONES DE SHORTCODES
+# ============================================================================
+
+class AlmacenVersiones:
+    """Versiones de los shortcodes de cada actividad: la última completa y las anteriores como diferencias"""
+
+    def __init__(self, max_versiones: int = VERSIONES_MAX_POR_ACTIVIDAD, resultado: Optional[str] = None):
+        self.max_versiones = max_versiones
+        self.resultado = resultado  # Huella del resultado al que pertenecen las versiones
+        self.actividades = {}
+
+    def guardar(self, actividad_num, shortcode: str, explicacion: Optional[str] = None,
+                timestamp: Optional[str] = None) -> Dict:
+        """Añadir una versión nueva; la anterior pasa a guardarse como diferencia respecto a esta"""
+        shortcode = shortcode or ""
+        version = {
+            "timestamp": timestamp or datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "shortcode": shortcode,
+            "explicacion": explicacion
+        }
+        actividad = self.actividades.get(f"actividad_{actividad_num}")
+        if actividad is None:
+            self.actividades[f"actividad_{actividad_num}"] = {"ultima": version, "anteriores": deque(), "descartadas": 0}
+            return version
+        
+        anterior = actividad["ultima"]
+        actividad["anteriores"].append({
+            "timestamp": anterior["timestamp"],
+            "explicacion": anterior["explicacion"],
+            "delta": self.calcular_delta(shortcode, anterior["shortcode"])
+        })
+        actividad["ultima"] = version
+        
+        # Limitar las versiones retenidas (la más antigua se descarta)
+        if len(actividad["anteriores"]) >= self.max_versiones:
+            actividad["anteriores"].popleft()
+            actividad["descartadas"] += 1
+        return version
+
+    def ultima(self, actividad_num) -> Optional[str]:
+        """Shortcode de la última versión de una actividad (None si no tiene versiones)"""
+        actividad = self.actividades.get(f"actividad_{actividad_num}")
+        return actividad["ultima"]["shortcode"] if actividad else None
+
+    def shortcode_actual(self, actividad: Dict) -> str:
+        """Última versión del shortcode de una actividad del resultado, o el shortcode original"""
+        ultima = self.ultima(actividad.get("numero"))
+        return ultima if ultima is not None else actividad.get("shortcode", "")
+
+    def num_versiones(self, actividad_num) -> int:
+        actividad = self.actividades.get(f"actividad_{actividad_num}")
+        return len(actividad["anteriores"]) + 1 if actividad else 0
+
+    def versiones(self, actividad_num) -> List[Dict]:
+        """Reconstruir las versiones retenidas, de la más antigua a la más reciente"""
+        actividad = self.actividades.get(f"actividad_{actividad_num}")
+        if actividad is None:
+            return []
+        
+        versiones = [dict(actividad["ultima"], numero=actividad["descartadas"] + len(actividad["anteriores"]) + 1)]
+        shortcode = actividad["ultima"]["shortcode"]
+        for i, anterior in enumerate(reversed(actividad["anteriores"])):
+            shortcode = self.aplicar_delta(shortcode, anterior["delta"])
+            versiones.append({
+                "timestamp": anterior["timestamp"],
+                "shortcode": shortcode,
+                "explicacion": anterior["explicacion"],
+                "numero": actividad["descartadas"] + len(actividad["anteriores"]) - i
+            })
+        return versiones[::-1]
+
+    @staticmethod
+    def calcular_delta(origen: str, destino: str) -> List:
+        """Diferencia para obtener destino a partir de origen: tramos copiados (inicio, fin) o texto nuevo"""
+        # Los refinamientos suelen cambiar una zona concreta: comparar solo lo que hay entre
+        # el prefijo y el sufijo comunes
+        limite = min(len(origen), len(destino))
+        prefijo = 0
+        while prefijo < limite and origen[prefijo] == destino[prefijo]:
+            prefijo += 1
+        sufijo = 0
+        while sufijo < limite - prefijo and origen[-1 - sufijo] == destino[-1 - sufijo]:
+            sufijo += 1
+        
+        delta = [(0, prefijo)] if prefijo else []
+        medio_origen = origen[prefijo:len(origen) - sufijo]
+        medio_destino = destino[prefijo:len(destino) - sufijo]
+        for operacion, i1, i2, j1, j2 in difflib.SequenceMatcher(None, medio_origen, medio_destino).get_opcodes():
+            if operacion == "equal":
+                delta.append((prefijo + i1, prefijo + i2))
+            elif operacion in ("replace", "insert"):
+                delta.append(medio_destino[j1:j2])
+        if sufijo:
+            delta.append((len(origen) - sufijo, len(origen)))
+        return delta
+
+    @staticmethod
+    def aplicar_delta(origen: str, delta: List) -> str:
+        return "".join(origen[parte[0]:parte[1]] if isinstance(parte, tuple) else parte for parte in delta)
+
+def obtener_almacen_versiones() -> AlmacenVersiones:
+    """Almacén de versiones del resultado activo, cargado del almacén del proyecto al acceder a él"""
+    proyecto = obtener_proyecto_actual()
+    huella = st.session_state.get('resultado_activo')
+    if not proyecto or not huella:
+        return AlmacenVersiones()
+    return cargar_almacen_versiones(proyecto, huella)
+
+# ============================================================================
+# HISTORIAL DE ACCIONES
+# ============================================================================
+
+class HistorialAcciones:
+    """Historial con capacidad fija en memoria: las entradas más antiguas se vuelcan a disco (JSONL)"""
+
+    def __init__(self, capacidad: int = HISTORIAL_CAPACIDAD, directorio: str = HISTORIAL_DIR):
+        self.capacidad = capacidad
+        self.directorio = directorio
+        self.recientes = deque()
+        self.archivo = None
+        self.volcadas = 0
+
+    def __len__(self) -> int:
+        return self.volcadas + len(self.recientes)
+
+    def agregar(self, entrada: Dict):
+        self.recientes.append(entrada)
+        if len(self.recientes) > self.capacidad:
+            self._volcar(self.recientes.popleft())
+
+    def _volcar(self, entrada: Dict):
+        try:
+            if self.archivo is None:
+                os.makedirs(self.directorio, exist_ok=True)
+                self.borrar_volcados_antiguos(self.directorio)
+                fd, self.archivo = tempfile.mkstemp(dir=self.directorio, suffix=".jsonl")
+                os.close(fd)
+            with open(self.archivo, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entrada, ensure_ascii=False) + "\n")
+            self.volcadas += 1
+        except OSError:
+            # Sin disco disponible la entrada se pierde, pero la memoria sigue acotada
+            pass
+
+    def num_paginas(self, tamaño: int) -> int:
+        return max(1, -(-len(self) // tamaño))
+
+    def pagina(self, numero: int, tamaño: int) -> List[Dict]:
+        """Entradas de una página, de la más reciente a la más antigua (numero empieza en 0)"""
+        inicio = numero * tamaño
+        fin = min(inicio + tamaño, len(self))
+        en_memoria = len(self.recientes)
+        
+        entradas = [self.recientes[en_memoria - 1 - i] for i in range(inicio, min(fin, en_memoria))]
+        if fin > en_memoria:
+            # Páginas antiguas: leer las entradas volcadas a disco
+            try:
+                with open(self.archivo, encoding="utf-8") as f:
+                    volcadas = f.readlines()
+            except OSError:
+                # El volcado se borró por antigüedad: solo quedan las entradas en memoria
+                self.archivo = None
+                self.volcadas = 0
+                return entradas
+            for i in range(max(inicio, en_memoria), fin):
+                entradas.append(json.loads(volcadas[self.volcadas - 1 - (i - en_memoria)]))
+        return entradas
+
+    def limpiar(self):
+        self.recientes.clear()
+        self.volcadas = 0
+        if self.archivo:
+            try:
+                os.remove(self.archivo)
+            except OSError:
+                pass
+            self.archivo = None
+
+    @staticmethod
+    def borrar_volcados_antiguos(directorio: str = HISTORIAL_DIR, max_edad: float = HISTORIAL_MAX_EDAD) -> int:
+        """Borrar los volcados sin escribir desde hace más de max_edad segundos (sesiones terminadas)"""
+        limite = time.time() - max_edad
+        borrados = 0
+        try:
+            with os.scandir(directorio) as it:
+                for e in it:
+                    if not e.name.endswith(".jsonl"):
+                        continue
+                    try:
+                        if e.stat().st_mtime < limite:
+                            os.remove(e.path)
+                            borrados += 1
+                    except OSError:
+                        continue
+        except OSError:
+            pass
+        return borrados
+
+@st.cache_resource
+def limpiar_volcados_historial() -> int:
+    """Limpieza de los volcados que dejaron las sesiones anteriores, una vez por proceso"""
+    return HistorialAcciones.borrar_volcados_antiguos()
+
+def obtener_historial() -> HistorialAcciones:
+    """Historial de acciones de la sesión actual (se crea si no existe)"""
+    limpiar_volcados_historial()
+    if not hasattr(st.session_state.get('conversation_history'), 'pagina'):
+        st.session_state.conversation_history = HistorialAcciones()
+    return st.session_state.conversation_history
+
+# ============================================================================
+# ALMACÉN PERSISTENTE DE PROYECTOS (SQLITE)
+# ============================================================================
+
+class AlmacenProyectos:
+    """Resultados, versiones de shortcodes y publicaciones de cada proyecto guardados en SQLite"""
+
+    ESQUEMA = """
+        CREATE TABLE IF NOT EXISTS proyectos (
+            id TEXT PRIMARY KEY,
+            creado TEXT NOT NULL,
+            actualizado TEXT NOT NULL,
+            texto_respuesta TEXT,
+            resultado TEXT
+        );
+        CREATE TABLE IF NOT EXISTS versiones (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            proyecto TEXT NOT NULL,
+            resultado TEXT NOT NULL,
+            actividad TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            shortcode TEXT NOT NULL,
+            explicacion TEXT
+        );
+        CREATE TABLE IF NOT EXISTS publicaciones (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            proyecto TEXT NOT NULL,
+            group_id INTEGER,
+            timestamp TEXT NOT NULL,
+            datos TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_versiones_resultado ON versiones (proyecto, resultado, actividad, id);
+        CREATE INDEX IF NOT EXISTS idx_publicaciones_proyecto ON publicaciones (proyecto, id);
+        CREATE INDEX IF NOT EXISTS idx_publicaciones_grupo ON publicaciones (group_id);
+    """
+
+    def __init__(self, ruta: str = PROYECTOS_DB):
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        # Una conexión compartida entre sesiones; el candado serializa su uso desde varios hilos
+        self.conexion = sqlite3.connect(ruta, check_same_thread=False)
+        self.conexion.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conexion.execute("PRAGMA journal_mode=WAL")
+            self.conexion.executescript(self.ESQUEMA)
+
+    def _ejecutar(self, sql: str, parametros: Tuple = ()) -> List[sqlite3.Row]:
+        with self.lock, self.conexion:
+            return self.conexion.execute(sql, parametros).fetchall()
+
+    def existe(self, proyecto: str) -> bool:
+        return bool(self._ejecutar("SELECT 1 FROM proyectos WHERE id = ?", (proyecto,)))
+
+    def guardar_resultado(self, proyecto: str, texto_respuesta: Optional[str], resultado: Dict):
+        """Guardar el resultado activo del proyecto (las versiones de cada resultado se guardan aparte)"""
+        ahora = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self._ejecutar(
+            "INSERT INTO proyectos (id, creado, actualizado, texto_respuesta, resultado) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET actualizado = excluded.actualizado, "
+            "texto_respuesta = excluded.texto_respuesta, resultado = excluded.resultado",
+            (proyecto, ahora, ahora, texto_respuesta, json.dumps(resultado, ensure_ascii=False))
+        )
+
+    def cargar_resultado(self, proyecto: str) -> Optional[Dict]:
+        filas = self._ejecutar("SELECT resultado FROM proyectos WHERE id = ?", (proyecto,))
+        return json.loads(filas[0]["resultado"]) if filas and filas[0]["resultado"] else None
+
+    def cargar_texto_respuesta(self, proyecto: str) -> Optional[str]:
+        filas = self._ejecutar("SELECT texto_respuesta FROM proyectos WHERE id = ?", (proyecto,))
+        return filas[0]["texto_respuesta"] if filas else None
+
+    def guardar_version(self, proyecto: str, resultado: str, actividad_num, version: Dict):
+        self._ejecutar(
+            "INSERT INTO versiones (proyecto, resultado, actividad, timestamp, shortcode, explicacion) VALUES (?, ?, ?, ?, ?, ?)",
+            (proyecto, resultado, str(actividad_num), version["timestamp"], version["shortcode"], version["explicacion"])
+        )
+
+    def borrar_versiones(self, proyecto: str, resultado: str):
+        self._ejecutar("DELETE FROM versiones WHERE proyecto = ? AND resultado = ?", (proyecto, resultado))
+
+    def cargar_versiones(self, proyecto: str, resultado: str,
+                         max_por_actividad: int = VERSIONES_MAX_POR_ACTIVIDAD) -> Iterator[sqlite3.Row]:
+        """Últimas versiones de cada actividad de un resultado, de la más antigua a la más reciente"""
+        return iter(self._ejecutar(
+            "SELECT actividad, timestamp, shortcode, explicacion FROM ("
+            "  SELECT *, ROW_NUMBER() OVER (PARTITION BY actividad ORDER BY id DESC) AS orden"
+            "  FROM versiones WHERE proyecto = ? AND resultado = ?"
+            ") WHERE orden <= ? ORDER BY id",
+            (proyecto, resultado, max_por_actividad)
+        ))
+
+    def guardar_publicacion(self, proyecto: str, publicacion: Dict):
+        self._ejecutar(
+            "INSERT INTO publicaciones (proyecto, group_id, timestamp, datos) VALUES (?, ?, ?, ?)",
+            (proyecto, publicacion.get("group_id"), publicacion["timestamp"], json.dumps(publicacion, ensure_ascii=False))
+        )
+
+    def actualizar_publicacion(self, registro: int, publicacion: Dict):
+        datos = {k: v for k, v in publicacion.items() if k != "registro"}
+        self._ejecutar("UPDATE publicaciones SET datos = ? WHERE id = ?", (json.dumps(datos, ensure_ascii=False), registro))
+
+    def publicaciones(self, proyecto: str) -> List[Dict]:
+        """Publicaciones del proyecto, de la más reciente a la más antigua (registro = id de la fila)"""
+        filas = self._ejecutar("SELECT id, datos FROM publicaciones WHERE proyecto = ? ORDER BY id DESC", (proyecto,))
+        return [dict(json.loads(fila["datos"]), registro=fila["id"]) for fila in filas]
+
+@st.cache_resource
+def obtener_almacen_proyectos() -> AlmacenProyectos:
+    return AlmacenProyectos()
+
+def obtener_proyecto_actual(crear: bool = False) -> Optional[str]:
+    """Identificador del proyecto de la sesión; se refleja en la URL (?proyecto=) para poder reanudarlo"""
+    if not st.session_state.get('proyecto_id') and crear:
+        st.session_state.proyecto_id = uuid.uuid4().hex
+        st.query_params["proyecto"] = st.session_state.proyecto_id
+    return st.session_state.get('proyecto_id')
+
+def reanudar_proyecto(proyecto: str) -> bool:
+    """Recuperar el resultado activo de un proyecto guardado (la sesión solo guarda su huella)"""
+    almacen = obtener_almacen_proyectos()
+    if not almacen.existe(proyecto):
+        return False
     
-    try:
-        # Realizar la solicitud a la API
-        response = requests.post(url, headers=headers, json=data, timeout=60)
+    resultado = almacen.cargar_resultado(proyecto)
+    st.session_state.proyecto_id = proyecto
+    st.session_state.resultado_activo = huella_resultado(resultado) if resultado else None
+    return True
+
+@st.cache_resource(max_entries=PROYECTOS_CACHE_MAX, show_spinner=False)
+def cargar_resultado_proyecto(proyecto: str, huella: str) -> Optional[Dict]:
+    """Resultado guardado del proyecto si sigue siendo el de esa huella (no se modifica: lo comparten las sesiones)"""
+    resultado = obtener_almacen_proyectos().cargar_resultado(proyecto)
+    return resultado if resultado and huella_resultado(resultado) == huella else None
+
+def obtener_resultado_activo() -> Optional[Dict]:
+    """Resultado activo de la sesión, leído del almacén del proyecto al acceder a él"""
+    proyecto = obtener_proyecto_actual()
+    huella = st.session_state.get('resultado_activo')
+    if not proyecto or not huella:
+        return None
+    
+    resultado = cargar_resultado_proyecto(proyecto, huella)
+    if resultado is None:
+        # Otra sesión del mismo proyecto abrió otro resultado: se continúa con el guardado
+        cargar_resultado_proyecto.clear(proyecto, huella)
+        resultado = obtener_almacen_proyectos().cargar_resultado(proyecto)
+        st.session_state.resultado_activo = huella_resultado(resultado) if resultado else None
+    return resultado
+
+@st.cache_resource(max_entries=PROYECTOS_CACHE_MAX, show_spinner=False)
+def cargar_almacen_versiones(proyecto: str, huella: str) -> AlmacenVersiones:
+    """Versiones de un resultado reconstruidas desde el almacén del proyecto (las nuevas se guardan en ambos)"""
+    almacen = AlmacenVersiones(resultado=huella)
+    for fila in obtener_almacen_proyectos().cargar_versiones(proyecto, huella, almacen.max_versiones):
+        almacen.guardar(fila["actividad"], fila["shortcode"], fila["explicacion"], fila["timestamp"])
+    return almacen
+
+def descartar_versiones(proyecto: str, huella: str):
+    obtener_almacen_proyectos().borrar_versiones(proyecto, huella)
+    cargar_almacen_versiones.clear(proyecto, huella)
+
+def obtener_texto_respuesta() -> Optional[str]:
+    """Respuesta completa de Claude del proyecto activo, leída del almacén solo cuando se muestra"""
+    proyecto = obtener_proyecto_actual()
+    return obtener_almacen_proyectos().cargar_texto_respuesta(proyecto) if proyecto else None
+
+# ============================================================================
+# FUNCIONES ORIGINALES DE IMGTOSH (CONSERVADAS)
+# ============================================================================
+
+# Función para obtener el texto de respuesta de Claude (lanza ErrorAnthropic, sin usar Streamlit)
+def solicitar_respuesta_claude(api_key, data):
+    cliente = obtener_cliente_anthropic()
+    texto_acumulado = ""
+    
+    # Si la respuesta se corta por max_tokens, continuar desde el texto parcial y unir las partes
+    for continuacion in range(MAX_CONTINUACIONES + 1):
+        peticion = data
+        if continuacion:
+            # La API no admite un mensaje de asistente terminado en espacios
+            texto_acumulado = texto_acumulado.rstrip()
+            peticion = construir_solicitud_continuacion(data, texto_acumulado)
+            cliente.metricas.registrar(continuaciones=1)
+        
+        # Realizar la solicitud a la API con el cliente compartido
+        response = cliente.enviar_mensaje(api_key, peticion)
         
         # Verificar si la respuesta fue exitosa
-        if response.status_code == 200:
-            try:
-                resultado = response.json()
-                
-                # Extraer la respuesta de texto
-                if 'content' in resultado and len(resultado['content']) > 0:
-                    respuesta_texto = resultado['content'][0]['text']
-                    return respuesta_texto
-                else:
-                    st.error("La respuesta de Claude no contiene contenido de texto")
-                    return None
-            except Exception as e:
-                st.error(f"Error al procesar la respuesta: {str(e)}")
-                return None
-        else:
-            # Mostrar información sobre el error
-            st.error(f"Error en la API: Código {response.status_code}")
+        if response.status_code != 200:
             try:
                 error_detail = response.json()
-            except:
+            except ValueError:
                 error_detail = response.text
-            st.error(f"Detalle del error: {error_detail}")
-            return None
+            raise ErrorAnthropic(response.status_code, error_detail)
+        
+        resultado = response.json()
+        
+        # Salida estructurada: el resultado llega como entrada de la herramienta (no admite continuación)
+        if 'tools' in data:
+            return extraer_resultado_herramienta(resultado)
+        
+        # Extraer la respuesta de texto
+        bloques_texto = [b.get('text', '') for b in resultado.get('content', []) if b.get('type') == 'text']
+        if not bloques_texto and not texto_acumulado:
+            raise ErrorAnthropic(response.status_code, "La respuesta de Claude no contiene contenido de texto")
+        texto_acumulado += "".join(bloques_texto)
+        
+        if resultado.get('stop_reason') != 'max_tokens':
+            break
     
-    except Exception as e:
-        st.error(f"Error al comunicarse con la API: {str(e)}")
-        return None
+    return texto_acumulado
 
-# Función para refinar un shortcode específico
-def refinar_shortcode(api_key, shortcode_original, texto_original, tipo_actividad, instruccion_refinamiento):
-    url = "https://api.anthropic.com/v1/messages"
+# Función para convertir la llamada a la herramienta en la respuesta JSON del análisis
+def extraer_resultado_herramienta(resultado):
+    if resultado.get('stop_reason') == 'max_tokens':
+        raise ErrorFormatoRespuesta(200, "La salida estructurada se cortó por max_tokens")
     
-    headers = {
-        "x-api-key": api_key.strip(),
-        "anthropic-version": "2023-06-01",
-        "content-type": "application/json"
-    }
+    bloque = next((b for b in resultado.get('content', []) if b.get('type') == 'tool_use'), None)
+    entrada = bloque.get('input') if bloque else None
+    if not isinstance(entrada, dict) or not isinstance(entrada.get('actividades'), list):
+        raise ErrorFormatoRespuesta(200, "La respuesta de Claude no contiene la herramienta esperada")
     
-    # Prompt para refinar el shortcode
-    prompt = f"""
-# Tarea: Refinar un shortcode educativo existente
+    return json.dumps(entrada, ensure_ascii=False, indent=2)
 
-Necesito que refines el siguiente shortcode según las instrucciones proporcionadas:
+# Función común para ejecutar una petición de análisis (caché + streaming opcional)
+def ejecutar_solicitud_analisis(api_key, data, contenido_extra=b"", usar_cache=True,
+                                al_recibir_actividad=None, mostrar_errores=True, data_texto=None):
+    # Consultar la caché de respuestas (se omite la lectura si está desactivada y, sin huella
+    # del contenido, no se lee ni se guarda)
+    cache = obtener_cache_respuestas() if contenido_extra is not None else None
+    clave_cache = cache.calcular_clave(data, contenido_extra) if cache else None
+    if usar_cache and cache:
+        respuesta_cacheada = cache.obtener(clave_cache)
+        if respuesta_cacheada is not None:
+            return respuesta_cacheada
+    
+    # Modo streaming: las actividades se notifican según van llegando (solo con salida de texto)
+    if al_recibir_actividad is not None and 'tools' not in data:
+        respuesta_texto = analizar_en_streaming(api_key, data, al_recibir_actividad)
+        if respuesta_texto:
+            if cache:
+                cache.guardar(clave_cache, respuesta_texto)
+            return respuesta_texto
+        st.info("ℹ️ No se pudo recibir la respuesta en streaming. Repitiendo el análisis en modo normal...")
+    
+    def solicitar():
+        try:
+            respuesta_texto = solicitar_respuesta_claude(api_key, data)
+        except ErrorFormatoRespuesta:
+            # Si la salida estructurada falla, repetir con el formato de texto
+            if data_texto is None:
+                raise
+            return ejecutar_solicitud_analisis(
+                api_key, data_texto, contenido_extra, usar_cache, mostrar_errores=False
+            )
+        if cache:
+            cache.guardar(clave_cache, respuesta_texto)
+        return respuesta_texto
+    
+    # Sin mostrar_errores (p. ej. desde hilos de un lote) las excepciones se propagan
+    if not mostrar_errores:
+        return solicitar()
+    
+    try:
+        return solicitar()
+    except Exception as e:
+        mostrar_error_api(e)
+        return None
 
-## Texto original del ejercicio
-{texto_original}
+# Función para mostrar en la interfaz un error de la API de Claude
+def mostrar_error_api(e):
+    if isinstance(e, ErrorAnthropic):
+        # Mostrar información sobre el error
+        if e.status_code == 200:
+            st.error(e.detalle)
+        else:
+            st.error(f"Error en la API: Código {e.status_code}")
+            st.error(f"Detalle del error: {e.detalle}")
+    elif isinstance(e, ValueError):
+        st.error(f"Error al procesar la respuesta: {str(e)}")
+    else:
+        st.error(f"Error al comunicarse con la API: {str(e)}")
 
-## Tipo de shortcode actual
-{tipo_actividad}
+# Función para consumir el stream SSE alimentando el parser incremental
+def analizar_en_streaming(api_key, data, al_recibir_actividad):
+    cliente = obtener_cliente_anthropic()
+    parser = ParserActividadesIncremental()
+    texto_acumulado = ""
+    
+    try:
+        for continuacion in range(MAX_CONTINUACIONES + 1):
+            peticion = data
+            if continuacion:
+                texto_acumulado = texto_acumulado.rstrip()
+                peticion = construir_solicitud_continuacion(data, texto_acumulado)
+                cliente.metricas.registrar(continuaciones=1)
+            
+            stop_reason = None
+            for evento in cliente.enviar_mensaje_stream(api_key, peticion):
+                delta = evento.get("delta") or {}
+                if evento.get("type") == "content_block_delta" and delta.get("type") == "text_delta":
+                    texto_acumulado += delta["text"]
+                    for actividad in parser.alimentar(delta["text"]):
+                        al_recibir_actividad(actividad)
+                elif evento.get("type") == "message_delta":
+                    stop_reason = delta.get("stop_reason")
+            
+            # Si se cortó por max_tokens, la continuación sigue alimentando el mismo parser
+            if stop_reason != "max_tokens":
+                break
+    except (ErrorAnthropic, requests.exceptions.RequestException, ValueError):
+        # Cualquier fallo devuelve None para que se use la vía sin streaming
+        return None
+    
+    for actividad in parser.finalizar():
+        al_recibir_actividad(actividad)
+    
+    return texto_acumulado or None
 
-## Shortcode actual
-{shortcode_original}
+# Función para analizar texto con prompt adaptado
+def analizar_texto_con_prompt(api_key, texto, prompt_personalizado="", usar_cache=True,
+                              al_recibir_actividad=None, mostrar_errores=True, salida_estructurada=False):
+    # Construir la petición (prefijo estático cacheable + sufijo variable)
+    data = construir_solicitud_analisis_texto(texto, prompt_personalizado, salida_estructurada)
+    data_texto = construir_solicitud_analisis_texto(texto, prompt_personalizado) if salida_estructurada else None
+    
+    return ejecutar_solicitud_analisis(
+        api_key, data, usar_cache=usar_cache, al_recibir_actividad=al_recibir_actividad,
+        mostrar_errores=mostrar_errores, data_texto=data_texto
+    )
 
-## Instrucciones de refinamiento
-{instruccion_refinamiento}
+# Función para analizar la imagen con prompt mejorado y personalizado
+def analizar_imagen_con_prompt(api_key, image_url, prompt_personalizado="", usar_cache=True,
+                               al_recibir_actividad=None, mostrar_errores=True, salida_estructurada=False):
+    # Construir la petición (prefijo estático cacheable + sufijo variable)
+    data = construir_solicitud_analisis_imagen(image_url, prompt_personalizado, salida_estructurada)
+    data_texto = construir_solicitud_analisis_imagen(image_url, prompt_personalizado) if salida_estructurada else None
+    
+    return ejecutar_solicitud_analisis(
+        api_key, data, huella_imagen(image_url), usar_cache=usar_cache,
+        al_recibir_actividad=al_recibir_actividad, mostrar_errores=mostrar_errores, data_texto=data_texto
+    )
 
-## Tipos de shortcodes disponibles
-El shortcode debe seguir alguno de estos formatos:
-- drag-words: [drag-words words="palabra1|palabra2|palabra3" sentence="Texto con [] para rellenar" markers="palabra_correcta1|palabra_correcta2"][/drag-words]
-- multiple-choice: [multiple-choice options="opción1|opción2|opción3" correctOptions="opciónCorrecta1|opciónCorrecta2"][/multiple-choice]
-- single-choice: [single-choice options="opción1|opción2|opción3" correctOption="opciónCorrecta"][/single-choice]
-- fill-in-the-blanks: [fill-in-the-blanks text="Texto con [text|respuesta] para completar." casesensitive="false" specialcharssensitive="false"][/fill-in-the-blanks]
-- fill-in-the-blanks: [fill-in-the-blanks text="Texto con [text|respuesta_valida1#respuesta_valida2] para completar." casesensitive="false" specialcharssensitive="false"][/fill-in-the-blanks]
-- fill-in-the-blanks: [fill-in-the-blanks text="Texto con [select|Incorrecta1#*Correcta#Incorrecta2 casesensitive="false" specialcharssensitive="false"] para seleccionar."][/fill-in-the-blanks]
-- fill-in-the-blanks: [fill-in-the-blanks text="Texto [short-text|letra1][short-text|letra2][short-text|letra3]" casesensitive="false" specialcharssensitive="false"][/fill-in-the-blanks]
-- fill-in-the-blanks: [fill-in-the-blanks text="Texto: [radio|Verdadero#Falso*]" casesensitive="false" specialcharssensitive="false"][/fill-in-the-blanks]
-- statement-option-match: [statement-option-match statements="a*afirmación1|b*afirmación2" options="b*respuesta correcta para la afirmación2*descripción1 (puede no existir, si no existe no poner nada)|a*respuesta correcta para la afirmación2*descripción2 (puede no existir, si no existe no poner nada)"][/statement-option-match]
-- writing: [writing maxtime="0"][/writing]
-- oral-expression: [oral-expression autoplay="false" maxtime="0" maxplays="0" recordmode="audio"][/oral-expression]
-- file-upload: [file-upload extensions="pdf|doc|docx"][/file-upload]
-- image-choice: [image-choice images="url_imagen1*texto_alternativo1|url_imagen2*texto_alternativo2" correctOptionIndex="índice_opción_correcta"][/image-choice]
-- multi-question: [multi-question questions=""][/multi-question]
-- abnone-choice: [abnone-choice titlea="Título A" texta="Texto A" titleb="Título B" textb="Texto B" questions="a*Pregunta A|b*Pregunta B|c*Pregunta C"][/abnone-choice]
+# Función para analizar un lote de imágenes en paralelo con un pool de hilos acotado
+def procesar_lote_imagenes(api_key, urls, prompt_personalizado="", max_workers=LOTE_MAX_WORKERS,
+                           usar_cache=True, al_completar=None, salida_estructurada=False):
+    def procesar_pagina(url):
+        inicio = time.perf_counter()
+        pagina = {"url": url, "texto_respuesta": None, "resultado": None, "error": None}
+        try:
+            texto_respuesta = analizar_imagen_con_prompt(
+                api_key, url, prompt_personalizado, usar_cache,
+                mostrar_errores=False, salida_estructurada=salida_estructurada
+            )
+            pagina["texto_respuesta"] = texto_respuesta
+            pagina["resultado"] = interpretar_respuesta(texto_respuesta)
+        except Exception as e:
+            pagina["error"] = str(e)
+        pagina["segundos"] = time.perf_counter() - inicio
+        return pagina
+    
+    return ejecutar_en_paralelo(procesar_pagina, urls, max_workers, al_completar)
 
-## Instrucciones importantes
-1. Mantén el mismo tipo de shortcode a menos que la instrucción de refinamiento indique explícitamente cambiarlo
-2. Sigue EXACTAMENTE la misma estructura y símbolos separadores (|, *, #, etc.)
-3. Respeta el formato exacto de las comillas y corchetes
-4. Incorpora las mejoras solicitadas en la instrucción de refinamiento
+# Función para aplicar una función a varios elementos con un pool de hilos acotado (mantiene el orden)
+def ejecutar_en_paralelo(funcion, elementos, max_workers=LOTE_MAX_WORKERS, al_completar=None):
+    # Los hilos comparten el contexto de la ejecución para acceder a los recursos cacheados
+    ctx = get_script_run_ctx()
+    resultados = [None] * len(elementos)
+    
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(max_workers, LOTE_MAX_WORKERS_LIMITE)),
+        initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)
+    ) as executor:
+        futuros = {executor.submit(funcion, elemento): i for i, elemento in enumerate(elementos)}
+        
+        # El progreso se notifica desde el hilo principal, donde se puede usar Streamlit
+        for completados, futuro in enumerate(as_completed(futuros), start=1):
+            indice = futuros[futuro]
+            resultados[indice] = futuro.result()
+            if al_completar:
+                al_completar(completados, len(elementos), resultados[indice])
+    
+    return resultados
 
-## Formato de tu respuesta
-Proporciona tu respuesta usando exactamente este formato:
+# Función para dividir un texto largo en bloques por los límites entre ejercicios
+def dividir_texto_en_bloques(texto, max_caracteres=TEXTO_BLOQUE_MAX_CARACTERES):
+    if len(texto) <= max_caracteres:
+        return [texto]
+    
+    lineas = texto.splitlines(keepends=True)
+    
+    # Preferir encabezados explícitos ("Ejercicio 3", "Actividad 2"); si no hay, líneas numeradas ("3.", "4)")
+    limites = [i for i, linea in enumerate(lineas) if PATRON_ENCABEZADO_EJERCICIO.match(linea)]
+    if len(limites) < 2:
+        limites = [i for i, linea in enumerate(lineas) if PATRON_LINEA_NUMERADA.match(linea)]
+    if not limites:
+        return [texto]
+    
+    # Segmentos por ejercicio; el texto previo al primero (enunciado general) va con él
+    cortes = [0] + [i for i in limites if i > 0] + [len(lineas)]
+    segmentos = ["".join(lineas[inicio:fin]) for inicio, fin in zip(cortes, cortes[1:]) if inicio < fin]
+    
+    # Agrupar segmentos consecutivos sin superar el tamaño máximo por bloque
+    bloques = []
+    for segmento in segmentos:
+        if bloques and len(bloques[-1]) + len(segmento) <= max_caracteres:
+            bloques[-1] += segmento
+        else:
+            bloques.append(segmento)
+    return bloques
 
-SHORTCODE REFINADO: (escribe aquí solo el shortcode refinado completo, sin comentarios adicionales)
+# Función para volver a escribir un resultado en el formato de texto que devuelve Claude
+def formatear_respuesta_texto(resultado):
+    partes = [f"ENUNCIADO: {resultado.get('enunciado', '')}\n"]
+    for actividad in resultado.get("actividades", []):
+        partes.append(
+            f"ACTIVIDAD {actividad.get('numero')}:\n"
+            f"- Texto original: {actividad.get('texto_original', '')}\n"
+            f"- Tipo de shortcode: {actividad.get('tipo', '')}\n"
+            f"- Shortcode generado: {actividad.get('shortcode', '')}\n"
+        )
+    return "\n".join(partes)
 
-EXPLICACIÓN: (explica brevemente los cambios realizados)
-"""
+# Función para unir los resultados de varios bloques: un único enunciado y actividades renumeradas
+def combinar_resultados(resultados):
+    enunciados = [r["enunciado"] for r in resultados if r.get("enunciado") and r["enunciado"] != ENUNCIADO_NO_ENCONTRADO]
+    actividades = []
+    for resultado in resultados:
+        for actividad in resultado.get("actividades", []):
+            actividades.append(dict(actividad, numero=str(len(actividades) + 1)))
     
-    data = {
-        "model": "claude-3-7-sonnet-20250219",
-        "max_tokens": 1000,
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": prompt
-                    }
-                ]
-            }
-        ]
+    return {
+        "enunciado": enunciados[0] if enunciados else ENUNCIADO_NO_ENCONTRADO,
+        "actividades": actividades
     }
+
+# Función para analizar textos largos por bloques en paralelo (un texto corto se analiza de una vez)
+def analizar_texto_por_bloques(api_key, texto, prompt_personalizado="", usar_cache=True,
+                               al_recibir_actividad=None, max_workers=LOTE_MAX_WORKERS,
+                               salida_estructurada=False):
+    bloques = dividir_texto_en_bloques(texto)
+    if len(bloques) == 1:
+        return analizar_texto_con_prompt(
+            api_key, texto, prompt_personalizado, usar_cache, al_recibir_actividad,
+            salida_estructurada=salida_estructurada
+        )
+    
+    def analizar_bloque(bloque):
+        return analizar_texto_con_prompt(
+            api_key, bloque, prompt_personalizado, usar_cache,
+            mostrar_errores=False, salida_estructurada=salida_estructurada
+        )
+    
+    try:
+        respuestas = ejecutar_en_paralelo(analizar_bloque, bloques, max_workers)
+    except Exception as e:
+        mostrar_error_api(e)
+        return None
+    
+    # Devolver el resultado combinado en el mismo formato de texto que una respuesta única
+    resultado = combinar_resultados([interpretar_respuesta(r) for r in respuestas])
+    return formatear_respuesta_texto(resultado)
+
+# Función para leer una lista de URLs (una por línea, ignorando vacías, comentarios y duplicados)
+def parsear_lista_urls(texto):
+    lineas = (linea.strip() for linea in texto.splitlines())
+    return list(dict.fromkeys(linea for linea in lineas if linea and not linea.startswith("#")))
+
+# Función para refinar un shortcode específico
+def refinar_shortcode(api_key, shortcode_original, texto_original, tipo_actividad, instruccion_refinamiento):
+    # Construir la petición (prefijo estático cacheable + sufijo variable)
+    data = construir_solicitud_refinamiento(
+        shortcode_original, texto_original, tipo_actividad, instruccion_refinamiento
+    )
     
     try:
-        response = requests.post(url, headers=headers, json=data, timeout=60)
+        response = obtener_cliente_anthropic().enviar_mensaje(api_key, data)
         
         if response.status_code == 200:
             try:
@@ -1207,92 +3020,195 @@ EXPLICACIÓN: (explica brevemente los cambios realizados)
         return None
 # Función para extraer información de la respuesta de texto
 def extraer_informacion_texto(texto_completo):
-    resultado = {}
+    # Recorrido único por líneas: cada línea se clasifica una vez y alimenta tres máquinas de estado
+    # (enunciado, formato ACTIVIDAD N / Texto original / ..., y formato libre EJERCICIO / TIPO / SHORTCODE)
+    enunciado = None
+    fin_enunciado = False
+    actividades = []
+    actual = None
+    campo = None
+    actividades_libres = []
+    actual_libre = None
+    campo_libre = None
     
-    # Extraer el enunciado - más robusto ahora
-    match_enunciado = re.search(r'ENUNCIADO:[\s\r\n]*(.*?)(?=ACTIVIDAD|\Z)', texto_completo, re.DOTALL | re.IGNORECASE)
-    if match_enunciado:
-        resultado["enunciado"] = match_enunciado.group(1).strip()
-    else:
-        # Buscar alternativas como "Enunciado principal:" o similar
-        alt_matches = re.search(r'(?:ENUNCIADO|ENUNCIADO PRINCIPAL|INSTRUCCIÓN):[\s\r\n]*(.*?)(?=ACTIVIDAD|\Z)', texto_completo, re.DOTALL | re.IGNORECASE)
-        if alt_matches:
-            resultado["enunciado"] = alt_matches.group(1).strip()
-        else:
-            resultado["enunciado"] = "No se encontró un enunciado claro"
+    for linea in texto_completo.split("\n"):
+        match_libre = PATRON_LINEA_ACTIVIDAD_LIBRE.match(linea)
+        
+        # Enunciado: desde su etiqueta hasta el primer encabezado de actividad numerado
+        # (una línea como "Pregunta a tu compañero..." forma parte del enunciado)
+        if match_libre and match_libre.group(1):
+            fin_enunciado = True
+        elif enunciado is not None:
+            if not fin_enunciado:
+                enunciado.append(linea)
+        elif not fin_enunciado:
+            match = PATRON_LINEA_ENUNCIADO.search(linea)
+            if match:
+                enunciado = [match.group(1)]
+        
+        # Formato principal: una actividad se cierra al empezar la siguiente o al final del texto
+        match = PATRON_LINEA_ACTIVIDAD.match(linea) if match_libre else None
+        if match:
+            cerrar_actividad(actual, actividades)
+            actual = {"numero": match.group(1)}
+            campo = None
+            for campo, valor in campos_en_linea(match.group(2)):
+                actual[campo] = [valor]
+        elif actual is not None:
+            match = PATRON_LINEA_CAMPO.match(linea)
+            if match:
+                campo = CAMPOS_ACTIVIDAD[match.group(1).lower()]
+                actual[campo] = [match.group(2)]
+            elif campo:
+                actual[campo].append(linea)
+        
+        # Formato libre: solo se usa si no hay ninguna actividad con el formato principal
+        if match_libre:
+            cerrar_actividad(actual_libre, actividades_libres)
+            actual_libre = {"numero": str(len(actividades_libres) + 1), "texto_original": [match_libre.group(2)]}
+            campo_libre = "texto_original"
+        elif actual_libre is not None:
+            match = PATRON_LINEA_CAMPO_LIBRE.match(linea) if campo_libre != "shortcode" else None
+            etiqueta = match.group(1).upper() if match else None
+            if campo_libre == "texto_original" and etiqueta in ("TIPO", "SHORTCODE"):
+                campo_libre = "tipo"
+                actual_libre[campo_libre] = [match.group(2)]
+            elif campo_libre == "tipo" and etiqueta in ("SHORTCODE", "CÓDIGO"):
+                campo_libre = "shortcode"
+                actual_libre[campo_libre] = [match.group(2)]
+            else:
+                actual_libre[campo_libre].append(linea)
     
-    # Extraer actividades - patrón más robusto
-    actividades = []
+    cerrar_actividad(actual, actividades)
+    cerrar_actividad(actual_libre, actividades_libres)
     
-    # Patrón mejorado para capturar más variaciones en el formato
-    pattern = r'ACTIVIDAD\s+(\d+):\s*[\r\n]*(?:-\s*)?Texto original:[\s\r\n]*(.*?)[\r\n]*(?:-\s*)?Tipo de shortcode:[\s\r\n]*(.*?)[\r\n]*(?:-\s*)?Shortcode generado:[\s\r\n]*(.*?)(?=ACTIVIDAD\s+\d+:|\Z)'
+    enunciado = "\n".join(enunciado).strip() if enunciado is not None else ENUNCIADO_NO_ENCONTRADO
+    return {
+        "enunciado": enunciado,
+        "actividades": actividades or actividades_libres
+    }
+
+# Función para leer los campos que siguen a "ACTIVIDAD N:" en la misma línea
+def campos_en_linea(resto):
+    # "Texto original: A" o "- Texto original: A - Tipo de shortcode: radio - Shortcode generado: [...]";
+    # un título libre ("ACTIVIDAD 1: Comprensión lectora") no aporta ningún campo
+    partes = PATRON_CAMPO_EN_LINEA.split(resto)
+    if partes[0].strip():
+        return []
+    return [
+        (CAMPOS_ACTIVIDAD[partes[i].lower()], partes[i + 1].strip())
+        for i in range(1, len(partes), 2)
+    ]
+
+# Función para añadir una actividad a la lista si llegó hasta su shortcode
+def cerrar_actividad(actividad, actividades):
+    if actividad is None or "shortcode" not in actividad:
+        return
     
-    matches_actividades = re.finditer(pattern, texto_completo, re.DOTALL | re.IGNORECASE)
+    actividades.append({
+        "numero": actividad["numero"],
+        "texto_original": "\n".join(actividad.get("texto_original", [])).strip(),
+        "tipo": "\n".join(actividad.get("tipo", [])).strip(),
+        "shortcode": "\n".join(actividad["shortcode"]).strip()
+    })
+
+# Función para convertir una respuesta de Claude (JSON de la herramienta o texto) en el resultado
+def interpretar_respuesta(texto_respuesta):
+    # La salida estructurada se decodifica directamente; el texto libre se parsea como siempre
+    if texto_respuesta.lstrip().startswith("{"):
+        try:
+            entrada = json.loads(texto_respuesta)
+        except ValueError:
+            entrada = None
+        if isinstance(entrada, dict) and isinstance(entrada.get("actividades"), list):
+            return {
+                "enunciado": (entrada.get("enunciado") or "").strip() or ENUNCIADO_NO_ENCONTRADO,
+                "actividades": [
+                    {
+                        "numero": str(i + 1),
+                        "texto_original": str(actividad.get("texto_original", "")).strip(),
+                        "tipo": str(actividad.get("tipo", "")).strip(),
+                        "shortcode": str(actividad.get("shortcode", "")).strip()
+                    }
+                    for i, actividad in enumerate(entrada["actividades"])
+                    if isinstance(actividad, dict)
+                ]
+            }
     
-    for match in matches_actividades:
-        num_actividad = match.group(1)
-        texto_original = match.group(2).strip()
-        tipo = match.group(3).strip()
-        shortcode = match.group(4).strip()
+    return extraer_informacion_texto(texto_respuesta)
+
+class ParserActividadesIncremental:
+    """Parser incremental que emite cada ACTIVIDAD en cuanto su shortcode está completo"""
+
+    def __init__(self):
+        self.pendiente = ""
+        self.enunciado = None
+        self.actual = None
+        self.campo = None
+        self.emitida = False
+
+    def alimentar(self, fragmento: str) -> List[Dict]:
+        """Añadir texto recibido y devolver las actividades que se han completado"""
+        self.pendiente += fragmento
+        *lineas, self.pendiente = self.pendiente.split("\n")
+        emitidas = []
+        for linea in lineas:
+            actividad = self._procesar_linea(linea.rstrip("\r"))
+            if actividad:
+                emitidas.append(actividad)
+        return emitidas
+
+    def finalizar(self) -> List[Dict]:
+        """Procesar la última línea y emitir la actividad pendiente, si la hay"""
+        emitidas = self.alimentar("\n")
+        if self.actual and not self.emitida and self.actual.get("shortcode"):
+            self.emitida = True
+            emitidas.append(dict(self.actual))
+        return emitidas
+
+    def _procesar_linea(self, linea: str) -> Optional[Dict]:
+        match = PATRON_LINEA_ACTIVIDAD.match(linea)
+        if match:
+            self.actual = {"numero": match.group(1), "texto_original": "", "tipo": "", "shortcode": ""}
+            self.campo = None
+            self.emitida = False
+            for self.campo, valor in campos_en_linea(match.group(2)):
+                self.actual[self.campo] = valor
+            return self._actividad_completa()
         
-        actividades.append({
-            "numero": num_actividad,
-            "texto_original": texto_original,
-            "tipo": tipo,
-            "shortcode": shortcode
-        })
-    
-    # Si no encontramos actividades con el patrón anterior, intentar un patrón alternativo
-    if not actividades:
-        alt_pattern = r'(?:ACTIVIDAD|EJERCICIO|PREGUNTA)\s*(?:\d+)?:?\s*(.*?)[\r\n]+(?:TIPO|SHORTCODE):?\s*(.*?)[\r\n]+(?:SHORTCODE|CÓDIGO):?\s*(.*?)(?=(?:ACTIVIDAD|EJERCICIO|PREGUNTA)|\Z)'
-        alt_matches = re.finditer(alt_pattern, texto_completo, re.DOTALL | re.IGNORECASE)
+        if self.actual is None:
+            match = PATRON_LINEA_ENUNCIADO.search(linea)
+            if match:
+                self.enunciado = match.group(1).strip()
+            elif self.enunciado is not None and linea.strip():
+                self.enunciado = (self.enunciado + "\n" + linea.strip()).strip()
+            return None
         
-        for i, match in enumerate(alt_matches):
-            texto_original = match.group(1).strip()
-            tipo = match.group(2).strip()
-            shortcode = match.group(3).strip()
-            
-            actividades.append({
-                "numero": str(i+1),
-                "texto_original": texto_original,
-                "tipo": tipo,
-                "shortcode": shortcode
-            })
-    
-    resultado["actividades"] = actividades
-    
-    return resultado
+        match = PATRON_LINEA_CAMPO.match(linea)
+        if match:
+            self.campo = CAMPOS_ACTIVIDAD[match.group(1).lower()]
+            self.actual[self.campo] = match.group(2).strip()
+        elif self.campo and linea.strip() and not self.emitida:
+            self.actual[self.campo] = (self.actual[self.campo] + "\n" + linea.strip()).strip()
+        
+        return self._actividad_completa()
+
+    def _actividad_completa(self) -> Optional[Dict]:
+        # La actividad está completa cuando termina la línea del shortcode generado
+        if self.campo == "shortcode" and self.actual["shortcode"] and not self.emitida:
+            self.emitida = True
+            return dict(self.actual)
+        return None
 
 # Función para generar el archivo de texto descargable
 def generate_download_text(resultado):
     if not resultado or "enunciado" not in resultado or "actividades" not in resultado:
         return None
     
-    # Iniciar con el enunciado principal
-    texto = f"ENUNCIADO Principal\n{resultado['enunciado']}\n\n"
-    
-    # Añadir cada actividad
-    for actividad in resultado["actividades"]:
-        numero = actividad.get("numero", "")
-        
-        # Obtener la versión más reciente del shortcode si existe en el historial
-        shortcode = actividad.get("shortcode", "")
-        actividad_key = f"actividad_{numero}"
-        if actividad_key in st.session_state.shortcode_versions and st.session_state.shortcode_versions[actividad_key]:
-            # Usar la versión más reciente
-            versiones = st.session_state.shortcode_versions[actividad_key]
-            if versiones:
-                shortcode = versiones[-1]["shortcode"]
-        
-        texto += f"ENUNCIADO Pregunta {numero}\n{actividad.get('texto_original', '')}\n\n"
-        texto += f"SHORTCODE Pregunta {numero}\n{shortcode}\n\n"
-    
-    return texto
-
-# Función para crear datos de descarga
-def get_download_data(text, filename="resultados_analisis.txt"):
-    b64 = base64.b64encode(text.encode()).decode()
-    return b64, filename
+    # Con la versión más reciente de cada shortcode
+    salida = io.StringIO()
+    escribir_exportacion_texto(resultado, obtener_almacen_versiones(), salida)
+    return salida.getvalue()
 
 # Función para agregar entrada al historial
 def agregar_a_historial(evento, detalles=None):
@@ -1302,30 +3218,461 @@ def agregar_a_historial(evento, detalles=None):
         "evento": evento,
         "detalles": detalles
     }
-    st.session_state.conversation_history.append(entrada)
+    obtener_historial().agregar(entrada)
 
 # Función para guardar una nueva versión de un shortcode
 def guardar_version_shortcode(actividad_num, shortcode, explicacion=None):
-    # Asegurarse de que shortcode_versions existe en la sesión
-    if 'shortcode_versions' not in st.session_state:
-        st.session_state.shortcode_versions = {}
+    # Guardar la nueva versión con timestamp en el almacén de la sesión y en el del proyecto
+    almacen = obtener_almacen_versiones()
+    version = almacen.guardar(actividad_num, shortcode, explicacion)
+    proyecto = obtener_proyecto_actual()
+    if proyecto and almacen.resultado:
+        obtener_almacen_proyectos().guardar_version(proyecto, almacen.resultado, actividad_num, version)
+
+# Función para guardar como nueva versión la reparación automática de un shortcode, si hace falta
+def guardar_version_reparada(actividad_num, shortcode):
+    reparado, reparaciones = reparar_shortcode(shortcode or "")
+    if not reparaciones:
+        return False
+    
+    guardar_version_shortcode(
+        actividad_num,
+        reparado,
+        "Reparación automática: " + "; ".join(reparaciones)
+    )
+    return True
+
+# Función para establecer el resultado activo y guardar la versión inicial de sus shortcodes
+# (con conservar_versiones, un resultado ya abierto antes, como una página del lote, recupera las suyas)
+def cargar_resultado_activo(texto_respuesta, resultado, conservar_versiones=False):
+    # El resultado y la respuesta completa solo se guardan en el almacén del proyecto; la sesión
+    # guarda la huella del resultado y ambos se leen al mostrarlos
+    proyecto = obtener_proyecto_actual(crear=True)
+    obtener_almacen_proyectos().guardar_resultado(proyecto, texto_respuesta, resultado)
+    st.session_state.resultado_activo = huella_resultado(resultado)
+    if conservar_versiones and obtener_almacen_versiones().actividades:
+        return
+    
+    descartar_versiones(proyecto, st.session_state.resultado_activo)
+    for actividad in resultado.get("actividades", []):
+        guardar_version_shortcode(
+            actividad.get("numero"), 
+            actividad.get("shortcode")
+        )
+        guardar_version_reparada(actividad.get("numero"), actividad.get("shortcode"))
+
+# Panel de una actividad del resultado. Es un fragmento: refinar una actividad solo vuelve a
+# ejecutar su panel, no toda la página (el bloque conjunto se actualiza en la siguiente recarga completa)
+@st.fragment
+def mostrar_panel_actividad(actividad, num_actividad, api_key):
+    with st.expander(f"Actividad {num_actividad}", expanded=False):
+        st.markdown("**Texto original:**")
+        texto_original = actividad.get("texto_original", "")
+        st.write(texto_original)
+        
+        st.markdown("**Tipo de shortcode:**")
+        tipo_actual = actividad.get("tipo", "")
+        st.code(tipo_actual)
+        
+        # Mostrar shortcode actual
+        st.markdown("**Shortcode actual:**")
+        
+        # Obtener la versión más reciente del shortcode si existe
+        almacen = obtener_almacen_versiones()
+        shortcode_actual = almacen.shortcode_actual(actividad)
+        
+        st.code(shortcode_actual, language="html")
+        
+        # Validación local del shortcode (antes de refinar o publicar)
+        problemas_shortcode = validar_shortcode(shortcode_actual)
+        if problemas_shortcode:
+            st.warning("⚠️ Problemas detectados en el shortcode:\n" + "\n".join(f"- {p}" for p in problemas_shortcode))
+        else:
+            st.caption("✅ Shortcode válido")
+        
+        # Historial de versiones del shortcode: solo se reconstruye al abrirlo
+        num_versiones = almacen.num_versiones(num_actividad)
+        if num_versiones > 1 and st.toggle(
+            f"Ver historial de versiones ({num_versiones})",
+            key=f"historial_{num_actividad}_{st.session_state.session_id}"
+        ):
+            versiones = almacen.versiones(num_actividad)
+            version_tabs = st.tabs([f"V{version['numero']}" for version in versiones])
+            for tab, version in zip(version_tabs, versiones):
+                with tab:
+                    st.write(f"**Versión {version['numero']}** - {version['timestamp']}")
+                    st.code(version['shortcode'], language="html")
+                    if version.get('explicacion'):
+                        st.write(f"*Explicación:* {version['explicacion']}")
+        
+        # Área para refinar el shortcode
+        st.markdown("**Refinar este shortcode:**")
+        st.caption("Las comillas tipográficas, las etiquetas de cierre y los atributos dentro de huecos se reparan automáticamente; usa Refinar para cambios de contenido.")
+        instruccion_refinamiento = st.text_area(
+            "Instrucciones de refinamiento", 
+            key=f"refine_{num_actividad}_{st.session_state.session_id}",
+            help="Especifica cómo quieres mejorar o modificar este shortcode"
+        )
+        
+        if st.button("Refinar", key=f"btn_refine_{num_actividad}_{st.session_state.session_id}"):
+            if not api_key:
+                st.error("Se requiere una clave API para refinar el shortcode.")
+            elif not instruccion_refinamiento:
+                st.warning("Por favor, proporciona instrucciones sobre cómo refinar el shortcode.")
+            else:
+                with st.spinner("Refinando shortcode con Claude 4..."):
+                    # Obtener resultado de refinamiento
+                    resultado_refinamiento = refinar_shortcode(
+                        api_key, 
+                        shortcode_actual, 
+                        texto_original, 
+                        tipo_actual, 
+                        instruccion_refinamiento
+                    )
+                    
+                    if resultado_refinamiento and resultado_refinamiento["shortcode"]:
+                        # Guardar nueva versión
+                        guardar_version_shortcode(
+                            num_actividad, 
+                            resultado_refinamiento["shortcode"],
+                            resultado_refinamiento.get("explicacion")
+                        )
+                        guardar_version_reparada(num_actividad, resultado_refinamiento["shortcode"])
+                        
+                        # Agregar al historial
+                        agregar_a_historial(
+                            f"Refinamiento de Actividad {num_actividad} con Claude 4", 
+                            f"Instrucción: {instruccion_refinamiento}\nExplicación: {resultado_refinamiento.get('explicacion', 'No proporcionada')}"
+                        )
+                        
+                        # Volver a ejecutar solo este panel para mostrar el shortcode actualizado
+                        st.rerun(scope="fragment")
+                    else:
+                        st.error("No se pudo refinar el shortcode. Inténtalo de nuevo.")
+
+# Función para obtener la etiqueta de apertura de un shortcode (para filtrar por tipo)
+def etiqueta_shortcode(shortcode):
+    match = PATRON_ETIQUETA_APERTURA.match(shortcode or "")
+    return match.group(1) if match else "(sin etiqueta)"
+
+# Función para filtrar las actividades por tipo de shortcode y validez de su versión actual
+def filtrar_actividades(actividades, almacen, tipos=None, validez="Todas"):
+    filtradas = []
+    for i, actividad in enumerate(actividades):
+        shortcode = almacen.shortcode_actual(actividad)
+        if tipos and etiqueta_shortcode(shortcode) not in tipos:
+            continue
+        # La validación solo se ejecuta si se filtra por validez
+        if validez != "Todas" and (not validar_shortcode(shortcode)) != (validez == "Válidos"):
+            continue
+        filtradas.append((actividad.get("numero", i+1), actividad))
+    return filtradas
+
+# Función para mostrar el resumen de un lote y elegir la página activa
+def mostrar_resultados_lote():
+    paginas = st.session_state.resultados_lote
+    correctas = [p for p in paginas if p["resultado"] is not None]
+    
+    st.subheader("Resultados del lote")
+    st.caption(f"{len(correctas)} de {len(paginas)} páginas procesadas correctamente")
+    st.dataframe(
+        pd.DataFrame([{
+            "Página": i + 1,
+            "URL": p["url"],
+            "Estado": "✅" if p["resultado"] is not None else f"❌ {p['error']}",
+            "Actividades": len(p["resultado"]["actividades"]) if p["resultado"] else 0,
+            "Segundos": round(p["segundos"], 1)
+        } for i, p in enumerate(paginas)]),
+        hide_index=True,
+        use_container_width=True
+    )
     
-    actividad_key = f"actividad_{actividad_num}"
+    if correctas:
+        opciones = {f"Página {i + 1}: {p['url']}": p for i, p in enumerate(paginas) if p["resultado"] is not None}
+        seleccion = st.selectbox("Página a revisar, refinar y publicar", list(opciones.keys()), key="pagina_lote")
+        if st.button("📄 Abrir página seleccionada"):
+            pagina = opciones[seleccion]
+            cargar_resultado_activo(pagina["texto_respuesta"], pagina["resultado"], conservar_versiones=True)
+            agregar_a_historial("Página del lote abierta", f"URL: {pagina['url']}")
+            st.rerun()
+
+# Función para crear el callback que pinta las actividades recibidas en streaming
+def crear_vista_previa_streaming(contenedor):
+    contenedor.subheader("Actividades recibidas")
     
-    if actividad_key not in st.session_state.shortcode_versions:
-        st.session_state.shortcode_versions[actividad_key] = []
+    def al_recibir_actividad(actividad):
+        with contenedor.expander(f"Actividad {actividad['numero']} · {actividad.get('tipo', '')}", expanded=False):
+            st.write(actividad.get("texto_original", ""))
+            st.code(actividad.get("shortcode", ""), language="html")
     
-    # Guardar la nueva versión con timestamp
-    st.session_state.shortcode_versions[actividad_key].append({
-        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "shortcode": shortcode,
-        "explicacion": explicacion
-    })
+    return al_recibir_actividad
+
+# ============================================================================
+# EXPORTACIÓN DE RESULTADOS
+# ============================================================================
+
+# Formatos de exportación: etiqueta -> (extensión, tipo MIME)
+FORMATOS_EXPORTACION = {
+    "Texto (.txt)": ("txt", "text/plain"),
+    "JSON Lines (.jsonl)": ("jsonl", "application/x-ndjson"),
+    "CSV (.csv)": ("csv", "text/csv")
+}
+
+def filas_exportacion(resultado: Dict, almacen: AlmacenVersiones) -> Iterator[Dict]:
+    """Una fila por actividad con la versión actual de su shortcode"""
+    for actividad in resultado.get("actividades", []):
+        yield {
+            "enunciado": resultado.get("enunciado", ""),
+            "numero": actividad.get("numero", ""),
+            "tipo": actividad.get("tipo", ""),
+            "texto_original": actividad.get("texto_original", ""),
+            "shortcode": almacen.shortcode_actual(actividad)
+        }
+
+def escribir_exportacion_texto(resultado: Dict, almacen: AlmacenVersiones, salida: io.TextIOBase):
+    """Formato de texto de descarga (el que lee parsear_texto_descarga)"""
+    salida.write(f"ENUNCIADO Principal\n{resultado.get('enunciado', '')}\n\n")
+    for fila in filas_exportacion(resultado, almacen):
+        salida.write(f"ENUNCIADO Pregunta {fila['numero']}\n{fila['texto_original']}\n\n")
+        salida.write(f"SHORTCODE Pregunta {fila['numero']}\n{fila['shortcode']}\n\n")
+
+def escribir_exportacion_jsonl(resultado: Dict, almacen: AlmacenVersiones, salida: io.TextIOBase):
+    for fila in filas_exportacion(resultado, almacen):
+        salida.write(json.dumps(fila, ensure_ascii=False) + "\n")
+
+def escribir_exportacion_csv(resultado: Dict, almacen: AlmacenVersiones, salida: io.TextIOBase):
+    columnas = ["enunciado", "numero", "tipo", "texto_original", "shortcode"]
+    pd.DataFrame(filas_exportacion(resultado, almacen), columns=columnas).to_csv(salida, index=False)
+
+ESCRITORES_EXPORTACION = {
+    "txt": escribir_exportacion_texto,
+    "jsonl": escribir_exportacion_jsonl,
+    "csv": escribir_exportacion_csv
+}
+
+def exportar_resultado(resultado: Dict, almacen: AlmacenVersiones, extension: str) -> bytes:
+    salida = io.StringIO()
+    ESCRITORES_EXPORTACION[extension](resultado, almacen, salida)
+    return salida.getvalue().encode("utf-8")
+
+def exportar_paquete_zip(resultados: List[Tuple[str, Dict, AlmacenVersiones]], extension: str) -> bytes:
+    """Comprimir varios resultados en un ZIP; cada uno se escribe directamente en su entrada"""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as paquete:
+        for nombre, resultado, almacen in resultados:
+            with paquete.open(f"{nombre}.{extension}", "w") as entrada:
+                with io.TextIOWrapper(entrada, encoding="utf-8", newline="") as salida:
+                    ESCRITORES_EXPORTACION[extension](resultado, almacen, salida)
+    return buffer.getvalue()
+
+def resultados_paquete(resultado: Dict, almacen: AlmacenVersiones, paginas_lote: Optional[List[Dict]],
+                       proyecto: Optional[str] = None) -> List[Tuple[str, Dict, AlmacenVersiones]]:
+    """Resultado activo y páginas correctas del último lote, cada una con las versiones guardadas en el proyecto"""
+    resultados = [("resultado_activo", resultado, almacen)]
+    for i, pagina in enumerate(paginas_lote or []):
+        if pagina["resultado"] is None:
+            continue
+        huella = huella_resultado(pagina["resultado"])
+        if huella != almacen.resultado:
+            resultados.append((f"pagina_{i + 1:03d}", pagina["resultado"], cargar_almacen_versiones(proyecto, huella) if proyecto else AlmacenVersiones()))
+    return resultados
+
+def mostrar_exportacion(resultado: Dict, nombre_archivo: str):
+    """Botones de descarga: el archivo solo se genera cuando se pulsa el botón"""
+    almacen = obtener_almacen_versiones()
+    formato = st.radio("Formato", list(FORMATOS_EXPORTACION), horizontal=True, key="formato_exportacion")
+    extension, mime = FORMATOS_EXPORTACION[formato]
+    base_nombre = os.path.splitext(nombre_archivo)[0] or "resultados_analisis"
+    
+    st.download_button(
+        "📥 Descargar Resultados",
+        data=lambda: exportar_resultado(resultado, almacen, extension),
+        file_name=f"{base_nombre}.{extension}",
+        mime=mime,
+        on_click="ignore",
+        type="primary"
+    )
+    
+    paginas_lote = st.session_state.resultados_lote
+    if paginas_lote and any(p["resultado"] is not None for p in paginas_lote):
+        proyecto = obtener_proyecto_actual()
+        st.download_button(
+            "🗜️ Descargar resultado y lote (.zip)",
+            data=lambda: exportar_paquete_zip(
+                resultados_paquete(resultado, almacen, paginas_lote, proyecto), extension
+            ),
+            file_name=f"{base_nombre}.zip",
+            mime="application/zip",
+            on_click="ignore"
+        )
+    
+    # Vista previa generada solo bajo demanda
+    if st.toggle("Vista previa del archivo de descarga", key="vista_previa_exportacion"):
+        st.text(exportar_resultado(resultado, almacen, extension).decode("utf-8"))
+
+# ============================================================================
+# AUDITORÍA DE CATÁLOGOS DE SHORTCODES
+# ============================================================================
+
+PATRON_BLOQUE_DESCARGA = re.compile(r'^(ENUNCIADO|SHORTCODE) Pregunta (\S+)$')
+PATRON_HUECO_CATALOGO = r'\[(?:text|short-text|select|radio)\|'
+
+def parsear_texto_descarga(texto: str) -> Dict:
+    """Leer un archivo generado por generate_download_text y devolver el resultado equivalente"""
+    resultado = {"enunciado": "", "actividades": []}
+    actividades = {}
+    bloque = None
+    lineas_bloque = []
+    
+    def cerrar_bloque():
+        if bloque is None:
+            return
+        contenido = "\n".join(lineas_bloque).strip()
+        if bloque[0] == "principal":
+            resultado["enunciado"] = contenido
+        else:
+            actividad = actividades.setdefault(bloque[1], {"numero": bloque[1], "texto_original": "", "tipo": "", "shortcode": ""})
+            actividad["texto_original" if bloque[0] == "ENUNCIADO" else "shortcode"] = contenido
+    
+    for linea in texto.split("\n"):
+        linea_limpia = linea.rstrip("\r")
+        match = PATRON_BLOQUE_DESCARGA.match(linea_limpia)
+        if match or linea_limpia == "ENUNCIADO Principal":
+            cerrar_bloque()
+            bloque = (match.group(1), match.group(2)) if match else ("principal", None)
+            lineas_bloque = []
+        elif bloque is not None:
+            lineas_bloque.append(linea_limpia)
+    cerrar_bloque()
+    
+    resultado["actividades"] = list(actividades.values())
+    return resultado
+
+def cargar_catalogo(archivos: List[Any], paginas_lote: Optional[List[Dict]] = None) -> pd.DataFrame:
+    """Reunir en un DataFrame (una fila por shortcode) archivos descargados y resultados guardados"""
+    filas = []
+    
+    def añadir(origen, resultado):
+        for actividad in resultado.get("actividades", []):
+            filas.append((origen, str(actividad.get("numero", "")), actividad.get("texto_original", ""), actividad.get("shortcode", "")))
+    
+    for archivo in archivos:
+        texto = archivo.getvalue().decode("utf-8", errors="replace")
+        # Archivos de descarga de esta aplicación o respuestas de Claude guardadas (texto o JSON)
+        if "\nSHORTCODE Pregunta " in texto or texto.startswith("SHORTCODE Pregunta "):
+            añadir(archivo.name, parsear_texto_descarga(texto))
+        else:
+            añadir(archivo.name, interpretar_respuesta(texto))
+    
+    for pagina in paginas_lote or []:
+        if pagina.get("resultado"):
+            añadir(pagina["url"], pagina["resultado"])
+    
+    return pd.DataFrame(filas, columns=["origen", "numero", "texto_original", "shortcode"])
+
+def auditar_catalogo(catalogo: pd.DataFrame) -> pd.DataFrame:
+    """Añadir al catálogo tipo, recuentos (operaciones vectorizadas) y validez según validar_shortcode"""
+    df = catalogo.copy()
+    shortcode = df["shortcode"].fillna("").astype(str).str.strip()
+    
+    # Tipo: etiqueta de apertura
+    df["etiqueta"] = shortcode.str.extract(r'^\[([\w-]+)', expand=False)
+    df["tipo"] = df["etiqueta"].map(TIPOS_EDIBLOCKS).fillna("text")
+    df["tipo_conocido"] = df["etiqueta"].isin(TIPOS_SHORTCODE)
+    
+    # Opciones de los tipos de selección
+    opciones = shortcode.str.extract(r'\soptions="([^"]*)"', expand=False)
+    df["num_opciones"] = (opciones.str.count(r'\|') + 1).fillna(0).astype(int)
+    
+    # Huecos: [text|...], [select|...], etc. en fill-in-the-blanks y [] en drag-words
+    df["num_huecos"] = shortcode.str.count(PATRON_HUECO_CATALOGO) + shortcode.str.count(r'\[\]')
+    
+    # Duplicados (ignorando diferencias de espacios)
+    normalizado = shortcode.str.replace(r'\s+', ' ', regex=True)
+    df["duplicado"] = normalizado.duplicated(keep=False) & (normalizado != "")
+    
+    # Validez con validar_shortcode, una vez por shortcode distinto
+    unicos = shortcode.drop_duplicates()
+    validos = pd.Series([not validar_shortcode(s) for s in unicos], index=unicos.to_numpy())
+    df["valido"] = shortcode.map(validos).astype(bool)
+    return df
+
+def resumir_auditoria(auditoria: pd.DataFrame) -> pd.DataFrame:
+    """Resumen por tipo de shortcode de un catálogo auditado"""
+    resumen = auditoria.groupby("tipo").agg(
+        shortcodes=("shortcode", "size"),
+        validos=("valido", "sum"),
+        duplicados=("duplicado", "sum"),
+        media_opciones=("num_opciones", "mean"),
+        media_huecos=("num_huecos", "mean")
+    )
+    resumen["porcentaje_validos"] = (100 * resumen["validos"] / resumen["shortcodes"]).round(1)
+    return resumen.sort_values("shortcodes", ascending=False).round(2)
+
+def mostrar_auditoria_catalogo():
+    """Sección de auditoría masiva de shortcodes (archivos descargados y resultados del lote)"""
+    archivos = st.file_uploader(
+        "Archivos de resultados (.txt descargados o respuestas de Claude guardadas)",
+        type=["txt", "json"],
+        accept_multiple_files=True,
+        key="archivos_catalogo"
+    )
+    incluir_lote = st.checkbox("Incluir los resultados del último lote", value=bool(st.session_state.resultados_lote))
+    
+    if st.button("🔎 Auditar catálogo"):
+        catalogo = cargar_catalogo(archivos or [], st.session_state.resultados_lote if incluir_lote else None)
+        if catalogo.empty:
+            st.warning("No se encontraron shortcodes en los archivos seleccionados.")
+            st.session_state.auditoria_catalogo = None
+        else:
+            inicio = time.perf_counter()
+            st.session_state.auditoria_catalogo = auditar_catalogo(catalogo)
+            agregar_a_historial(
+                "Auditoría de catálogo",
+                f"{len(catalogo)} shortcodes auditados en {time.perf_counter() - inicio:.2f} s"
+            )
+    
+    auditoria = st.session_state.auditoria_catalogo
+    if auditoria is None:
+        return
+    
+    invalidos = auditoria[~auditoria["valido"]]
+    c1, c2, c3, c4 = st.columns(4)
+    c1.metric("Shortcodes", len(auditoria))
+    c2.metric("Válidos", f"{auditoria['valido'].mean():.1%}")
+    c3.metric("Duplicados", int(auditoria["duplicado"].sum()))
+    c4.metric("Orígenes", auditoria["origen"].nunique())
+    
+    st.markdown("**Resumen por tipo**")
+    st.dataframe(resumir_auditoria(auditoria), use_container_width=True)
+    
+    if not invalidos.empty:
+        st.markdown(f"**Shortcodes con problemas ({len(invalidos)})**")
+        st.dataframe(
+            invalidos[["origen", "numero", "tipo", "shortcode"]].head(1000),
+            use_container_width=True,
+            hide_index=True
+        )
+    
+    # El CSV solo se genera cuando se pulsa el botón
+    st.download_button(
+        "📥 Descargar auditoría (CSV)",
+        data=lambda: auditoria.to_csv(index=False).encode("utf-8"),
+        file_name="auditoria_shortcodes.csv",
+        mime="text/csv",
+        on_click="ignore"
+    )
 
 # ============================================================================
 # INTERFAZ PRINCIPAL ACTUALIZADA
 # ============================================================================
 
+# Reanudar el proyecto indicado en la URL (tras recargar la página o un redespliegue)
+if 'proyecto_id' not in st.session_state and st.query_params.get("proyecto"):
+    if not reanudar_proyecto(st.query_params["proyecto"]):
+        st.session_state.proyecto_id = None
+        st.query_params.pop("proyecto", None)
+
 # Configuración de la app
 st.title("🔄 Conversor de Ejercicios a Shortcodes + EdiBlocks")
 st.markdown("### Extracción automática de ejercicios desde imágenes y texto plano + Publicación en EdiBlocks")
@@ -1345,20 +3692,72 @@ with st.sidebar:
     if api_key != st.session_state.api_key_saved:
         st.session_state.api_key_saved = api_key
     
+    # Estado de la cola compartida de peticiones a Claude
+    estado_limitador = obtener_cliente_anthropic().limitador.estado()
+    if estado_limitador["en_cola"]:
+        st.caption(
+            f"⏳ Cola de Claude: {estado_limitador['en_cola']} peticiones de "
+            f"{estado_limitador['sesiones']} sesiones · espera estimada {estado_limitador['espera_estimada']:.0f}s"
+        )
+    else:
+        st.caption(f"✅ Cola de Claude vacía · espera estimada {estado_limitador['espera_estimada']:.0f}s")
+    
     # Opciones avanzadas - minimizadas por defecto
     with st.expander("Opciones avanzadas"):
         mostrar_respuesta_completa = st.checkbox("Mostrar respuesta completa", value=False)
         mostrar_tipologias = st.checkbox("Mostrar ejemplos de tipologías", value=False)
+        salida_estructurada = st.checkbox(
+            "Salida estructurada (JSON)",
+            value=False,
+            help="Pide a Claude el resultado como JSON con esquema en lugar de texto libre. Si no lo devuelve, se usa el formato de texto."
+        )
+        usar_streaming = st.checkbox(
+            "Mostrar actividades según se generan (streaming)",
+            value=True,
+            help="Muestra cada actividad en cuanto Claude termina su shortcode. Si el streaming falla se usa el modo normal."
+        )
         nombre_archivo = st.text_input("Nombre del archivo de descarga", value="resultados_analisis.txt")
         
+        # Caché persistente de respuestas de Claude
+        usar_cache_respuestas = st.checkbox(
+            "Usar caché de respuestas",
+            value=True,
+            help="Reutiliza el análisis guardado si la imagen/texto, el prompt y el modelo no han cambiado. Desactívalo para forzar una nueva llamada a Claude."
+        )
+        estadisticas_cache = obtener_cache_respuestas().estadisticas()
+        st.caption(f"Caché: {estadisticas_cache['entradas']} respuestas ({estadisticas_cache['bytes'] / 1024:.1f} KB)")
+        if st.button("🗑️ Vaciar caché de respuestas"):
+            obtener_cache_respuestas().limpiar()
+            agregar_a_historial("Caché de respuestas vaciada")
+            st.rerun()
+        
+        # Uso de la caché de prompts de Anthropic (prefijo estático de los prompts)
+        metricas = obtener_cliente_anthropic().metricas.resumen()
+        st.caption(
+            f"Caché de prompts: {metricas['tasa_acierto_cache']:.0%} de tokens de entrada leídos de caché "
+            f"({metricas['cache_read_input_tokens']} leídos, {metricas['cache_creation_input_tokens']} escritos). "
+            f"Latencia media: {metricas['latencia_media_con_cache_leida']:.1f}s con caché / "
+            f"{metricas['latencia_media_sin_cache_leida']:.1f}s sin caché"
+        )
+        
+        # Reintentos ante errores transitorios
+        reintentos_claude = obtener_cliente_anthropic().reintentos.resumen()
+        reintentos_ediblocks = obtener_reintentos_ediblocks().resumen()
+        st.caption(
+            f"Reintentos: Claude {reintentos_claude['reintentos']} "
+            f"({reintentos_claude['segundos_espera']:.1f}s de espera, {reintentos_claude['agotados']} agotados) · "
+            f"EdiBlocks {reintentos_ediblocks['reintentos']} "
+            f"({reintentos_ediblocks['segundos_espera']:.1f}s de espera, {reintentos_ediblocks['agotados']} agotados)"
+        )
+        
         # Botón para reiniciar todo el estado de la aplicación
         if st.button("🔄 Reiniciar toda la aplicación"):
-            # Limpiar todas las variables de estado
+            # Limpiar todas las variables de estado (y el historial volcado a disco)
+            obtener_historial().limpiar()
             for key in list(st.session_state.keys()):
                 del st.session_state[key]
             # Inicializar las variables necesarias
-            st.session_state.conversation_history = []
-            st.session_state.shortcode_versions = {}
+            st.session_state.conversation_history = HistorialAcciones()
             st.session_state.current_image_url = None
             st.session_state.current_text_content = ""
             st.session_state.temp_text_content = ""
@@ -1366,7 +3765,9 @@ with st.sidebar:
             st.session_state.prompt_personalizado = ""
             st.session_state.api_key_saved = ""
             st.session_state.session_id = str(int(time.time()))
-            st.session_state.resultado = None
+            st.session_state.resultado_activo = None
+            st.session_state.resultados_lote = None
+            st.session_state.auditoria_catalogo = None
             # Variables EdiBlocks
             st.session_state.ediblocks_config = {
                 'base_url': EDIBLOCKS_BASE_URL,
@@ -1374,7 +3775,9 @@ with st.sidebar:
                 'organization_id': 1
             }
             st.session_state.available_tags = []
-            st.session_state.publication_history = []
+            # Empezar un proyecto nuevo (el anterior sigue guardado y se puede reanudar con su enlace)
+            st.session_state.proyecto_id = None
+            st.query_params.pop("proyecto", None)
             # Agregar registro al historial
             timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             entrada = {
@@ -1382,20 +3785,29 @@ with st.sidebar:
                 "evento": "Reinicio completo de la aplicación",
                 "detalles": "Se ha reiniciado el estado completo de la aplicación"
             }
-            st.session_state.conversation_history = [entrada]
+            st.session_state.conversation_history.agregar(entrada)
             # Recargar la página
             st.rerun()
     
     # Historial de acciones
     st.header("Historial")
     with st.expander("Ver historial de acciones", expanded=True):
-        if st.session_state.conversation_history:
-            for entrada in reversed(st.session_state.conversation_history):
+        historial = obtener_historial()
+        if len(historial):
+            # Solo se muestra una página de entradas en cada ejecución
+            paginas_historial = historial.num_paginas(HISTORIAL_POR_PAGINA)
+            pagina_historial = 1
+            if paginas_historial > 1:
+                pagina_historial = st.number_input(
+                    "Página", min_value=1, max_value=paginas_historial, value=1, key="pagina_historial"
+                )
+            for entrada in historial.pagina(pagina_historial - 1, HISTORIAL_POR_PAGINA):
                 with st.container():
                     st.write(f"**{entrada['timestamp']}**: {entrada['evento']}")
                     if entrada['detalles']:
                         st.caption(entrada['detalles'])
                     st.divider()
+            st.caption(f"{len(historial)} acciones · página {pagina_historial} de {paginas_historial}")
         else:
             st.info("No hay historial de acciones aún.")
 
@@ -1407,10 +3819,11 @@ if 'mostrar_tipologias' in locals() and mostrar_tipologias:
             st.code(tipo['sample'], language="html")
 
 # Selector de tipo de entrada
-input_type_options = ["URL de imagen", "Texto plano"]
+input_type_options = ["URL de imagen", "Texto plano", "Lote de URLs de imágenes"]
 input_type_mapping = {
     "URL de imagen": "image_url", 
-    "Texto plano": "text_upload"
+    "Texto plano": "text_upload",
+    "Lote de URLs de imágenes": "image_batch"
 }
 reverse_mapping = {v: k for k, v in input_type_mapping.items()}
 
@@ -1458,6 +3871,27 @@ with col1:
             except Exception as e:
                 st.warning(f"⚠️ No se ha podido acceder a la imagen guardada. Error: {str(e)}")
     
+    elif st.session_state.input_type == "image_batch":
+        st.header("Proporciona las URLs de las imágenes")
+        texto_urls_lote = st.text_area(
+            "URLs de las imágenes (una por línea)",
+            height=200,
+            help="Cada URL se analiza como una página independiente"
+        )
+        archivo_urls_lote = st.file_uploader("O sube un archivo con una URL por línea", type=["txt"])
+        if archivo_urls_lote is not None:
+            texto_urls_lote += "\n" + archivo_urls_lote.getvalue().decode("utf-8")
+        urls_lote = parsear_lista_urls(texto_urls_lote)
+        
+        concurrencia_lote = st.slider(
+            "Análisis simultáneos",
+            min_value=1,
+            max_value=LOTE_MAX_WORKERS_LIMITE,
+            value=LOTE_MAX_WORKERS,
+            help="Número máximo de imágenes analizadas a la vez"
+        )
+        st.caption(f"{len(urls_lote)} URLs en el lote")
+    
     else:  # text_upload
         st.header("Texto de los ejercicios")
         # Opción para subir un archivo de texto
@@ -1525,13 +3959,19 @@ with col1:
             st.error("Por favor, ingresa tu clave API de Anthropic en la barra lateral.")
         elif st.session_state.input_type == "image_url" and not url_imagen:
             st.error("Por favor, proporciona una URL de imagen válida.")
+        elif st.session_state.input_type == "image_batch" and not urls_lote:
+            st.error("Por favor, proporciona al menos una URL de imagen.")
         elif st.session_state.input_type == "text_upload" and (not st.session_state.current_text_content.strip() and not st.session_state.temp_text_content.strip()):
             st.error("Por favor, introduce o sube un texto para procesar.")
         else:
             # Limpiar variables específicas para un nuevo procesamiento
-            for key in ['texto_respuesta', 'resultado', 'shortcode_versions']:
-                if key in st.session_state:
-                    del st.session_state[key]
+            # (las versiones del resultado activo siguen en el almacén del proyecto)
+            st.session_state.resultado_activo = None
+            
+            # Vista previa en la columna de resultados para el modo streaming
+            al_recibir_actividad = None
+            if usar_streaming and st.session_state.input_type != "image_batch":
+                al_recibir_actividad = crear_vista_previa_streaming(col2.container())
             
             # Procesar según el tipo de entrada
             if st.session_state.input_type == "image_url":
@@ -1551,7 +3991,10 @@ with col1:
                 
                 # Procesar la imagen desde la URL
                 with st.spinner("Analizando la imagen con Claude 4..."):
-                    texto_respuesta = analizar_imagen_con_prompt(api_key, url_imagen, prompt_personalizado)
+                    texto_respuesta = analizar_imagen_con_prompt(
+                        api_key, url_imagen, prompt_personalizado, usar_cache_respuestas, al_recibir_actividad,
+                        salida_estructurada=salida_estructurada
+                    )
                     
                     if texto_respuesta:
                         evento = "Imagen procesada con Claude 4"
@@ -1569,7 +4012,11 @@ with col1:
                     if not texto_a_procesar.strip():
                         texto_a_procesar = st.session_state.current_text_content
                     
-                    texto_respuesta = analizar_texto_con_prompt(api_key, texto_a_procesar, prompt_personalizado)
+                    # Los textos largos se dividen en bloques que se analizan en paralelo
+                    texto_respuesta = analizar_texto_por_bloques(
+                        api_key, texto_a_procesar, prompt_personalizado, usar_cache_respuestas, al_recibir_actividad,
+                        salida_estructurada=salida_estructurada
+                    )
                     
                     if texto_respuesta:
                         evento = "Texto procesado con Claude 4"
@@ -1579,25 +4026,45 @@ with col1:
                         
                         agregar_a_historial(evento, detalles)
             
-            # Procesar el resultado (común para todos los tipos de entrada)
-            if 'texto_respuesta' in locals() and texto_respuesta:
-                # Guardar el texto completo
-                st.session_state.texto_respuesta = texto_respuesta
+            elif st.session_state.input_type == "image_batch":
+                # Procesar todas las imágenes con un pool de hilos acotado
+                barra_progreso = st.progress(0.0, text=f"Analizando {len(urls_lote)} imágenes...")
+                
+                def al_completar_pagina(completadas, total, pagina):
+                    estado = "✅" if pagina["error"] is None else "❌"
+                    barra_progreso.progress(completadas / total, text=f"{completadas}/{total} {estado} {pagina['url']}")
                 
-                # Extraer información estructurada
-                info_estructurada = extraer_informacion_texto(texto_respuesta)
-                st.session_state.resultado = info_estructurada
+                inicio_lote = time.perf_counter()
+                resultados_lote = procesar_lote_imagenes(
+                    api_key, urls_lote, prompt_personalizado, concurrencia_lote,
+                    usar_cache_respuestas, al_completar_pagina, salida_estructurada
+                )
+                st.session_state.resultados_lote = resultados_lote
                 
-                # Asegurarse de que shortcode_versions existe
-                if 'shortcode_versions' not in st.session_state:
-                    st.session_state.shortcode_versions = {}
+                # Las páginas del lote nuevo empiezan sin versiones, aunque coincidan con las de uno anterior
+                proyecto = obtener_proyecto_actual()
+                for pagina in resultados_lote:
+                    if proyecto and pagina["resultado"] is not None:
+                        descartar_versiones(proyecto, huella_resultado(pagina["resultado"]))
                 
-                # Guardar la versión inicial de cada shortcode
-                for actividad in info_estructurada.get("actividades", []):
-                    guardar_version_shortcode(
-                        actividad.get("numero"), 
-                        actividad.get("shortcode")
-                    )
+                fallidas = [p for p in resultados_lote if p["error"] is not None]
+                agregar_a_historial(
+                    "Lote de imágenes procesado con Claude 4",
+                    f"Páginas: {len(resultados_lote)}\nFallidas: {len(fallidas)}\n"
+                    f"Concurrencia: {concurrencia_lote}\nTiempo: {time.perf_counter() - inicio_lote:.1f}s"
+                )
+                
+                # Abrir la primera página correcta como resultado activo
+                primera_correcta = next((p for p in resultados_lote if p["resultado"] is not None), None)
+                if primera_correcta:
+                    cargar_resultado_activo(primera_correcta["texto_respuesta"], primera_correcta["resultado"])
+                st.rerun()
+            
+            # Procesar el resultado (común para todos los tipos de entrada)
+            if 'texto_respuesta' in locals() and texto_respuesta:
+                # Guardar el texto completo, extraer la información estructurada
+                # y guardar la versión inicial de cada shortcode
+                cargar_resultado_activo(texto_respuesta, interpretar_respuesta(texto_respuesta))
                 
                 # Mostrar mensaje de éxito
                 st.success("¡Análisis completado!")
@@ -1606,164 +4073,75 @@ with col1:
 with col2:
     st.header("Resultado")
     
+    # Resumen del último lote procesado
+    if st.session_state.resultados_lote:
+        mostrar_resultados_lote()
+    
     # Mostrar mensaje de éxito si hay un resultado
-    if 'resultado' in st.session_state and st.session_state.resultado:
+    resultado = obtener_resultado_activo()
+    if resultado:
         st.success("✅ ¡Análisis completado con éxito! Consulta los resultados a continuación.")
     
-    if ('texto_respuesta' in st.session_state and st.session_state.texto_respuesta and 
-        'mostrar_respuesta_completa' in locals() and mostrar_respuesta_completa):
+    texto_completo = obtener_texto_respuesta() if 'mostrar_respuesta_completa' in locals() and mostrar_respuesta_completa else None
+    if texto_completo:
         # Mostrar el texto completo de la respuesta solo si está activada la opción
         with st.expander("Respuesta completa de Claude"):
-            st.markdown(st.session_state.texto_respuesta)
+            st.markdown(texto_completo)
     
-    if 'resultado' in st.session_state and st.session_state.resultado:
-        resultado = st.session_state.resultado
-        
+    if resultado:
         # Mostrar enunciado en una caja tipo markdown similar a la de los shortcodes
         st.subheader("Enunciado original")
         st.code(resultado.get("enunciado", "No se encontró un enunciado"), language="markdown")
         
         st.subheader("Actividades convertidas")
-        for i, actividad in enumerate(resultado.get("actividades", [])):
-            num_actividad = actividad.get("numero", i+1)
-            actividad_key = f"actividad_{num_actividad}"
-            
-            with st.expander(f"Actividad {num_actividad}", expanded=False):
-                st.markdown("**Texto original:**")
-                texto_original = actividad.get("texto_original", "")
-                st.write(texto_original)
-                
-                st.markdown("**Tipo de shortcode:**")
-                tipo_actual = actividad.get("tipo", "")
-                st.code(tipo_actual)
-                
-                # Mostrar shortcode actual
-                st.markdown("**Shortcode actual:**")
-                
-                # Obtener la versión más reciente del shortcode si existe
-                shortcode_actual = actividad.get("shortcode", "")
-                
-                # Asegurarse de que shortcode_versions existe
-                if 'shortcode_versions' not in st.session_state:
-                    st.session_state.shortcode_versions = {}
-                
-                if actividad_key in st.session_state.shortcode_versions and st.session_state.shortcode_versions[actividad_key]:
-                    versiones = st.session_state.shortcode_versions[actividad_key]
-                    if versiones:
-                        shortcode_actual = versiones[-1]["shortcode"]
-                
-                st.code(shortcode_actual, language="html")
-                
-                # Historial de versiones del shortcode
-                if actividad_key in st.session_state.shortcode_versions and len(st.session_state.shortcode_versions[actividad_key]) > 1:
-                    st.markdown("**Historial de versiones:**")
-                    version_tabs = st.tabs([f"V{v_idx+1}" for v_idx in range(len(st.session_state.shortcode_versions[actividad_key]))])
-                    for v_idx, (tab, version) in enumerate(zip(version_tabs, st.session_state.shortcode_versions[actividad_key])):
-                        with tab:
-                            st.write(f"**Versión {v_idx+1}** - {version['timestamp']}")
-                            st.code(version['shortcode'], language="html")
-                            if version.get('explicacion'):
-                                st.write(f"*Explicación:* {version['explicacion']}")
-                
-                # Área para refinar el shortcode
-                st.markdown("**Refinar este shortcode:**")
-                instruccion_refinamiento = st.text_area(
-                    "Instrucciones de refinamiento", 
-                    key=f"refine_{num_actividad}_{st.session_state.session_id}",
-                    help="Especifica cómo quieres mejorar o modificar este shortcode"
-                )
-                
-                if st.button("Refinar", key=f"btn_refine_{num_actividad}_{st.session_state.session_id}"):
-                    if not api_key:
-                        st.error("Se requiere una clave API para refinar el shortcode.")
-                    elif not instruccion_refinamiento:
-                        st.warning("Por favor, proporciona instrucciones sobre cómo refinar el shortcode.")
-                    else:
-                        with st.spinner("Refinando shortcode con Claude 4..."):
-                            # Obtener resultado de refinamiento
-                            resultado_refinamiento = refinar_shortcode(
-                                api_key, 
-                                shortcode_actual, 
-                                texto_original, 
-                                tipo_actual, 
-                                instruccion_refinamiento
-                            )
-                            
-                            if resultado_refinamiento and resultado_refinamiento["shortcode"]:
-                                # Guardar nueva versión
-                                guardar_version_shortcode(
-                                    num_actividad, 
-                                    resultado_refinamiento["shortcode"],
-                                    resultado_refinamiento.get("explicacion")
-                                )
-                                
-                                # Agregar al historial
-                                agregar_a_historial(
-                                    f"Refinamiento de Actividad {num_actividad} con Claude 4", 
-                                    f"Instrucción: {instruccion_refinamiento}\nExplicación: {resultado_refinamiento.get('explicacion', 'No proporcionada')}"
-                                )
-                                
-                                # Recargar la página para mostrar el shortcode actualizado
-                                st.rerun()
-                            else:
-                                st.error("No se pudo refinar el shortcode. Inténtalo de nuevo.")
+        actividades = resultado.get("actividades", [])
+        almacen = obtener_almacen_versiones()
+        
+        # Filtros por tipo de shortcode y validez
+        col_tipos, col_validez = st.columns(2)
+        with col_tipos:
+            tipos_filtro = st.multiselect(
+                "Tipo de shortcode",
+                sorted({etiqueta_shortcode(almacen.shortcode_actual(actividad)) for actividad in actividades}),
+                key="filtro_tipos_actividades"
+            )
+        with col_validez:
+            validez_filtro = st.selectbox(
+                "Validez", ["Todas", "Válidos", "Con problemas"], key="filtro_validez_actividades"
+            )
+        actividades_filtradas = filtrar_actividades(actividades, almacen, tipos_filtro, validez_filtro)
+        
+        # Solo se construyen los paneles de la página visible
+        paginas_actividades = max(1, -(-len(actividades_filtradas) // ACTIVIDADES_POR_PAGINA))
+        pagina_actividades = 1
+        if paginas_actividades > 1:
+            if st.session_state.get("pagina_actividades", 1) > paginas_actividades:
+                st.session_state.pagina_actividades = paginas_actividades
+            pagina_actividades = st.number_input(
+                "Página de actividades", min_value=1, max_value=paginas_actividades, value=1, key="pagina_actividades"
+            )
+        inicio = (pagina_actividades - 1) * ACTIVIDADES_POR_PAGINA
+        for num_actividad, actividad in actividades_filtradas[inicio:inicio + ACTIVIDADES_POR_PAGINA]:
+            mostrar_panel_actividad(actividad, num_actividad, api_key)
+        
+        if not actividades_filtradas:
+            st.info("Ninguna actividad cumple los filtros seleccionados.")
+        st.caption(
+            f"{len(actividades_filtradas)} de {len(actividades)} actividades · "
+            f"página {pagina_actividades} de {paginas_actividades}"
+        )
         
         # Mostrar todos los shortcodes juntos (versiones más recientes)
         st.subheader("Todos los shortcodes generados (versión actual)")
-        todos_shortcodes = []
-        
-        for actividad in resultado.get("actividades", []):
-            num_actividad = actividad.get("numero")
-            actividad_key = f"actividad_{num_actividad}"
-            
-            shortcode = actividad.get("shortcode", "")
-            # Usar la versión más reciente si existe
-            if 'shortcode_versions' in st.session_state and actividad_key in st.session_state.shortcode_versions and st.session_state.shortcode_versions[actividad_key]:
-                versiones = st.session_state.shortcode_versions[actividad_key]
-                if versiones:
-                    shortcode = versiones[-1]["shortcode"]
-            
-            todos_shortcodes.append(shortcode)
+        # Usar la versión más reciente de cada actividad si existe
+        almacen = obtener_almacen_versiones()
+        todos_shortcodes = [almacen.shortcode_actual(actividad) for actividad in resultado.get("actividades", [])]
         
         st.code("\n\n".join(todos_shortcodes), language="html")
             
-        # Generar y preparar descarga
-        texto_descargable = generate_download_text(resultado)
-        if texto_descargable:
-            st.subheader("Descargar resultados")
-            nombre_archivo_final = nombre_archivo if 'nombre_archivo' in locals() else "resultados_analisis.txt"
-            
-            # Preparar datos para descarga
-            b64_data, filename = get_download_data(texto_descargable, nombre_archivo_final)
-            
-            # Crear botón de descarga
-            download_button_str = f'''
-            <div style="margin-bottom: 20px;">
-            <a href="data:file/txt;base64,{b64_data}" download="{filename}">
-                <button style="
-                    background-color: #4CAF50;
-                    border: none;
-                    color: white;
-                    padding: 12px 24px;
-                    text-align: center;
-                    text-decoration: none;
-                    display: inline-block;
-                    font-size: 16px;
-                    margin: 4px 2px;
-                    cursor: pointer;
-                    border-radius: 4px;
-                    box-shadow: 0 2px 5px rgba(0,0,0,0.2);
-                ">
-                    📥 Descargar Resultados
-                </button>
-            </a>
-            </div>
-            '''
-            st.markdown(download_button_str, unsafe_allow_html=True)
-            
-            # Mostrar vista previa del archivo de descarga
-            with st.expander("Vista previa del archivo de descarga"):
-                st.text(texto_descargable)
+        # Descarga de resultados (se genera al pulsar el botón)
+        st.subheader("Descargar resultados")
+        mostrar_exportacion(resultado, nombre_archivo if 'nombre_archivo' in locals() else "resultados_analisis.txt")
         
         # ============================================================================
         # NUEVA SECCIÓN: PUBLICACIÓN EN EDIBLOCKS
@@ -1774,6 +4152,11 @@ with col2:
     else:
         st.info("Procesa una imagen o un texto para ver los resultados.")
 
+# Auditoría masiva de shortcodes
+st.markdown("---")
+with st.expander("📚 Auditoría de catálogo de shortcodes"):
+    mostrar_auditoria_catalogo()
+
 # Footer
 st.markdown("---")
 st.markdown("<div style='text-align: center; padding: 10px;'>Conversor de Ejercicios a Shortcodes + EdiBlocks - Desarrollado con ❤️ usando Claude 4</div>", unsafe_allow_html=True)
@@ -0,0 +1,139 @@
+"""Benchmark de latencia p50/p95 de una ráfaga de refinamientos contra un servidor local.
+
+Compara un requests.post por llamada (un handshake TCP+TLS en cada petición) con el
+ClienteAnthropic compartido de shortcodes.py (pool de conexiones keep-alive). El servidor
+local (stub_anthropic.py) imita /v1/messages con TLS (certificado autofirmado generado con
+el comando openssl); sin openssl se mide por HTTP, donde la diferencia es menor.
+
+Después comprueba MetricasAnthropic: con la caché de prompts del servidor, la tasa de acierto
+y los tokens de resumen() deben coincidir con el uso que ha devuelto el servidor, y las
+llamadas con caché leída deben tardar menos de media.
+
+shortcodes.py se importa en modo "bare": la interfaz se ejecuta sin servidor de Streamlit
+y sus avisos se silencian.
+
+Uso: python tests/bench_cliente_anthropic.py [peticiones] [concurrencia]
+"""
+import logging
+import sys
+import tempfile
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+import urllib3
+
+from stub_anthropic import StubAnthropic, contexto_tls
+
+SEGUNDOS_POR_TOKEN = 2e-5  # Latencia del stub por token de entrada no leído de la caché de prompts
+PETICIONES_POR_PREFIJO = 10  # Cada tantas peticiones el prefijo cacheado cambia (como si caducara)
+
+
+def cargar_shortcodes():
+    """Importar shortcodes.py sin servidor de Streamlit"""
+    logging.disable(logging.WARNING)
+    warnings.filterwarnings("ignore")
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    import shortcodes
+    return shortcodes
+
+
+def percentiles(tiempos):
+    tiempos = sorted(tiempos)
+    return tiempos[len(tiempos) // 2] * 1e3, tiempos[min(len(tiempos) - 1, int(len(tiempos) * 0.95))] * 1e3
+
+
+def medir(enviar, peticiones, concurrencia):
+    def una():
+        inicio = time.perf_counter()
+        respuesta = enviar()
+        assert respuesta.status_code == 200
+        return time.perf_counter() - inicio
+
+    with ThreadPoolExecutor(max_workers=concurrencia) as pool:
+        return percentiles(list(pool.map(lambda _: una(), range(peticiones))))
+
+
+def solicitud_refinamiento(sc, numero):
+    return sc.construir_solicitud_refinamiento(
+        '[writing maxtime="0"]Describe tu ciudad[/writing]', "Describe tu ciudad.", "writing",
+        f"Añade un punto final al enunciado (petición {numero})"
+    )
+
+
+def cliente_local(sc):
+    cliente = sc.ClienteAnthropic()
+    cliente.session.verify = False
+    cliente.session.trust_env = False
+    # Se mide la conexión y la caché, no la cuota: el limitador no debe hacer esperar a la ráfaga
+    cliente.limitador = sc.LimitadorAnthropic(rpm=10 ** 6, tpm=10 ** 9)
+    return cliente
+
+
+def comparar_latencias(sc, tls, peticiones, concurrencia):
+    with StubAnthropic(tls=tls) as stub:
+        sc.ANTHROPIC_API_URL = stub.url
+        data = solicitud_refinamiento(sc, 0)
+
+        def sin_pool():
+            # Lo que hacía cada llamada antes del cliente compartido: requests.post abre una sesión nueva
+            with requests.Session() as sesion:
+                sesion.trust_env = False
+                return sesion.post(
+                    stub.url, json=data, verify=False, timeout=sc.ANTHROPIC_TIMEOUT,
+                    headers={"x-api-key": "clave", "anthropic-version": sc.ANTHROPIC_API_VERSION}
+                )
+
+        cliente = cliente_local(sc)
+        print(f"{peticiones} refinamientos, {concurrencia} simultáneos, {stub.url.split(':')[0].upper()}")
+        print(f"{'cliente':>18} {'p50 (ms)':>9} {'p95 (ms)':>9}")
+        for nombre, enviar in (
+            ("requests.post", sin_pool),
+            ("ClienteAnthropic", lambda: cliente.enviar_mensaje("clave", data)),
+        ):
+            p50, p95 = medir(enviar, peticiones, concurrencia)
+            print(f"{nombre:>18} {p50:>9.2f} {p95:>9.2f}")
+
+
+def comprobar_metricas_cache(sc, tls, peticiones):
+    with StubAnthropic(tls=tls, segundos_por_token=SEGUNDOS_POR_TOKEN) as stub:
+        sc.ANTHROPIC_API_URL = stub.url
+        cliente = cliente_local(sc)
+        for numero in range(peticiones):
+            data = solicitud_refinamiento(sc, numero)
+            data["messages"][0]["content"][0]["text"] += f"\n(prefijo {numero // PETICIONES_POR_PREFIJO})"
+            assert cliente.enviar_mensaje("clave", data).status_code == 200
+        resumen = cliente.metricas.resumen()
+        uso = stub.uso
+
+    total = sum(uso.values())
+    esperada = uso["cache_read_input_tokens"] / total
+    print(f"\nCaché de prompts: {peticiones} refinamientos, el prefijo cambia cada {PETICIONES_POR_PREFIJO}")
+    print(f"  tasa de acierto: {resumen['tasa_acierto_cache']:.1%} (servidor: {esperada:.1%})")
+    print(f"  latencia media: {resumen['latencia_media_con_cache_leida'] * 1e3:.2f} ms con caché leída, "
+          f"{resumen['latencia_media_sin_cache_leida'] * 1e3:.2f} ms sin ella")
+    for clave, valor in uso.items():
+        assert resumen[clave] == valor, f"{clave}: {resumen[clave]} != {valor}"
+    assert abs(resumen["tasa_acierto_cache"] - esperada) < 1e-12
+    # La primera llamada de cada prefijo lo guarda en la caché y las siguientes lo leen
+    prefijos = -(-peticiones // PETICIONES_POR_PREFIJO)
+    assert (resumen["llamadas_sin_cache_leida"], resumen["llamadas_con_cache_leida"]) == (prefijos, peticiones - prefijos)
+    assert resumen["latencia_media_con_cache_leida"] < resumen["latencia_media_sin_cache_leida"]
+
+
+def main():
+    peticiones = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    concurrencia = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    urllib3.disable_warnings()
+
+    with tempfile.TemporaryDirectory() as directorio:
+        tls = contexto_tls(directorio)
+        sc = cargar_shortcodes()
+        comparar_latencias(sc, tls, peticiones, concurrencia)
+        comprobar_metricas_cache(sc, tls, peticiones)
+
+
+if __name__ == "__main__":
+    main()
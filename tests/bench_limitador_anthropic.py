@@ -0,0 +1,92 @@
+"""Ráfaga de varias sesiones a través de LimitadorAnthropic contra un servidor que aplica límites.
+
+El servidor local (stub_anthropic.py) responde 429 por encima de los límites de peticiones y
+tokens por minuto. Servidor y limitador empiezan sin saldo, como tras una ráfaga anterior, para
+que todas las peticiones dependan de la recarga. Con los mismos límites en ambos se comprueba que:
+  - sin limitador, la misma ráfaga sí recibe 429 (el servidor aplica los límites);
+  - con limitador, ninguna petición recibe 429;
+  - las sesiones se atienden por turnos (round-robin).
+
+Uso: python tests/bench_limitador_anthropic.py [sesiones] [peticiones_por_sesion]
+"""
+import sys
+import threading
+import time
+
+import requests
+
+from bench_cliente_anthropic import cargar_shortcodes
+from stub_anthropic import StubAnthropic
+
+HILOS_POR_SESION = 2  # Cada sesión tiene siempre peticiones en cola
+TOKENS_POR_PETICION = 50
+
+# Un escenario para cada cubo (20 peticiones por segundo en ambos)
+ESCENARIOS = (
+    ("peticiones por minuto", {"rpm": 1200, "tpm": 10 ** 7}),
+    ("tokens por minuto", {"rpm": 10 ** 6, "tpm": 1200 * TOKENS_POR_PETICION}),
+)
+
+
+def rafaga(url, sesiones, por_sesion, limitador=None):
+    def trabajador(sesion, peticiones):
+        with requests.Session() as cliente:
+            cliente.trust_env = False
+            for _ in range(peticiones):
+                if limitador:
+                    limitador.adquirir(sesion, TOKENS_POR_PETICION)
+                cliente.post(url, json={}, headers={
+                    "x-stub-sesion": sesion, "x-stub-tokens": str(TOKENS_POR_PETICION)
+                })
+
+    hilos = [
+        threading.Thread(target=trabajador, args=(f"sesion_{i}", por_sesion // HILOS_POR_SESION))
+        for i in range(sesiones) for _ in range(HILOS_POR_SESION)
+    ]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+
+def limitador_vacio(sc, limites):
+    limitador = sc.LimitadorAnthropic(**limites)
+    limitador.disponible = dict.fromkeys(limitador.disponible, 0.0)
+    return limitador
+
+
+def turnos_incumplidos(orden, sesiones):
+    """Posiciones en las que una sesión se atiende antes de que las demás hayan tenido su turno"""
+    return [i for i in range(len(orden) - sesiones + 1) if len(set(orden[i:i + sesiones])) < sesiones]
+
+
+def main():
+    sesiones = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    por_sesion = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    sc = cargar_shortcodes()
+
+    for nombre, limites in ESCENARIOS:
+        with StubAnthropic(**limites, vacio=True) as stub:
+            rafaga(stub.url, sesiones, por_sesion)
+            sin_limitador = stub.rechazadas()
+
+        with StubAnthropic(**limites, vacio=True) as stub:
+            inicio = time.perf_counter()
+            rafaga(stub.url, sesiones, por_sesion, limitador_vacio(sc, limites))
+            segundos = time.perf_counter() - inicio
+            rechazadas = stub.rechazadas()
+            # Turnos estrictos salvo al final, cuando ya no todas las sesiones tienen peticiones pendientes
+            orden = [sesion for sesion, _, _ in stub.peticiones][:-sesiones * HILOS_POR_SESION]
+            incumplidos = turnos_incumplidos(orden, sesiones)
+
+        print(f"Límite de {nombre}: {sesiones * por_sesion} peticiones de {sesiones} sesiones")
+        print(f"  sin limitador: {sin_limitador} respuestas 429")
+        print(f"  con limitador: {rechazadas} respuestas 429 en {segundos:.1f} s, "
+              f"{len(incumplidos)} peticiones fuera de turno")
+        assert sin_limitador > 0, "el servidor no ha aplicado el límite"
+        assert rechazadas == 0, "el limitador ha dejado pasar peticiones por encima del límite"
+        assert not incumplidos, "las sesiones no se han atendido por turnos"
+
+
+if __name__ == "__main__":
+    main()
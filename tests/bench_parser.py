@@ -0,0 +1,130 @@
+"""Benchmark de extraer_informacion_texto de 10 a 10 000 actividades, comparado con la
+implementación anterior basada en expresiones regulares (copiada de la versión f75fa03).
+
+La implementación anterior es cuadrática con respuestas mal formadas: a partir del tamaño en
+que una medición supera LIMITE_SEGUNDOS no se mide en los tamaños mayores.
+
+Uso: python tests/bench_parser.py [repeticiones]
+"""
+import re
+import sys
+import time
+
+from parser_sin_interfaz import cargar_parser
+
+TAMAÑOS = (10, 100, 1000, 10000)
+LIMITE_SEGUNDOS = 10
+
+
+# Implementación anterior, sin cambios salvo el nombre
+def extraer_informacion_texto_regex(texto_completo):
+    resultado = {}
+    
+    # Extraer el enunciado - más robusto ahora
+    match_enunciado = re.search(r'ENUNCIADO:[\s\r\n]*(.*?)(?=ACTIVIDAD|\Z)', texto_completo, re.DOTALL | re.IGNORECASE)
+    if match_enunciado:
+        resultado["enunciado"] = match_enunciado.group(1).strip()
+    else:
+        # Buscar alternativas como "Enunciado principal:" o similar
+        alt_matches = re.search(r'(?:ENUNCIADO|ENUNCIADO PRINCIPAL|INSTRUCCIÓN):[\s\r\n]*(.*?)(?=ACTIVIDAD|\Z)', texto_completo, re.DOTALL | re.IGNORECASE)
+        if alt_matches:
+            resultado["enunciado"] = alt_matches.group(1).strip()
+        else:
+            resultado["enunciado"] = "No se encontró un enunciado claro"
+    
+    # Extraer actividades - patrón más robusto
+    actividades = []
+    
+    # Patrón mejorado para capturar más variaciones en el formato
+    pattern = r'ACTIVIDAD\s+(\d+):\s*[\r\n]*(?:-\s*)?Texto original:[\s\r\n]*(.*?)[\r\n]*(?:-\s*)?Tipo de shortcode:[\s\r\n]*(.*?)[\r\n]*(?:-\s*)?Shortcode generado:[\s\r\n]*(.*?)(?=ACTIVIDAD\s+\d+:|\Z)'
+    
+    matches_actividades = re.finditer(pattern, texto_completo, re.DOTALL | re.IGNORECASE)
+    
+    for match in matches_actividades:
+        num_actividad = match.group(1)
+        texto_original = match.group(2).strip()
+        tipo = match.group(3).strip()
+        shortcode = match.group(4).strip()
+        
+        actividades.append({
+            "numero": num_actividad,
+            "texto_original": texto_original,
+            "tipo": tipo,
+            "shortcode": shortcode
+        })
+    
+    # Si no encontramos actividades con el patrón anterior, intentar un patrón alternativo
+    if not actividades:
+        alt_pattern = r'(?:ACTIVIDAD|EJERCICIO|PREGUNTA)\s*(?:\d+)?:?\s*(.*?)[\r\n]+(?:TIPO|SHORTCODE):?\s*(.*?)[\r\n]+(?:SHORTCODE|CÓDIGO):?\s*(.*?)(?=(?:ACTIVIDAD|EJERCICIO|PREGUNTA)|\Z)'
+        alt_matches = re.finditer(alt_pattern, texto_completo, re.DOTALL | re.IGNORECASE)
+        
+        for i, match in enumerate(alt_matches):
+            texto_original = match.group(1).strip()
+            tipo = match.group(2).strip()
+            shortcode = match.group(3).strip()
+            
+            actividades.append({
+                "numero": str(i+1),
+                "texto_original": texto_original,
+                "tipo": tipo,
+                "shortcode": shortcode
+            })
+    
+    resultado["actividades"] = actividades
+    
+    return resultado
+
+
+
+def actividad(numero, etiqueta_tipo="Tipo de shortcode"):
+    return (
+        f"ACTIVIDAD {numero}:\n"
+        f"- Texto original: Escribe una redacción sobre el tema {numero}.\n"
+        f"- {etiqueta_tipo}: writing\n"
+        f'- Shortcode generado: [writing maxtime="0"]Pregunta {numero}[/writing]\n\n'
+    )
+
+
+def respuesta(actividades, **kwargs):
+    return "ENUNCIADO: Lee el texto y responde.\n\n" + "".join(
+        actividad(numero, **kwargs) for numero in range(1, actividades + 1)
+    )
+
+
+def mejor_tiempo(funcion, texto, repeticiones):
+    """Mejor tiempo de varias repeticiones (una sola si la primera ya supera el límite)"""
+    mejor = float("inf")
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion(texto)
+        mejor = min(mejor, time.perf_counter() - inicio)
+        if mejor > LIMITE_SEGUNDOS:
+            break
+    return mejor
+
+
+def main():
+    repeticiones = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    extraer = cargar_parser()["extraer_informacion_texto"]
+    casos = (("bien formada", {}), ("sin «Tipo de shortcode»", {"etiqueta_tipo": "Tipo"}))
+    
+    print(f"{'actividades':>11} {'respuesta':>24} {'actual (ms)':>12} {'regex anterior (ms)':>20}")
+    omitidos = set()
+    for tamaño in TAMAÑOS:
+        for nombre, opciones in casos:
+            texto = respuesta(tamaño, **opciones)
+            assert len(extraer(texto)["actividades"]) == tamaño
+            actual = mejor_tiempo(extraer, texto, repeticiones)
+            
+            if nombre in omitidos:
+                anterior = f"> {LIMITE_SEGUNDOS * 1e3:.0f}"
+            else:
+                segundos = mejor_tiempo(extraer_informacion_texto_regex, texto, repeticiones)
+                anterior = f"{segundos * 1e3:.2f}"
+                if segundos > LIMITE_SEGUNDOS:
+                    omitidos.add(nombre)
+            print(f"{tamaño:>11} {nombre:>24} {actual * 1e3:>12.2f} {anterior:>20}")
+
+
+if __name__ == "__main__":
+    main()
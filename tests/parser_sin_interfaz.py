@@ -0,0 +1,44 @@
+"""Carga el parser de respuestas de shortcodes.py sin ejecutar la interfaz de Streamlit.
+
+shortcodes.py es un script de Streamlit: importarlo dibuja la aplicación entera. Aquí se
+toman de su árbol sintáctico solo las constantes de patrones y las funciones del parser.
+"""
+import ast
+import json
+import re
+from pathlib import Path
+from typing import Dict, List, Optional
+
+RUTA_SHORTCODES = Path(__file__).resolve().parent.parent / "shortcodes.py"
+
+CONSTANTES = ("PATRON_LINEA_", "PATRON_CAMPO_", "CAMPOS_ACTIVIDAD", "ENUNCIADO_NO_ENCONTRADO")
+DEFINICIONES = {
+    "extraer_informacion_texto",
+    "campos_en_linea",
+    "cerrar_actividad",
+    "interpretar_respuesta",
+    "ParserActividadesIncremental",
+}
+
+
+def _es_constante(nodo):
+    return isinstance(nodo, ast.Assign) and any(
+        isinstance(destino, ast.Name) and destino.id.startswith(CONSTANTES) for destino in nodo.targets
+    )
+
+
+def cargar_parser():
+    """Devolver un espacio de nombres con el parser de shortcodes.py"""
+    arbol = ast.parse(RUTA_SHORTCODES.read_text(encoding="utf-8"))
+    nodos = [
+        nodo for nodo in arbol.body
+        if _es_constante(nodo)
+        or (isinstance(nodo, (ast.FunctionDef, ast.ClassDef)) and nodo.name in DEFINICIONES)
+    ]
+    faltan = DEFINICIONES - {nodo.name for nodo in nodos if not isinstance(nodo, ast.Assign)}
+    if faltan:
+        raise ImportError(f"shortcodes.py no define: {', '.join(sorted(faltan))}")
+    
+    espacio = {"re": re, "json": json, "Dict": Dict, "List": List, "Optional": Optional}
+    exec(compile(ast.Module(body=nodos, type_ignores=[]), str(RUTA_SHORTCODES), "exec"), espacio)
+    return espacio
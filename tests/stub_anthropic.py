@@ -0,0 +1,175 @@
+"""Servidor local que imita /v1/messages de Anthropic para los benchmarks de tests/.
+
+Aplica límites de peticiones y tokens por minuto con un token bucket, como la API real:
+por encima del límite responde 429. Registra cada petición (sesión, tokens y código)
+para que los benchmarks comprueben el orden y los rechazos.
+
+También imita la caché de prompts: el prefijo hasta el último bloque con cache_control se
+cuenta como cache_creation_input_tokens la primera vez y como cache_read_input_tokens las
+siguientes (unos 4 caracteres por token), y los tokens no leídos de caché pueden añadir
+latencia (segundos_por_token). Los totales devueltos se acumulan en StubAnthropic.uso.
+"""
+import json
+import os
+import shutil
+import ssl
+import subprocess
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RESPUESTA_REFINAMIENTO = 'SHORTCODE REFINADO: [writing maxtime="0"]Describe tu ciudad.[/writing]\n\nEXPLICACIÓN: ok'
+
+
+def contexto_tls(directorio):
+    """Contexto TLS de servidor con un certificado autofirmado (None si no hay openssl)"""
+    if not shutil.which("openssl"):
+        return None
+    certificado, clave = os.path.join(directorio, "cert.pem"), os.path.join(directorio, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-subj", "/CN=127.0.0.1", "-keyout", clave, "-out", certificado],
+        check=True, capture_output=True
+    )
+    contexto = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    contexto.load_cert_chain(certificado, clave)
+    return contexto
+
+
+def tokens_texto(bloques):
+    return sum(len(bloque.get("text", "")) for bloque in bloques) // 4
+
+
+def bloques_peticion(peticion):
+    bloques = []
+    for mensaje in peticion.get("messages", []):
+        contenido = mensaje.get("content")
+        bloques.extend([{"text": contenido}] if isinstance(contenido, str) else contenido or [])
+    return bloques
+
+
+class CuboStub:
+    """Token bucket con la misma recarga continua que el de la API (capacidad por minuto)"""
+
+    def __init__(self, capacidad, vacio=False):
+        self.capacidad = float(capacidad)
+        self.disponible = 0.0 if vacio else self.capacidad
+        self.ultima_recarga = time.monotonic()
+
+    def recargar(self):
+        ahora = time.monotonic()
+        self.disponible = min(
+            self.capacidad, self.disponible + self.capacidad * (ahora - self.ultima_recarga) / 60
+        )
+        self.ultima_recarga = ahora
+
+    def alcanza(self, cantidad):
+        # Margen para el redondeo entre los relojes del limitador y del servidor
+        return cantidad <= self.disponible + 1e-6
+
+
+class StubAnthropic:
+    """Servidor /v1/messages en un hilo; rpm/tpm None = sin límite (vacio: sin saldo inicial).
+    Con un contexto TLS (contexto_tls) sirve por HTTPS"""
+
+    def __init__(self, rpm=None, tpm=None, vacio=False, tls=None, segundos_por_token=0.0):
+        self.cubos = {
+            nombre: CuboStub(capacidad, vacio)
+            for nombre, capacidad in (("peticiones", rpm), ("tokens", tpm)) if capacidad
+        }
+        self.segundos_por_token = segundos_por_token
+        self.peticiones = []  # (sesión, tokens, código) en orden de llegada
+        self.prefijos = set()  # Prefijos ya guardados en la caché de prompts
+        self.uso = dict.fromkeys(("input_tokens", "cache_creation_input_tokens", "cache_read_input_tokens"), 0)
+        self._lock = threading.Lock()
+        self.servidor = ThreadingHTTPServer(("127.0.0.1", 0), self._manejador())
+        self.servidor.daemon_threads = True
+        if tls:
+            self.servidor.socket = tls.wrap_socket(self.servidor.socket, server_side=True)
+        esquema = "https" if tls else "http"
+        self.url = f"{esquema}://127.0.0.1:{self.servidor.server_address[1]}/v1/messages"
+
+    def __enter__(self):
+        threading.Thread(target=self.servidor.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.servidor.shutdown()
+        self.servidor.server_close()
+
+    def rechazadas(self):
+        return sum(1 for _, _, codigo in self.peticiones if codigo == 429)
+
+    def atender(self, sesion, tokens):
+        """Registrar una petición y devolver su código (429 si supera algún límite)"""
+        with self._lock:
+            necesario = {"peticiones": 1, "tokens": tokens}
+            for cubo in self.cubos.values():
+                cubo.recargar()
+            # Como en la API, una petición rechazada no consume saldo de ningún cubo
+            codigo = 429
+            if all(cubo.alcanza(necesario[nombre]) for nombre, cubo in self.cubos.items()):
+                for nombre, cubo in self.cubos.items():
+                    cubo.disponible -= necesario[nombre]
+                codigo = 200
+            self.peticiones.append((sesion, tokens, codigo))
+            return codigo
+
+    def calcular_uso(self, bloques):
+        """Uso de tokens de una petición atendida, con el prefijo marcado con cache_control en la caché"""
+        marcados = [i for i, bloque in enumerate(bloques) if "cache_control" in bloque]
+        corte = marcados[-1] + 1 if marcados else 0
+        prefijo = json.dumps(bloques[:corte], sort_keys=True)
+        
+        uso = {
+            "input_tokens": tokens_texto(bloques[corte:]),
+            "cache_creation_input_tokens": 0,
+            "cache_read_input_tokens": 0,
+            "output_tokens": len(RESPUESTA_REFINAMIENTO) // 4
+        }
+        with self._lock:
+            if corte:
+                guardado = prefijo in self.prefijos
+                uso["cache_read_input_tokens" if guardado else "cache_creation_input_tokens"] = tokens_texto(bloques[:corte])
+                self.prefijos.add(prefijo)
+            for clave in self.uso:
+                self.uso[clave] += uso[clave]
+        return uso
+
+    def _manejador(self):
+        stub = self
+
+        class Manejador(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                peticion = json.loads(self.rfile.read(int(self.headers.get("content-length", 0))) or b"{}")
+                # Las ráfagas del limitador indican sus tokens en una cabecera; si no, se calculan
+                bloques = bloques_peticion(peticion)
+                tokens = int(self.headers.get("x-stub-tokens", tokens_texto(bloques)))
+                
+                codigo = stub.atender(self.headers.get("x-stub-sesion", "global"), tokens)
+                if codigo == 429:
+                    cuerpo = {"type": "error", "error": {"type": "rate_limit_error", "message": "rate limited"}}
+                else:
+                    uso = {"input_tokens": tokens, "output_tokens": 0}
+                    if "x-stub-tokens" not in self.headers:
+                        uso = stub.calcular_uso(bloques)
+                    # Lo que no se lee de la caché de prompts se procesa: tarda más
+                    time.sleep(stub.segundos_por_token * (uso["input_tokens"] + uso.get("cache_creation_input_tokens", 0)))
+                    cuerpo = {
+                        "content": [{"type": "text", "text": RESPUESTA_REFINAMIENTO}],
+                        "stop_reason": "end_turn",
+                        "usage": uso
+                    }
+                datos = json.dumps(cuerpo).encode("utf-8")
+                self.send_response(codigo)
+                self.send_header("content-type", "application/json")
+                self.send_header("content-length", str(len(datos)))
+                self.end_headers()
+                self.wfile.write(datos)
+
+        return Manejador
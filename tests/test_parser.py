@@ -0,0 +1,66 @@
+"""Corpus de respuestas de Claude (válidas y malformadas) para extraer_informacion_texto.
+
+Cada tests/corpus/<nombre>.txt tiene al lado <nombre>.json con el resultado esperado.
+"""
+import json
+from pathlib import Path
+
+import pytest
+
+from parser_sin_interfaz import cargar_parser
+
+CORPUS = Path(__file__).resolve().parent / "corpus"
+RESPUESTAS = sorted(ruta.stem for ruta in CORPUS.glob("*.txt"))
+
+parser = cargar_parser()
+
+
+def leer_respuesta(nombre):
+    # Sin traducir saltos de línea: el corpus incluye respuestas con \r\n
+    with open(CORPUS / f"{nombre}.txt", encoding="utf-8", newline="") as archivo:
+        return archivo.read()
+
+
+@pytest.mark.parametrize("nombre", RESPUESTAS)
+def test_corpus(nombre):
+    esperado = json.loads((CORPUS / f"{nombre}.json").read_text(encoding="utf-8"))
+    assert parser["extraer_informacion_texto"](leer_respuesta(nombre)) == esperado
+
+
+def test_cabecera_con_campo():
+    resultado = parser["extraer_informacion_texto"](leer_respuesta("valida_cabecera_con_campo"))
+    assert resultado["actividades"][0]["texto_original"] == "A"
+
+
+def test_actividad_en_linea():
+    resultado = parser["extraer_informacion_texto"](leer_respuesta("valida_actividad_en_linea"))
+    assert [actividad["shortcode"] for actividad in resultado["actividades"]] == [
+        "[writing][/writing]", "[radio|si*|no]"
+    ]
+
+
+def test_enunciado_no_termina_en_pregunta_sin_numero():
+    resultado = parser["extraer_informacion_texto"](leer_respuesta("valida_enunciado_con_pregunta"))
+    assert resultado["enunciado"] == "Lee el texto.\nPregunta a tu compañero qué opina."
+
+
+def test_respuesta_json():
+    texto = json.dumps({"enunciado": " Lee. ", "actividades": [{"texto_original": "a", "tipo": "radio", "shortcode": "[radio|a*|b]"}]})
+    assert parser["interpretar_respuesta"](texto) == {
+        "enunciado": "Lee.",
+        "actividades": [{"numero": "1", "texto_original": "a", "tipo": "radio", "shortcode": "[radio|a*|b]"}],
+    }
+
+
+@pytest.mark.parametrize("nombre", [
+    "valida_basico", "valida_crlf", "valida_sin_guion", "valida_cabecera_con_campo", "valida_actividad_en_linea"
+])
+def test_incremental_coincide_con_extraer(nombre):
+    # Con shortcodes de una línea, la lectura en streaming da las mismas actividades
+    texto = leer_respuesta(nombre)
+    incremental = parser["ParserActividadesIncremental"]()
+    emitidas = []
+    for inicio in range(0, len(texto), 7):
+        emitidas += incremental.alimentar(texto[inicio:inicio + 7])
+    emitidas += incremental.finalizar()
+    assert emitidas == parser["extraer_informacion_texto"](texto)["actividades"]